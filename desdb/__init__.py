@@ -1,12 +1,25 @@
 # files location code is useful even without oracle
 from . import files
 from . import sync
+from . import records
+from . import gzipio
+from . import profiling
+from . import hooks
+from . import metrics
 
 from .files import DESFiles
 
 # catch error if oracle is not found
 try:
     from . import desdb
+    from . import pool
+    from . import parallel
+    from . import batch
+    from . import split
+    from . import resume
+    from . import cache
+    from . import npyio
+    from . import fitsindex
 
     from .desdb import connect
     from .desdb import Connection
@@ -19,4 +32,8 @@ try:
 except:
     pass
 
-
+# asyncio interface, python 3 only
+try:
+    from . import aio
+except:
+    pass
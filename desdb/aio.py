@@ -0,0 +1,171 @@
+"""
+asyncio interface for running many small, independent queries concurrently.
+Requires python 3.
+
+The blocking driver calls are run in a thread pool kept for the connection
+parameters, with at least one thread per session in the pool.  Every query
+runs on a pooled session, so at most pool.maxsize queries are in flight at
+once; threads without a free session wait for one.
+
+examples
+--------
+
+    import asyncio
+    import desdb.aio
+
+    async def main():
+        res=await desdb.aio.aquick(query, params={'run':run})
+
+        # a list of queries, or (query, params) pairs, run concurrently
+        reslist=await desdb.aio.aquick_many(queries)
+
+    asyncio.run(main())
+
+    # from ordinary code
+    reslist=desdb.aio.quick_many(queries)
+
+    # a single session can also be used without blocking the event loop,
+    # although queries on one session run one at a time
+    res=await conn.quick_async(query)
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import pool
+
+_executors={}
+_executors_lock=threading.Lock()
+
+async def aquick(query, params=None, **keys):
+    """
+    Run Connection.quick on a pooled session without blocking the
+    event loop
+
+    parameters
+    ----------
+    query: string
+        A query to execute
+    params: dict or sequence, optional
+        Values for bind variables in the query
+    **keys:
+        Keywords for the pooled session, e.g. user,password,host, and
+        keywords for Connection.quick, e.g. lists,array
+    """
+    conn_keys,quick_keys=_split_keys(keys)
+
+    func=functools.partial(_quick_pooled,
+                           query,
+                           params,
+                           conn_keys,
+                           quick_keys)
+
+    loop=asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(**conn_keys), func)
+
+async def aquick_many(queries, return_exceptions=False, **keys):
+    """
+    Run the queries concurrently on pooled sessions and return the results
+    in the same order
+
+    parameters
+    ----------
+    queries: sequence
+        Each element is a query string or a (query, params) pair
+    return_exceptions: bool, optional
+        If True, errors are returned in place of the results rather than
+        raised.  Default False
+    **keys:
+        Keywords for aquick
+    """
+    coros=[]
+    for q in queries:
+        if isinstance(q, str):
+            query,params=q,None
+        else:
+            query,params=q
+        coros.append( aquick(query, params=params, **keys) )
+
+    return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+
+async def amap(func, items, **keys):
+    """
+    Call the blocking function on each item in the thread pool for the
+    connection parameters, returning the results in order.  Use this to
+    fan out helpers that run their own pooled queries, such as
+    files.Coadd.load
+
+    parameters
+    ----------
+    func: callable
+        Called as func(item)
+    items: sequence
+        The inputs
+    **keys:
+        Keywords identifying the session pool, e.g. user,password,host
+    """
+    conn_keys,extra=_split_keys(keys)
+    executor=get_executor(**conn_keys)
+
+    loop=asyncio.get_running_loop()
+    futures=[loop.run_in_executor(executor, func, item) for item in items]
+    return await asyncio.gather(*futures)
+
+def quick_many(queries, **keys):
+    """
+    Run the queries concurrently and wait for the results.  For use
+    outside of a running event loop.  See aquick_many
+    """
+    return run( aquick_many(queries, **keys) )
+
+def run(coro):
+    """
+    Run the coroutine in a new event loop and return the result
+    """
+    return asyncio.run(coro)
+
+def quick_async(conn, query, **keys):
+    """
+    Run conn.quick in a thread, returning an awaitable.  Used by
+    Connection.quick_async
+    """
+    func=functools.partial(conn.quick, query, **keys)
+
+    loop=asyncio.get_event_loop()
+    return loop.run_in_executor(None, func)
+
+def get_executor(**keys):
+    """
+    Get the thread pool for the connection parameters, with at least one
+    thread for each session in the pool
+    """
+    conn_keys,extra=_split_keys(keys)
+    pkey=pool._get_pool_key(**conn_keys)
+    sessions=pool.get_pool(**conn_keys)
+
+    with _executors_lock:
+        executor,nthreads=_executors.get(pkey, (None,0))
+        if executor is None or nthreads < sessions.maxsize:
+            # a larger one when the pool grows.  The old one is not shut
+            # down, since other callers may still be using it; its threads
+            # exit once it is no longer referenced
+            nthreads=sessions.maxsize
+            executor=ThreadPoolExecutor(max_workers=nthreads)
+            _executors[pkey]=(executor, nthreads)
+
+    return executor
+
+def _quick_pooled(query, params, conn_keys, quick_keys):
+    with pool.session(**conn_keys) as conn:
+        return conn.quick(query, params=params, **quick_keys)
+
+def _split_keys(keys):
+    conn_keys={}
+    other={}
+    for key,val in keys.items():
+        if key in pool._CONN_KEYS:
+            conn_keys[key]=val
+        else:
+            other[key]=val
+    return conn_keys,other
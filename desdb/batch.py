@@ -0,0 +1,295 @@
+"""
+Running many queries in one process.
+
+Scripts that call des-query once per tile or run pay for starting python,
+importing cx_Oracle, reading ~/.netrc and logging in for every query.  The
+functions here run a whole list of queries from one process, on a bounded
+pool of sessions, writing each result with the same code as
+Connection.quickWrite.
+
+manifest format
+---------------
+
+A manifest has one JSON object per line, with the query and output file
+
+    {"query": "select * from runtag where ...", "file": "tag1.csv"}
+    {"query_file": "objects.sql", "file": "objects.fits", "fmt": "fits"}
+
+Optional entries are "fmt", "params", "header", "replace_none" and "name",
+which labels the query in the report.  Blank lines and lines starting with #
+are skipped.
+
+examples
+--------
+
+    import desdb
+
+    results=desdb.batch.run_manifest('manifest.json', nsessions=4)
+
+    # or from the command line
+    des-query --batch manifest.json --nsessions 4 --report report.json
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import desdb
+from . import pool
+from . import profiling
+
+_NSESSIONS=4
+
+# keys allowed in a manifest entry
+_ENTRY_KEYS=('query','query_file','file','fmt','params','header',
+             'replace_none','name')
+
+def run_manifest(fname, **keys):
+    """
+    Read the manifest and run the queries.  See run_batch for the keywords
+    """
+    entries=read_manifest(fname)
+    return run_batch(entries, **keys)
+
+def read_manifest(fname):
+    """
+    Read a manifest with one JSON object per line, see the module docs.
+    Queries in a "query_file" are read relative to the directory of the
+    manifest
+
+    returns
+    -------
+    A list of dicts with 'query', 'file' and the optional entries
+    """
+    dirname=os.path.dirname(fname)
+
+    entries=[]
+    with open(fname) as fobj:
+        for lineno,line in enumerate(fobj,1):
+            line=line.strip()
+            if line=='' or line.startswith('#'):
+                continue
+
+            try:
+                entry=json.loads(line)
+            except ValueError as err:
+                raise ValueError("%s:%d: could not read entry: %s" % (fname,
+                                                                      lineno,
+                                                                      err))
+
+            if not isinstance(entry, dict):
+                raise ValueError("%s:%d: entries must be JSON "
+                                 "objects" % (fname,lineno))
+
+            if 'query_file' in entry:
+                qfile=os.path.join(dirname, entry.pop('query_file'))
+                with open(qfile) as qobj:
+                    entry['query']=qobj.read()
+
+            try:
+                _check_entry(entry)
+            except ValueError as err:
+                raise ValueError("%s:%d: %s" % (fname,lineno,err))
+
+            entries.append(entry)
+
+    return entries
+
+def run_batch(entries,
+              nsessions=_NSESSIONS,
+              fmt='csv',
+              header='names',
+              replace_none=None,
+              prefetch=desdb._PREFETCH,
+              stop_on_error=False,
+              verbose=True,
+              show=False,
+              **keys):
+    """
+    Run the queries on a pool of sessions, writing each result to its file
+    with quickWrite.  Errors in one query do not stop the others unless
+    stop_on_error is True.
+
+    parameters
+    ----------
+    entries: sequence of dicts
+        Each has a 'query' and an output 'file', and optionally 'fmt',
+        'params', 'header', 'replace_none' and 'name', as in a manifest
+    nsessions: int, optional
+        Number of queries run at once, each on its own session.  Default 4
+    fmt: string, optional
+        Format for entries without 'fmt'.  Default 'csv'
+    header: optional
+        Header for entries without 'header'.  Default 'names'
+    replace_none: optional
+        replace_none for entries without 'replace_none'
+    prefetch: int or 'auto', optional
+        Number of rows to fetch in each round trip
+    stop_on_error: bool, optional
+        If True, queries not yet started are skipped after an error.
+        Default False
+    verbose: bool, optional
+        If True, print a line to stderr as each query finishes.
+        Default True
+    show: bool, optional
+        If True, print the queries to stderr
+    **keys:
+        Keywords for the sessions, e.g. user,password,host,port,dbname
+
+    returns
+    -------
+    A list of dicts, in the order of the entries, with 'name', 'file',
+    'fmt', 'status' ('ok', 'error' or 'skipped'), 'seconds' and 'error'
+    """
+    entries=list(entries)
+    for entry in entries:
+        _check_entry(entry)
+
+    nentries=len(entries)
+    if nentries==0:
+        return []
+
+    nsessions=min(nsessions, nentries)
+    if nsessions < 1:
+        raise ValueError("nsessions must be >= 1, got %s" % nsessions)
+
+    sessions=pool.get_pool(**keys)
+
+    defaults={'fmt':fmt, 'header':header, 'replace_none':replace_none}
+
+    todo=queue.Queue()
+    for i,entry in enumerate(entries):
+        todo.put( (i,entry) )
+
+    results=[None]*nentries
+    state={'ndone':0}
+    lock=threading.Lock()
+    stop=threading.Event()
+
+    def finish(i, res):
+        with lock:
+            results[i]=res
+            state['ndone'] += 1
+            if verbose:
+                _print_result(res, state['ndone'], nentries)
+            if stop_on_error and res['status']=='error':
+                stop.set()
+
+    # the work in the threads is added to the caller's profile
+    prof=profiling.get_profile()
+
+    def work():
+        while True:
+            try:
+                i,entry=todo.get_nowait()
+            except queue.Empty:
+                return
+
+            if stop.is_set():
+                res=_get_result(entry, defaults)
+                res['status']='skipped'
+            else:
+                with profiling.using(prof):
+                    res=_run_entry(sessions, entry, defaults, prefetch, show)
+            finish(i, res)
+
+    # the pool goes back to its size when the batch is done
+    with sessions.expanded(nsessions):
+        threads=[]
+        for i in range(nsessions):
+            thread=threading.Thread(target=work)
+            thread.daemon=True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    # a timeout so the main thread can still be interrupted
+                    thread.join(0.1)
+        except KeyboardInterrupt:
+            stop.set()
+            raise RuntimeError("Interrupt encountered")
+
+    return results
+
+def write_report(results, file=None):
+    """
+    Write the results from run_batch as one JSON object per line
+
+    parameters
+    ----------
+    results: list
+        The output of run_batch
+    file: string, optional
+        The file to write.  Default standard output
+    """
+    if file is not None:
+        fobj=open(file,'w')
+    else:
+        fobj=sys.stdout
+
+    try:
+        for res in results:
+            fobj.write(json.dumps(res, sort_keys=True))
+            fobj.write('\n')
+    finally:
+        if file is not None:
+            fobj.close()
+
+def _run_entry(sessions, entry, defaults, prefetch, show):
+    res=_get_result(entry, defaults)
+
+    tm0=time.time()
+    try:
+        with sessions.session() as conn:
+            conn.quickWrite(entry['query'],
+                            fmt=res['fmt'],
+                            header=entry.get('header',defaults['header']),
+                            replace_none=entry.get('replace_none',
+                                                   defaults['replace_none']),
+                            params=entry.get('params',None),
+                            file=entry['file'],
+                            prefetch=prefetch,
+                            show=show)
+        res['status']='ok'
+    except Exception as err:
+        res['status']='error'
+        res['error']='%s: %s' % (err.__class__.__name__, err)
+
+    res['seconds']=round(time.time()-tm0, 3)
+    return res
+
+def _get_result(entry, defaults):
+    return {'name':entry.get('name',entry['file']),
+            'file':entry['file'],
+            'fmt':entry.get('fmt',defaults['fmt']),
+            'status':None,
+            'seconds':0.0,
+            'error':None}
+
+def _print_result(res, ndone, ntot):
+    mess='[%d/%d] %-7s %8.2fs  %s' % (ndone, ntot, res['status'],
+                                     res['seconds'], res['name'])
+    if res['error'] is not None:
+        mess += '  ' + res['error']
+    print(mess, file=sys.stderr)
+
+def _check_entry(entry):
+    bad=[k for k in entry if k not in _ENTRY_KEYS]
+    if len(bad) > 0:
+        raise ValueError("unknown manifest keys: %s" % ', '.join(bad))
+
+    if 'query' not in entry:
+        raise ValueError("each entry needs a 'query' or 'query_file'")
+
+    # results from several sessions cannot share standard output
+    if entry.get('file',None) is None:
+        raise ValueError("each entry needs an output 'file'")
@@ -0,0 +1,612 @@
+"""
+On-disk cache of query results.
+
+Results from Connection.quick can be kept on disk so repeated lookups of
+data that does not change, such as the runs in a release, do not go back to
+the database.  Entries are keyed by the query text with whitespace
+normalized, the bind values, the user, host and database name, and the form
+of the result (dicts, lists or array).
+
+Each entry is stored in its own file, column by column: a JSON header with
+the form of the result, the column names and types, followed by a numpy .npy
+array for each column, all compressed with zlib.  Nothing is unpickled when
+reading, so files placed in a shared cache directory cannot run code in the
+reader.  Results holding values other than numbers, strings, dates and NULL
+are not cached.
+
+Entries expire after a time-to-live, and when the total size goes over the
+limit the least recently used entries are removed.
+
+The cache directory is $DESDB_CACHE_DIR, or ~/.cache/desdb by default.
+
+examples
+--------
+
+    import desdb
+
+    conn=desdb.Connection()
+
+    # use the default cache
+    res=conn.quick(query, cache=True)
+
+    # keep these results for a week
+    res=conn.quick(query, cache=True, cache_ttl=7*86400)
+
+    # a cache with a different directory or size limit
+    qc=desdb.cache.QueryCache(dir='/some/dir', max_bytes=100*1024*1024)
+    res=conn.quick(query, cache=qc)
+
+    # remove the entries for a query, or everything
+    conn.invalidate_cache(query)
+    qc.clear()
+"""
+from __future__ import print_function
+import os
+import re
+import io
+import time
+import zlib
+import json
+import struct
+import hashlib
+import datetime
+import tempfile
+
+import numpy
+
+from . import records
+
+# default time-to-live for entries, seconds
+_TTL=86400.0
+
+# default size limit for the whole cache, bytes
+_MAX_BYTES=1024*1024*1024
+
+_EXT='.qcache'
+
+# each file starts with the expiration time
+_HEADER=struct.Struct('<d')
+
+# size of the JSON header that starts the compressed data
+_JSON_SIZE=struct.Struct('<I')
+
+# version of the stored format, part of the key
+_VERSION=2
+
+try:
+    _text_type=unicode
+    _int_types=(int, long)
+except NameError:
+    _text_type=str
+    _int_types=(int,)
+
+_default_cache=None
+
+def get_cache(cache=True):
+    """
+    Get a QueryCache.  If cache is True the default cache is returned,
+    otherwise cache is returned unchanged
+    """
+    global _default_cache
+
+    if cache is True:
+        if _default_cache is None:
+            _default_cache=QueryCache()
+        return _default_cache
+
+    return cache
+
+def get_default_dir():
+    """
+    The directory for the default cache, $DESDB_CACHE_DIR or ~/.cache/desdb
+    """
+    dir=os.environ.get('DESDB_CACHE_DIR',None)
+    if dir is None:
+        dir=os.path.join(os.path.expanduser('~'), '.cache', 'desdb')
+    return dir
+
+def normalize_query(query):
+    """
+    Collapse runs of whitespace so trivially different formatting
+    of the same query gives the same key
+    """
+    return re.sub(r'\s+', ' ', query).strip()
+
+class QueryCache(object):
+    """
+    An on-disk cache of query results, with a time-to-live for each
+    entry and a limit on the total size.
+
+    parameters
+    ----------
+    dir: string, optional
+        Directory holding the cache files.  Default $DESDB_CACHE_DIR
+        or ~/.cache/desdb
+    ttl: float, optional
+        Default number of seconds until entries expire.  Default one day
+    max_bytes: int, optional
+        Maximum total size of the cache files.  The least recently used
+        entries are removed to keep under the limit.  Default 1GB
+    """
+    def __init__(self, dir=None, ttl=None, max_bytes=None):
+        if dir is None:
+            dir=get_default_dir()
+        if ttl is None:
+            ttl=_TTL
+        if max_bytes is None:
+            max_bytes=_MAX_BYTES
+
+        self.dir=os.path.expandvars(os.path.expanduser(dir))
+        self.ttl=ttl
+        self.max_bytes=max_bytes
+
+    def get_key(self, query, params=None, user=None, host=None, dbname=None,
+                **mode):
+        """
+        Get the key for the query and parameters
+
+        parameters
+        ----------
+        query: string
+            The query
+        params: dict or sequence, optional
+            Values for bind variables
+        user,host,dbname: optional
+            Identify the database and its view of the data
+        **mode:
+            Keywords determining the form of the result, e.g. lists,
+            array, replace_none
+        """
+        base=self._get_base_key(query, params=params, user=user,
+                                host=host, dbname=dbname)
+        mode=repr( sorted(mode.items()) ).encode('utf-8')
+        return '%s-%s' % (base, hashlib.sha1(mode).hexdigest()[:12])
+
+    def _get_base_key(self, query, params=None, user=None, host=None,
+                      dbname=None):
+        """
+        the part of the key shared by all forms of the result
+        """
+        if isinstance(params, dict):
+            params=sorted(params.items())
+        elif params is not None:
+            params=list(params)
+
+        parts=[
+            _VERSION,
+            normalize_query(query),
+            params,
+            user,
+            host,
+            str(dbname),
+        ]
+        text=repr(parts).encode('utf-8')
+        return hashlib.sha1(text).hexdigest()
+
+    def get(self, key):
+        """
+        Get the result for the key, or None if it is missing or expired
+        """
+        fname=self._get_fname(key)
+        try:
+            with open(fname,'rb') as fobj:
+                expires,=_HEADER.unpack( fobj.read(_HEADER.size) )
+                if time.time() > expires:
+                    data=None
+                else:
+                    data=fobj.read()
+        except (IOError, OSError, struct.error):
+            return None
+
+        if data is None:
+            self._remove(fname)
+            return None
+
+        try:
+            res=_decode(data)
+        except Exception:
+            # a damaged entry
+            self._remove(fname)
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+
+        return res
+
+    def put(self, key, res, ttl=None):
+        """
+        Store the result under the key, removing old entries if the cache
+        is over its size limit
+
+        parameters
+        ----------
+        key: string
+            From get_key
+        res:
+            A result from Connection.quick
+        ttl: float, optional
+            Seconds until the entry expires.  Default is the ttl for
+            the cache
+        """
+        if ttl is None:
+            ttl=self.ttl
+
+        data=_encode(res)
+        if data is None:
+            return
+
+        self._makedir()
+
+        # write a temporary file and rename, so readers never see a
+        # partial entry
+        fd,tmpname=tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd,'wb') as fobj:
+                fobj.write( _HEADER.pack(time.time()+ttl) )
+                fobj.write(data)
+            os.rename(tmpname, self._get_fname(key))
+        except:
+            self._remove(tmpname)
+            raise
+
+        self.evict()
+
+    def invalidate(self, query, params=None, user=None, host=None,
+                   dbname=None):
+        """
+        Remove the entries for the query, for all forms of the result.
+        The keywords are the same as for get_key
+        """
+        base=self._get_base_key(query, params=params, user=user,
+                                host=host, dbname=dbname)
+
+        prefix=os.path.join(self.dir, base+'-')
+        for fname,size,mtime in self._list_entries():
+            if fname.startswith(prefix):
+                self._remove(fname)
+
+    def remove(self, key):
+        """
+        Remove the entry for the key
+        """
+        self._remove(self._get_fname(key))
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        for fname,size,mtime in self._list_entries():
+            self._remove(fname)
+
+    def evict(self):
+        """
+        Remove expired entries, then the least recently used entries until
+        the cache is under the size limit
+        """
+        entries=self._list_entries()
+
+        tm=time.time()
+        keep=[]
+        for entry in entries:
+            if self._expired(entry[0], tm):
+                self._remove(entry[0])
+            else:
+                keep.append(entry)
+
+        total=sum(e[1] for e in keep)
+        if total <= self.max_bytes:
+            return
+
+        keep.sort(key=lambda e: e[2])
+        for fname,size,mtime in keep:
+            if total <= self.max_bytes:
+                break
+            self._remove(fname)
+            total -= size
+
+    @property
+    def size(self):
+        """
+        total size of the cache files in bytes
+        """
+        return sum(e[1] for e in self._list_entries())
+
+    def _expired(self, fname, tm):
+        try:
+            with open(fname,'rb') as fobj:
+                expires,=_HEADER.unpack( fobj.read(_HEADER.size) )
+        except (IOError, OSError, struct.error):
+            return True
+        return tm > expires
+
+    def _list_entries(self):
+        """
+        list of (fname, size, mtime)
+        """
+        if not os.path.isdir(self.dir):
+            return []
+
+        entries=[]
+        for name in os.listdir(self.dir):
+            if not name.endswith(_EXT):
+                continue
+            fname=os.path.join(self.dir,name)
+            try:
+                st=os.stat(fname)
+            except OSError:
+                continue
+            entries.append( (fname, st.st_size, st.st_mtime) )
+        return entries
+
+    def _get_fname(self, key):
+        return os.path.join(self.dir, key+_EXT)
+
+    def _makedir(self):
+        if not os.path.exists(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError:
+                # made by another process
+                if not os.path.isdir(self.dir):
+                    raise
+
+    def _remove(self, fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+    def __repr__(self):
+        rep=["DESDB QueryCache"]
+        indent=' '*4
+        rep.append("%sdir:       %s" % (indent,self.dir))
+        rep.append("%sttl:       %s" % (indent,self.ttl))
+        rep.append("%smax_bytes: %s" % (indent,self.max_bytes))
+        return '\n'.join(rep)
+
+def _encode(res):
+    """
+    Convert a result from quick to the compressed data for a cache file.
+    Returns None for results that are not cached
+    """
+    entry=_to_columns(res)
+    if entry is None:
+        return None
+
+    header,arrays=entry
+    header['narrays']=len(arrays)
+
+    jtext=json.dumps(header).encode('utf-8')
+
+    bio=io.BytesIO()
+    bio.write(_JSON_SIZE.pack(len(jtext)))
+    bio.write(jtext)
+    for arr in arrays:
+        numpy.save(bio, arr, allow_pickle=False)
+
+    return zlib.compress(bio.getvalue())
+
+def _decode(data):
+    """
+    Get the result back from the compressed data of a cache file
+    """
+    bio=io.BytesIO(zlib.decompress(data))
+
+    jsize,=_JSON_SIZE.unpack(bio.read(_JSON_SIZE.size))
+    header=json.loads(bio.read(jsize).decode('utf-8'))
+
+    arrays=[numpy.load(bio, allow_pickle=False)
+            for i in range(header['narrays'])]
+
+    return _from_columns(header, arrays)
+
+def _to_columns(res):
+    """
+    Convert a result from quick to a JSON-able header and a list of
+    arrays.  Returns None for results that are not cached
+    """
+    if isinstance(res, tuple) and len(res)==2:
+        # array with null mask
+        arr,mask=res
+        header={'kind':'array_mask',
+                'descr':_get_descr(arr),
+                'mask_descr':_get_descr(mask),
+                'nrows':arr.size}
+        return header, _split_fields(arr) + _split_fields(mask)
+
+    if isinstance(res, numpy.ndarray):
+        header={'kind':'array', 'descr':_get_descr(res), 'nrows':res.size}
+        return header, _split_fields(res)
+
+    if isinstance(res, dict):
+        names=list(res.keys())
+        nrows=len(res[names[0]]) if len(names) > 0 else 0
+        return _values_to_columns('columns', names,
+                                  [res[n] for n in names], nrows)
+
+    if not isinstance(res, list):
+        return None
+
+    nrows=len(res)
+
+    if nrows > 0 and hasattr(res[0], '_names'):
+        names=list(res[0].keys())
+        columns=[ [r[i] for r in res] for i in range(len(names)) ]
+        return _values_to_columns('records', names, columns, nrows)
+
+    if nrows > 0 and isinstance(res[0], dict):
+        names=list(res[0].keys())
+        columns=[ [r[n] for r in res] for n in names ]
+        return _values_to_columns('dicts', names, columns, nrows)
+
+    ncol=len(res[0]) if nrows > 0 else 0
+    columns=[ [r[i] for r in res] for i in range(ncol) ]
+    return _values_to_columns('lists', None, columns, nrows)
+
+def _from_columns(header, arrays):
+    kind=header['kind']
+    if kind=='array':
+        return _join_fields(header['descr'], arrays)
+    elif kind=='array_mask':
+        nfields=len(header['descr'])
+        return (_join_fields(header['descr'], arrays[:nfields]),
+                _join_fields(header['mask_descr'], arrays[nfields:]))
+
+    nrows=header['nrows']
+    columns=[]
+    iarr=0
+    for info in header['types']:
+        narr=_get_narrays(info)
+        columns.append(_decode_values(info, arrays[iarr:iarr+narr], nrows))
+        iarr += narr
+
+    names=header['names']
+    if names is not None:
+        names=[_native_str(n) for n in names]
+
+    if kind=='columns':
+        return dict(zip(names, columns))
+    elif kind=='records':
+        rows=list(zip(*columns))
+        return records.rows2records(rows, names)
+    elif kind=='dicts':
+        return [dict(zip(names,row)) for row in zip(*columns)]
+    else:
+        return list(zip(*columns))
+
+def _values_to_columns(kind, names, columns, nrows):
+    """
+    header and arrays for columns of python values, or None if some
+    column cannot be stored without pickling
+    """
+    types=[]
+    arrays=[]
+    for vals in columns:
+        res=_encode_values(vals)
+        if res is None:
+            return None
+        info,carrays=res
+        types.append(info)
+        arrays += carrays
+
+    header={'kind':kind, 'names':names, 'types':types, 'nrows':nrows}
+    return header, arrays
+
+def _encode_values(vals):
+    """
+    Convert a list of python values to arrays.  Returns (info, arrays), with
+    info describing how to get the values back, or None if the values are
+    not all of one supported type
+    """
+    present=[v for v in vals if v is not None]
+    hasnull=len(present) < len(vals)
+
+    if len(present)==0:
+        return {'type':'null', 'null':False}, []
+
+    vtypes=set(type(v) for v in present)
+    fill=present[0]
+    filled=[fill if v is None else v for v in vals]
+
+    try:
+        if vtypes <= set(_int_types):
+            vtype='int'
+            arrays=[numpy.array(filled, dtype='i8')]
+        elif vtypes == set([float]):
+            vtype='float'
+            arrays=[numpy.array(filled, dtype='f8')]
+        elif vtypes <= set(_int_types + (float,)):
+            # NUMBER columns can hold both
+            vtype='number'
+            isfloat=numpy.array([type(v) is float for v in filled])
+            ivals=[0 if f else v for v,f in zip(filled,isfloat)]
+            fvals=[v if f else 0.0 for v,f in zip(filled,isfloat)]
+            arrays=[numpy.array(ivals, dtype='i8'),
+                    numpy.array(fvals, dtype='f8'),
+                    isfloat]
+        elif vtypes == set([_text_type]) or vtypes == set([bytes]):
+            if vtypes == set([bytes]):
+                vtype,dtype,nul='bytes','S',b'\0'
+            else:
+                vtype,dtype,nul='text','U',u'\0'
+
+            # fixed width arrays drop trailing NUL characters
+            if any(v.endswith(nul) for v in present):
+                return None
+            arrays=[numpy.array(filled, dtype=dtype)]
+        elif vtypes == set([datetime.datetime]):
+            if any(v.tzinfo is not None for v in present):
+                return None
+            vtype='datetime'
+            arrays=[numpy.array(filled, dtype='datetime64[us]')]
+        elif vtypes == set([datetime.date]):
+            vtype='date'
+            arrays=[numpy.array(filled, dtype='datetime64[D]')]
+        else:
+            return None
+    except (OverflowError, ValueError):
+        # e.g. integers too large for 64 bits
+        return None
+
+    if hasnull:
+        arrays.append( numpy.array([v is None for v in vals]) )
+
+    return {'type':vtype, 'null':hasnull}, arrays
+
+def _decode_values(info, arrays, nrows):
+    """
+    get the list of python values back from the arrays
+    """
+    vtype=info['type']
+    if vtype=='null':
+        return [None]*nrows
+
+    if vtype=='number':
+        ivals,fvals,isfloat=arrays[0:3]
+        vals=[f if isf else i for i,f,isf in zip(ivals.tolist(),
+                                                 fvals.tolist(),
+                                                 isfloat.tolist())]
+    else:
+        vals=arrays[0].tolist()
+
+    if info['null']:
+        isnull=arrays[-1].tolist()
+        vals=[None if n else v for v,n in zip(vals,isnull)]
+
+    return vals
+
+def _native_str(text):
+    """
+    json gives unicode in python 2, where the names were str
+    """
+    if not isinstance(text, str):
+        text=text.encode('utf-8')
+    return text
+
+def _get_narrays(info):
+    narr={'null':0, 'number':3}.get(info['type'],1)
+    if info['null']:
+        narr += 1
+    return narr
+
+def _get_descr(arr):
+    return [list(d) for d in arr.dtype.descr]
+
+def _split_fields(arr):
+    return [numpy.ascontiguousarray(arr[n]) for n in arr.dtype.names]
+
+def _join_fields(descr, arrays):
+    # json gives lists, and unicode names which numpy in python 2 does
+    # not take
+    descr=[(_native_str(d[0]), str(d[1])) + tuple(tuple(x) for x in d[2:])
+           for d in descr]
+
+    nrows=arrays[0].shape[0] if len(arrays) > 0 else 0
+    arr=numpy.zeros(nrows, dtype=descr)
+    for name,col in zip(arr.dtype.names, arrays):
+        arr[name]=col
+    return arr
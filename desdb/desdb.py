@@ -6,6 +6,16 @@ import os
 import sys
 from sys import stdout,stderr
 import csv
+import time
+import operator
+import itertools
+import tempfile
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     import cx_Oracle
@@ -14,6 +24,9 @@ except ImportError as e:
     sys.stderr.write("Could not import cx_Oracle: %s" % str(e))
     raise e
 
+from . import profiling
+from . import hooks
+
 try:
     import json
     have_json=True
@@ -35,12 +48,66 @@ _release_map={'dc6b':'dr012', 'dr012':'dr012'}
 
 _PREFETCH=10000
 
+# for prefetch='auto', the number of rows per round trip is chosen so the
+# fetched rows take about this much memory, within these limits
+_PREFETCH_BYTES=32*1024*1024
+_PREFETCH_MIN=100
+_PREFETCH_MAX=200000
+
+# for prefetch='auto', fetches faster than this many seconds grow the number
+# of rows fetched, and slower ones shrink it
+_PREFETCH_FAST=0.1
+_PREFETCH_SLOW=2.0
+
+# rough per-value overhead of the python objects for each fetched row
+_PYOBJ_BYTES=40
+
+# number of fetched chunks a ThreadedCursor holds ready for the writer
+_FETCH_DEPTH=2
+
+# number of parsed statements oracle keeps for each session
+_STMTCACHESIZE=50
+
 # for numpy conversions of NUMBER types
 _defs={}
 _defs['f4_digits'] = 6
 _defs['f8_digits'] = 15
 _defs['lower'] = True
 
+# values used for NULL in numpy conversions, by type kind.  Strings get
+# an empty string
+_null_sentinels={}
+_null_sentinels['f'] = float('nan')
+_null_sentinels['i'] = -9999
+_null_sentinels['u'] = 0
+_null_sentinels['b'] = False
+
+# output formats written from numpy arrays
+_numpy_formats=('fits','npydir')
+
+# forms of the result for Connection.quick(container=)
+_containers=('dicts','records','columns')
+
+# largest width taken from the description for streaming pretty output
+_PRETTY_MAXWIDTH=30
+_pretty_string_types=tuple(
+    getattr(cx_Oracle,n) for n in ('STRING','FIXED_CHAR','NCHAR','FIXED_NCHAR')
+    if hasattr(cx_Oracle,n)
+)
+
+# value types for the block csv writer
+_NoneType=type(None)
+_csv_float_types=set([float])
+_csv_str_types=set([str])
+try:
+    _csv_int_types=set([int,long,bool])
+    # csv.writer encodes these in python 2
+    _csv_nostr_types=set([unicode])
+except NameError:
+    _csv_int_types=set([int,bool])
+    _csv_nostr_types=set()
+_csv_number_types=_csv_int_types | _csv_float_types
+
 _binary_err='size of %s not allowed for BINARY floating point types'
 
 _flt_digits_err=\
@@ -55,6 +122,9 @@ _int_digits_err=\
 
 _string_err='The size of field "%s" is %s but must be greater than zero'
 
+# older versions of cx_Oracle have no native integer type
+_NATIVE_INT=getattr(cx_Oracle, 'NATIVE_INT', None)
+
 
 def dataset2release(dataset):
     if dataset not in _release_map:
@@ -76,6 +146,10 @@ class Connection(cx_Oracle.Connection):
     quick:
         Execute the query and return the results.
 
+    quick_async:
+        Execute the query in a thread, returning an awaitable
+        for use with asyncio
+
     quickWrite:
         Execute the query and write the results to a the
         standard output or a file.
@@ -100,6 +174,17 @@ class Connection(cx_Oracle.Connection):
             over-ride the default port
         dbname: optional
             over-ride the default database name
+        threaded: bool, optional
+            Set up the session so it can be used from threads other
+            than the one that created it, as is done in the session
+            pools.  Default True
+        stmtcachesize: int, optional
+            Number of parsed statements to keep in the client statement
+            cache.  Queries with the same text, for example those using
+            bind variables, are then not re-parsed.  Default 50
+        prefetch_bytes: int, optional
+            Memory budget in bytes used to choose the number of rows
+            per round trip when prefetch='auto' is sent.  Default 32MB
         """
         p=PasswordGetter(**keys)
         self._pwd_getter=p
@@ -108,11 +193,24 @@ class Connection(cx_Oracle.Connection):
 
         url = _url_template % (p.host, self._port, self._dbname)
 
-        cx_Oracle.Connection.__init__(self,p.user,p.password,url)
+        with profiling.get_profile().timer('connect'):
+            cx_Oracle.Connection.__init__(self,p.user,p.password,url,
+                                          threaded=self._threaded)
+
+        self.stmtcachesize=self._stmtcachesize
 
 
     def quick(self, query, lists=False, strings=False, array=False,
               prefetch=_PREFETCH,
+              params=None,
+              replace_none=None,
+              null_mask=False,
+              container=None,
+              shared=None,
+              max_memory=None,
+              cache=None,
+              cache_ttl=None,
+              profile=False,
               show=False, **keys):
         """
         Execute the query and return the result.
@@ -123,38 +221,179 @@ class Connection(cx_Oracle.Connection):
         ----------
         query: string
             A query to execute
+        params: dict or sequence, optional
+            Values for bind variables in the query, e.g.
+                conn.quick("select * from coadd where run=:run",
+                           params={'run':run})
+            Using bind variables rather than pasting values into the
+            query lets the server and client statement cache reuse
+            the parsed statement.
         lists: bool, optional
             Return a list of lists instead of a list of dicts.
         strings: bool, optional
             Convert all values to strings
         array: bool, optional
             If True, convert to a numpy recarray
+        container: string, optional
+            The form of the result, instead of a list of dicts
+                'records': a list of Record objects, tuples with attribute
+                           access to the columns that also support
+                           r['band'] as for the dicts.  Records are
+                           read-only; use r.asdict() for a row that can
+                           be modified
+                'columns': a dict with a list of values for each column
+                'dicts':   a list of dicts, the default
+            See desdb.records
+        replace_none: optional
+            For array=True, replace NULL with this value.  By default a
+            value is chosen for each type, see get_null_sentinel
+        null_mask: bool, optional
+            For array=True, also return a mask array with True where the
+            nullable columns were NULL, see cursor2array
+        prefetch: int or 'auto', optional
+            Number of rows to fetch in each round trip.  If 'auto', the
+            number is chosen from the row width and the prefetch_bytes
+            budget of the connection, and adjusted as rows are fetched.
+            Default 10000
+        shared: bool or string, optional
+            For array=True, write the result once into a .npy file and
+            return a desdb.npyio.SharedArray handle.  The handle can be sent
+            to worker processes, which attach to the data as a read-only
+            memory map with handle.attach().  If True the file is made in
+            shared memory under /dev/shm, or $DESDB_SHM_DIR if set.  A
+            directory or a file name ending in .npy can also be sent.
+            Remove the file with handle.unlink() when done.
+        max_memory: int, optional
+            For array=True, a memory budget in bytes for the result.  If
+            the result grows past the budget, it is written to a file in
+            $DES_SCRATCH, or the temporary directory, and a numpy memmap
+            is returned.  See cursor2array
+        cache: bool or QueryCache, optional
+            If True, look for the result in the default on-disk cache
+            before running the query, and store it there afterward.  A
+            desdb.cache.QueryCache can also be sent.  Default is no caching
+        cache_ttl: float, optional
+            Seconds to keep the cached result.  Default is the ttl of
+            the cache, one day for the default cache
+        profile: bool, optional
+            If True, time each phase of the query and return
+            (result, stats), with stats a desdb.profiling.QueryProfile
         show: bool, optional
             If True, print the query to stderr
         """
 
-        curs=self.cursor()
+        if profile:
+            with profiling.profiled() as stats:
+                res=self.quick(query, lists=lists, strings=strings,
+                               array=array, prefetch=prefetch, params=params,
+                               replace_none=replace_none, null_mask=null_mask,
+                               container=container, shared=shared,
+                               max_memory=max_memory, cache=cache,
+                               cache_ttl=cache_ttl, show=show, **keys)
+            return res, stats
+
+        if container is not None:
+            if container not in _containers:
+                raise ValueError("container should be one of %s, got "
+                                 "'%s'" % (_containers,container))
+            if lists or array:
+                raise ValueError("container= cannot be used with "
+                                 "lists or array")
+
+        if shared and not array:
+            raise ValueError("shared= requires array=True")
+        if max_memory is not None and not array:
+            raise ValueError("max_memory= requires array=True")
+
+        if cache:
+            from . import cache as qcache
+            cache=qcache.get_cache(cache)
+            key=self._get_cache_key(cache, query, params,
+                                    lists=lists,
+                                    strings=strings,
+                                    array=array,
+                                    container=container,
+                                    replace_none=replace_none,
+                                    null_mask=null_mask,
+                                    shared=bool(shared),
+                                    spilled=(max_memory is not None))
+            res=cache.get(key)
+            if res is not None:
+                if show:
+                    stderr.write('using cached result for query\n')
+                return res
+
+        res=self._quick(query, lists=lists, array=array, prefetch=prefetch,
+                        params=params, container=container,
+                        replace_none=replace_none,
+                        null_mask=null_mask, shared=shared,
+                        max_memory=max_memory, show=show)
+
+        if cache:
+            cache.put(key, res, ttl=cache_ttl)
 
-        # pre-fetch
-        curs.arraysize = prefetch
+        return res
 
-        if show: 
-            stderr.write(query);stderr.write('\n')
-        curs.execute(query)
+    def invalidate_cache(self, query, params=None, cache=True):
+        """
+        Remove the cached results for the query, see quick()
+
+        parameters
+        ----------
+        query: string
+            The query
+        params: dict or sequence, optional
+            The values for bind variables
+        cache: bool or QueryCache, optional
+            The cache, default the default cache
+        """
+        from . import cache as qcache
+        cache=qcache.get_cache(cache)
+        cache.invalidate(query,
+                         params=params,
+                         user=self._pwd_getter.user,
+                         host=self._pwd_getter.host,
+                         dbname=self._dbname)
+
+    def _get_cache_key(self, cache, query, params, **mode):
+        return cache.get_key(query,
+                             params=params,
+                             user=self._pwd_getter.user,
+                             host=self._pwd_getter.host,
+                             dbname=self._dbname,
+                             **mode)
+
+    def _quick(self, query, lists=False, array=False, prefetch=_PREFETCH,
+               params=None, container=None,
+               replace_none=None, null_mask=False, shared=None,
+               max_memory=None, show=False):
+        """
+        run the query for quick(), without the cache
+        """
+        curs=self._execute(query, params=params, prefetch=prefetch, show=show,
+                           numpy_types=array)
 
         if curs.description is not None:
 
             if lists:
                 res=[]
-                try:
-                    for r in curs:
-                        res.append(r)
-                except KeyboardInterrupt:
-                    curs.close()
-                    raise RuntimeError("Interrupt encountered")
-
+                for rows in cursor_chunks(curs):
+                    res += rows
+
+            elif array and shared:
+                res=cursor2shared(curs,
+                                  shared=shared,
+                                  replace_none=replace_none,
+                                  null_mask=null_mask)
             elif array:
-                res=cursor2array(curs)
+                res=cursor2array(curs,
+                                 replace_none=replace_none,
+                                 null_mask=null_mask,
+                                 max_memory=max_memory)
+            elif container=='records':
+                res = cursor2records(curs)
+            elif container=='columns':
+                res = cursor2columns(curs)
             else:
                 res = cursor2dictlist(curs)
         else:
@@ -162,10 +401,132 @@ class Connection(cx_Oracle.Connection):
         curs.close()
         return res
 
+    def quick_async(self, query, **keys):
+        """
+        Run quick() in a thread so the asyncio event loop is not
+        blocked, returning an awaitable.  Python 3 only.
+
+            res=await conn.quick_async(query)
+
+        Queries on a single session still run one at a time; use
+        desdb.aio.aquick_many to run many queries concurrently on
+        pooled sessions.
+
+        parameters
+        ----------
+        Same as for quick()
+        """
+        from . import aio
+        return aio.quick_async(self, query, **keys)
+
+    def iter_rows(self, query, params=None, chunksize=_PREFETCH, show=False):
+        """
+        Execute the query and yield the rows in chunks as they are fetched,
+        so the full result is never held in memory.
+
+        parameters
+        ----------
+        query: string
+            A query to execute
+        params: dict or sequence, optional
+            Values for bind variables in the query
+        chunksize: int or 'auto', optional
+            Number of rows to fetch in each round trip, and the maximum
+            number of rows in each chunk.  See the prefetch keyword
+            for quick()
+        show: bool, optional
+            If True, print the query to stderr
+
+        yields
+        ------
+        lists of row tuples
+
+        examples
+        --------
+        for rows in conn.iter_rows(query):
+            for row in rows:
+                ...
+        """
+
+        curs=self._execute(query, params=params, prefetch=chunksize, show=show)
+        try:
+            if curs.description is not None:
+                for rows in cursor_chunks(curs):
+                    yield rows
+        finally:
+            curs.close()
+
+    def iter_arrays(self, query, params=None, chunksize=_PREFETCH,
+                    replace_none=None,
+                    null_mask=False,
+                    dtype=None,
+                    f4_digits=_defs['f4_digits'],
+                    f8_digits=_defs['f8_digits'],
+                    lower=_defs['lower'],
+                    show=False):
+        """
+        Execute the query and yield the result in chunks of numpy arrays
+        with fields, converting each chunk as it is fetched.
+
+        parameters
+        ----------
+        query: string
+            A query to execute
+        params: dict or sequence, optional
+            Values for bind variables in the query
+        chunksize: int or 'auto', optional
+            Number of rows to fetch in each round trip, and the maximum
+            number of rows in each array.  See the prefetch keyword
+            for quick()
+        replace_none: optional
+            Replace NULL with this value.  By default a value is chosen for
+            each type, see get_null_sentinel
+        null_mask: bool, optional
+            If True, yield (array, mask) pairs, see cursor2array
+        dtype, f4_digits, f8_digits, lower:
+            See the docs for cursor2array
+        show: bool, optional
+            If True, print the query to stderr
+
+        yields
+        ------
+        numpy arrays with fields, all with the same dtype
+
+        examples
+        --------
+        nobj=0
+        for data in conn.iter_arrays(query):
+            w,=numpy.where(data['flags']==0)
+            nobj += w.size
+        """
+
+        curs=self._execute(query, params=params, prefetch=chunksize, show=show,
+                           numpy_types=True)
+        try:
+            if curs.description is not None:
+                chunks=cursor2array_chunks(curs,
+                                           replace_none=replace_none,
+                                           null_mask=null_mask,
+                                           dtype=dtype,
+                                           f4_digits=f4_digits,
+                                           f8_digits=f8_digits,
+                                           lower=lower)
+                for data in chunks:
+                    yield data
+        finally:
+            curs.close()
+
     def quickWrite(self, query, fmt='csv', header='names',
                    prefetch=_PREFETCH,
                    replace_none=None,
                    file=None,
+                   params=None,
+                   fetch_thread=True,
+                   split_by=None,
+                   max_open=None,
+                   index_by=None,
+                   nconcurrent=1,
+                   profile=False,
                    show=False):
         """
         Execute the query and print the results.
@@ -173,9 +534,17 @@ class Connection(cx_Oracle.Connection):
         parameters
         ----------
         query: string
-            A query to execute
+            A query to execute.  For fits output this can also be a list
+            of (name, query) or (name, query, params), or a dict keyed by
+            name, to write each result as a named extension of one file.
+            See queries2fits
+        params: dict or sequence, optional
+            Values for bind variables in the query
         fmt: string, optional
             The format for writing.  Default 'csv'
+        prefetch: int or 'auto', optional
+            Number of rows to fetch in each round trip.  See the docs
+            for quick()
         header: string,optional
             If not False, put a header.  Can be
                 'names' csv names
@@ -183,36 +552,75 @@ class Connection(cx_Oracle.Connection):
         file: string
             Write the results to the file rather than
             standard output
+        fetch_thread: bool, optional
+            If True, fetch rows in a background thread while the previous
+            chunk is converted and written, see ThreadedCursor.
+            Default True
+        split_by: string or sequence, optional
+            Write the rows to a separate file for each value of these
+            columns, in one pass over the results.  file is then a
+            template for the names, e.g. 'objects-{tilename}.fits'.
+            See desdb.split
+        max_open: int, optional
+            Maximum number of files open at once with split_by, default 64
+        index_by: string or sequence, optional
+            For fits output, add a sorted index on these columns for fast
+            lookups with desdb.fitsindex.FitsIndex
+        nconcurrent: int, optional
+            When writing several queries to fits, the number run at once
+            on pooled sessions.  Default 1
+        profile: bool, optional
+            If True, time each phase of the query and return the
+            statistics as a desdb.profiling.QueryProfile
 
         show: bool, optional
             If True, print the query to stderr
         """
 
-        curs=self.cursor()
-        curs.arraysize = prefetch
+        if profile:
+            with profiling.profiled() as stats:
+                self.quickWrite(query, fmt=fmt, header=header,
+                                prefetch=prefetch, replace_none=replace_none,
+                                file=file, params=params,
+                                fetch_thread=fetch_thread, split_by=split_by,
+                                max_open=max_open, index_by=index_by,
+                                nconcurrent=nconcurrent, show=show)
+            return stats
+
+        if isinstance(query, (list,tuple,dict)):
+            if fmt != 'fits':
+                raise ValueError("several queries can only be written "
+                                 "to fits")
+            if file is None:
+                raise RuntimeError("you must send file= for fits writing")
+
+            queries2fits(file,
+                         query,
+                         conn=self,
+                         nconcurrent=nconcurrent,
+                         replace_none=replace_none,
+                         prefetch=prefetch,
+                         show=show)
+            return
 
-        if show: 
-            stderr.write(query)
-        curs.execute(query)
+        curs=self._execute(query, params=params, prefetch=prefetch, show=show,
+                           numpy_types=(fmt in _numpy_formats))
 
-        if curs.description is not None:
-            if fmt=='fits':
-                if file is None:
-                    raise RuntimeError("you must send file= for fits writing")
+        if fetch_thread and curs.description is not None:
+            curs=ThreadedCursor(curs)
 
-                cursor2fits(
-                    file,
-                    curs,
-                    replace_none=replace_none,
-                )
-            else:
-                print_cursor(
-                    curs,
-                    fmt=fmt,
-                    header=header,
-                    replace_none=replace_none,
-                    file=file)
-        curs.close()
+        try:
+            if curs.description is not None:
+                write_cursor(curs,
+                             fmt=fmt,
+                             header=header,
+                             replace_none=replace_none,
+                             file=file,
+                             split_by=split_by,
+                             max_open=max_open,
+                             index_by=index_by)
+        finally:
+            curs.close()
 
     def describe(self, table, fmt='pretty', comments=False, show=False):
         """
@@ -231,7 +639,7 @@ class Connection(cx_Oracle.Connection):
                 FROM
                     table(fgetmetadata)
                 WHERE
-                    table_name  = '{table}'
+                    table_name  = :table
                 ORDER BY
                     column_id
             """
@@ -248,19 +656,13 @@ class Connection(cx_Oracle.Connection):
                 FROM
                     table(fgetmetadata)
                 WHERE
-                    table_name  = '{table}'
+                    table_name  = :table
                 ORDER BY
                     column_id
             """
-        q=q.format(table=table.upper())
-
-        if show:
-            stderr.write(q)
-
-        curs = self.cursor()
-        curs.arraysize = _PREFETCH
+        params={'table':table.upper()}
 
-        curs.execute(q) 
+        curs=self._execute(q, params=params, show=show)
         print_cursor(curs,fmt=fmt)
 
         # now indexes
@@ -270,11 +672,11 @@ class Connection(cx_Oracle.Connection):
             FROM
                 dba_ind_columns
             WHERE
-                table_name = '%s' order by index_name, column_position
-        """ % table.upper()
+                table_name = :table order by index_name, column_position
+        """
 
         print
-        curs.execute(q)
+        curs.execute(q, params)
         print_cursor(curs, fmt=fmt)
 
         curs.close()
@@ -290,16 +692,92 @@ class Connection(cx_Oracle.Connection):
                 all_tables
         """
 
+        curs=self._execute(q, show=show)
+        print_cursor(curs,fmt=fmt)
+
+        curs.close()
+
+    def _execute(self, query, params=None, prefetch=_PREFETCH, show=False,
+                 numpy_types=False):
+        """
+        Get a new cursor and execute the query, binding the params
+        if sent.
+
+        If numpy_types is True, numbers are fetched as native machine
+        types, see numpy_outputtypehandler
+
+        If prefetch is 'auto' an AdaptivePrefetchCursor is returned
+        """
+        curs=self.cursor()
+
+        if numpy_types:
+            curs.outputtypehandler = numpy_outputtypehandler
+
+        adaptive = (prefetch == 'auto')
+        if adaptive:
+            # parse first so the number of rows can be chosen from the
+            # description before the fetch buffers are set up
+            curs.parse(query)
+            if curs.description is not None:
+                prefetch=get_prefetch(curs.description,
+                                      prefetch_bytes=self.prefetch_bytes)
+            else:
+                prefetch=_PREFETCH
+
+        # pre-fetch
+        curs.arraysize = prefetch
+
         if show:
-            stderr.write(q)
+            stderr.write(query);stderr.write('\n')
+            if params is not None:
+                stderr.write('params: %s\n' % (params,))
+
+        prof=profiling.get_profile()
+        funcs=hooks.get_hooks('on_execute')
+        if not prof.enabled and not funcs:
+            if params is None:
+                curs.execute(query)
+            else:
+                curs.execute(query, params)
+        else:
+            self._timed_execute(curs, query, params, prof, funcs)
 
-        curs = self.cursor()
-        curs.arraysize = _PREFETCH
+        if adaptive and curs.description is not None:
+            curs=AdaptivePrefetchCursor(curs)
 
-        curs.execute(q) 
-        print_cursor(curs,fmt=fmt)
+        return curs
 
-        curs.close()
+    def _timed_execute(self, curs, query, params, prof, funcs):
+        """
+        execute, sending the time to the profile and the on_execute hooks.
+        The hooks are called outside of the error handling, so an error
+        from the execute is always the one raised
+        """
+        tm0=time.time()
+        try:
+            if params is None:
+                curs.execute(query)
+            else:
+                curs.execute(query, params)
+        except Exception as err:
+            self._execute_done(query, params, prof, funcs, tm0, error=err)
+            raise
+
+        self._execute_done(query, params, prof, funcs, tm0)
+
+    def _execute_done(self, query, params, prof, funcs, tm0, error=None):
+        """
+        add the execute time to the profile and call the on_execute hooks,
+        which never raise
+        """
+        seconds=time.time()-tm0
+        prof.add_time('execute', seconds)
+        hooks.call(funcs,
+                   query=query,
+                   params=params,
+                   dbname=self._dbname,
+                   seconds=seconds,
+                   error=error)
 
     def _process_pars(self, **keys):
         self._port=keys.get('port',_defport)
@@ -308,6 +786,27 @@ class Connection(cx_Oracle.Connection):
         self._dbname=keys.get('dbname',_defdb)
         if self._dbname is None: self._dbname=_defdb
 
+        self._threaded=keys.get('threaded',True)
+        if self._threaded is None: self._threaded=True
+
+        self._stmtcachesize=keys.get('stmtcachesize',_STMTCACHESIZE)
+        if self._stmtcachesize is None: self._stmtcachesize=_STMTCACHESIZE
+
+        self.prefetch_bytes=keys.get('prefetch_bytes',_PREFETCH_BYTES)
+        if self.prefetch_bytes is None: self.prefetch_bytes=_PREFETCH_BYTES
+
+
+    def _get_conn_keys(self):
+        """
+        keywords for making more sessions like this one, e.g. in a
+        desdb.pool
+        """
+        p=self._pwd_getter
+        return {'user':p.user,
+                'password':p.password,
+                'host':p.host,
+                'port':self._port,
+                'dbname':self._dbname}
 
     def __repr__(self):
         rep=["DESDB Connection"]
@@ -329,19 +828,149 @@ def cursor2dictlist(curs, lower=True):
             key=key.lower()
         keys.append(key)
         
+    prof=profiling.get_profile()
+
     output=[]
-    try:
-        for row in curs:
-            tmp={}
-            for i,val in enumerate(row):
-                tmp[keys[i]] = val    
-            output.append(tmp)
-    except KeyboardInterrupt:
-        curs.close()
-        raise RuntimeError("Interrupt encountered")
+    for rows in cursor_chunks(curs):
+        with prof.timer('convert'):
+            output += [dict(zip(keys,row)) for row in rows]
+
+    return output
+
+def cursor2records(curs, lower=True):
+    """
+    Get the rows from the cursor as a list of Record objects, tuples with
+    attribute access to the columns that also support r['band'].  See
+    desdb.records
+    """
+    from . import records
+
+    if curs is None:
+        return None
+
+    names=get_names(curs.description, lower=lower)
+
+    prof=profiling.get_profile()
+
+    output=[]
+    for rows in cursor_chunks(curs):
+        with prof.timer('convert'):
+            output += records.rows2records(rows, names)
 
     return output
 
+def cursor2columns(curs, lower=True):
+    """
+    Get the rows from the cursor as a dict with a list of values
+    for each column
+    """
+    if curs is None:
+        return None
+
+    names=get_names(curs.description, lower=lower)
+
+    prof=profiling.get_profile()
+
+    columns=[[] for n in names]
+    for rows in cursor_chunks(curs):
+        with prof.timer('convert'):
+            for col,vals in zip(columns, zip(*rows)):
+                col.extend(vals)
+
+    return dict(zip(names,columns))
+
+def get_names(desc, lower=True):
+    """
+    Get the column names from the cursor description
+    """
+    names=[]
+    for d in desc:
+        name=d[0]
+        if lower:
+            name=name.lower()
+        names.append(name)
+    return names
+
+def write_cursor(curs, fmt='csv', header='names', replace_none=None, file=None,
+                 split_by=None, max_open=None, index_by=None):
+    """
+    Write the rows from the cursor in the requested format, as done
+    in Connection.quickWrite
+
+    parameters
+    ----------
+    curs: cursor
+        An executed cursor, or any object with a description and
+        a fetchmany method
+    fmt: string, optional
+        The format for writing.  Default 'csv'
+    header: string, optional
+        If not False, write a header
+    replace_none: optional
+        Replace None with this value
+    file: string, optional
+        Write to this file rather than standard output.  Required
+        for fits
+    split_by: string or sequence, optional
+        Write the rows to a separate file for each value of these
+        columns, see desdb.split.write_split.  file is then the
+        template for the file names
+    max_open: int, optional
+        Maximum number of files open at once when using split_by
+    index_by: string or sequence, optional
+        For fits, add a sorted index on these columns, see cursor2fits
+    """
+    if index_by is not None:
+        if fmt != 'fits':
+            raise ValueError("index_by is only supported for fits output")
+        if split_by is not None:
+            raise ValueError("index_by is not supported with split_by")
+
+    if split_by is not None:
+        from . import split
+
+        if file is None:
+            raise RuntimeError("you must send file= with split_by")
+
+        if max_open is None:
+            max_open=split._MAX_OPEN
+
+        split.write_split(
+            curs,
+            file,
+            split_by,
+            fmt=fmt,
+            header=header,
+            replace_none=replace_none,
+            max_open=max_open,
+        )
+    elif fmt=='fits':
+        if file is None:
+            raise RuntimeError("you must send file= for fits writing")
+
+        cursor2fits(
+            file,
+            curs,
+            replace_none=replace_none,
+            index_by=index_by,
+        )
+    elif fmt=='npydir':
+        if file is None:
+            raise RuntimeError("you must send file= for npydir writing")
+
+        cursor2columnar(
+            file,
+            curs,
+            replace_none=replace_none,
+        )
+    else:
+        print_cursor(
+            curs,
+            fmt=fmt,
+            header=header,
+            replace_none=replace_none,
+            file=file)
+
 def print_cursor(curs, fmt='csv', header='names', replace_none=None, file=None):
     rw=CursorWriter(
         fmt=fmt,
@@ -374,6 +1003,14 @@ class CursorWriter(object):
 
         self.file=file
 
+    def _open(self):
+        """
+        open the output file, compressed if the name ends in .gz, or get
+        standard output if no file was sent
+        """
+        from . import gzipio
+        return gzipio.open_output(self.file)
+
     def write(self, curs):
         """
         Write rows from the cursor.
@@ -383,6 +1020,8 @@ class CursorWriter(object):
             self.write_csv(curs)
         elif self.fmt == 'pretty':
             self.write_pretty(curs)
+        elif self.fmt == 'ndjson':
+            self.write_ndjson(curs)
         else:
             data = cursor2dictlist(curs)
             w=ObjWriter(file=self.file, 
@@ -394,8 +1033,6 @@ class CursorWriter(object):
         """
         Simple csv with, by default, a header
         """
-        import time
-
         desc = curs.description
         if desc is None:
             return
@@ -404,28 +1041,9 @@ class CursorWriter(object):
         if 0 == ncol:
             return
         
-        if self.file is not None:
-            fobj = open(self.file,'w')
-        else:
-            fobj=sys.stdout
-
-        if self.fmt=='csv':
-            writer = csv.writer(fobj,dialect='excel',
-                                quoting=csv.QUOTE_MINIMAL,
-                                lineterminator = '\n')
-        else:
-            if self.fmt=='space':
-                delim=' '
-            elif self.fmt=='tab':
-                delim='\t'
-            else:
-                raise ValueError("bad format type: '%s'" % self.fmt)
-
-            writer = csv.writer(fobj,dialect='excel',
-                                delimiter=delim,
-                                quoting=csv.QUOTE_MINIMAL,
-                                lineterminator = '\n')
+        fobj=self._open()
 
+        writer,delim=self.get_csv_writer(fobj)
 
         if self.header_type == 'names': 
             hdr = [d[0].lower() for d in desc]
@@ -434,85 +1052,186 @@ class CursorWriter(object):
             pass
 
         nresults = 0
-        try:
-            for row in curs:
-                if self.replace_none:
-                    row = replace_none_row(row, self.replace_none)
-
-                writer.writerow(row)
-                nresults += 1
-        except KeyboardInterrupt:
-            curs.close()
-            raise RuntimeError("Interrupt encountered")
+        for rows in cursor_chunks(curs):
+            self.write_csv_rows(fobj, writer, delim, rows)
+            nresults += len(rows)
         
         if self.file is not None:
             fobj.close()
 
         return nresults
 
+    def get_csv_writer(self, fobj):
+        """
+        Get a csv.writer for the format, and the delimiter
+        """
+        if self.fmt=='csv':
+            delim=','
+        elif self.fmt=='space':
+            delim=' '
+        elif self.fmt=='tab':
+            delim='\t'
+        else:
+            raise ValueError("bad format type: '%s'" % self.fmt)
+
+        writer = csv.writer(fobj,dialect='excel',
+                            delimiter=delim,
+                            quoting=csv.QUOTE_MINIMAL,
+                            lineterminator = '\n')
+        return writer, delim
+
+    def write_csv_rows(self, fobj, writer, delim, rows):
+        """
+        Write a chunk of rows with the writer from get_csv_writer
+        """
+        if self.replace_none:
+            nullstr=format_csv_value(self.replace_none)
+        else:
+            nullstr=''
+
+        prof=profiling.get_profile()
+
+        # each chunk is formatted as a block and written at once, unless
+        # some value needs quoting
+        with prof.timer('convert'):
+            text=format_csv_chunk(rows, delim=delim, nullstr=nullstr)
+
+        if text is not None:
+            write_chunk(fobj.write, text,
+                        fmt=self.fmt,
+                        file=get_fobj_name(fobj),
+                        nrows=len(rows),
+                        nbytes=len(text))
+        else:
+            if self.replace_none:
+                rows=[replace_none_row(row, self.replace_none)
+                      for row in rows]
+            # formatted and written together; the bytes are not known
+            write_chunk(writer.writerows, rows,
+                        fmt=self.fmt,
+                        file=get_fobj_name(fobj),
+                        nrows=len(rows))
+
+    def write_ndjson(self, curs):
+        """
+        Write newline-delimited json, one object per row, as the rows are
+        fetched.  Each chunk of rows is encoded and written at once.
+        Values json cannot represent, such as dates, are written as
+        strings
+        """
+        desc = curs.description
+        if desc is None:
+            return
+
+        formatter=self.get_ndjson_formatter(desc)
+
+        fobj=self._open()
+
+        nresults=0
+        for rows in cursor_chunks(curs):
+            self.write_ndjson_rows(fobj, formatter, rows)
+            fobj.flush()
+            nresults += len(rows)
+
+        if self.file is not None:
+            fobj.close()
+
+        return nresults
+
+    def write_ndjson_rows(self, fobj, formatter, rows):
+        """
+        Write a chunk of rows with the formatter from get_ndjson_formatter
+        """
+        prof=profiling.get_profile()
+
+        with prof.timer('convert'):
+            text=formatter(rows)
+        write_chunk(fobj.write, text,
+                    fmt='ndjson',
+                    file=get_fobj_name(fobj),
+                    nrows=len(rows),
+                    nbytes=len(text))
+
+    def get_ndjson_formatter(self, desc):
+        """
+        Get a function converting a chunk of rows to ndjson text
+        """
+        if not have_json:
+            raise ValueError("don't have the json library")
+
+        encode=json.JSONEncoder(separators=(',',':'), default=str).encode
+
+        # the keys are encoded once, keeping the column order
+        keys=[encode(d[0].lower())+':' for d in desc]
+
+        def formatter(rows):
+            lines=[
+                '{' + ','.join(map(operator.add, keys, map(encode, row))) + '}\n'
+                for row in rows
+            ]
+            return ''.join(lines)
+
+        return formatter
+
     def write_pretty(self, curs, **keys):
+        """
+        Write the rows as an aligned table for viewing.
+
+        Output starts after the first chunk of rows is fetched, and at most
+        two chunks are held at once.  If the whole result fits in the first
+        chunk the column widths are exact.  Otherwise they come from the
+        first chunk and the sizes of the string columns in the description;
+        later cells that do not fit are handled according to overflow
+
+        parameters
+        ----------
+        overflow: string, optional
+            'expand' to write the full cell, shifting the rest of that line,
+            or 'truncate' to cut the cell to the column width, marking it
+            with a ~.  Default 'expand'
+        maxwidth: int, optional
+            Largest width taken from the description for string columns,
+            default 30
+        """
         try:
             self._write_pretty(curs, **keys)
         except KeyboardInterrupt:
             curs.close()
             raise RuntimeError("Interrupt encountered")
 
-    def _write_pretty(self, curs, **keys):
-
-        if self.file is not None:
-            fobj = open(self.file,'w')
-        else:
-            fobj=sys.stdout
-
+    def _write_pretty(self, curs, overflow='expand', maxwidth=_PRETTY_MAXWIDTH):
 
-        max_lens=[]
-        names=[]
-        for d in curs.description:
-            name=d[0]
-            names.append(name)
-            max_lens.append( len(name) )
-        nfields = len(names)
+        if overflow not in ('expand','truncate'):
+            raise ValueError("overflow should be 'expand' or 'truncate', "
+                             "got '%s'" % overflow)
 
-        strings=[]
-        for row in curs:
-            cols=[]
-            for i,colval in enumerate(row):
-                name=names[i]
-                colstr=str(colval)
-                l=len(colstr)
-
-                if l > max_lens[i]:
-                    max_lens[i]=l
-
-                cols.append(colstr)
-            strings.append(cols)
-                
-        # now create the formats for writing each field
-        # and the separator
-        separator = []
-        forms = []
-        for i,length in enumerate(max_lens):
-            fmt='%-'+str(length)+'s'
+        fobj=self._open()
 
-            #pad = 2
-            #if i == (nfields-1):
-            #    pad=1
+        desc=curs.description
+        names=[d[0] for d in desc]
 
-            #sep = '%s' % '-'*(length+pad)
-            sep = '%s' % '-'*length
+        # look ahead one chunk to see if the result is complete
+        first=[_pretty_strings(row) for row in curs.fetchmany()]
+        if len(first) > 0:
+            second=curs.fetchmany()
+        else:
+            second=[]
 
-            forms.append(fmt)
-            separator.append(sep)
+        if len(second)==0:
+            widths=get_pretty_widths(names, first)
+        else:
+            widths=get_pretty_widths(names, first, desc=desc,
+                                     maxwidth=maxwidth)
 
+        # now create the formats for writing each field
+        # and the separator
+        forms=['%-'+str(length)+'s' for length in widths]
         row_fmt=' | '.join(forms)
-        separator='-+-'.join(separator)
+        separator='-+-'.join(['-'*length for length in widths])
 
         header = []
-        for i in xrange(nfields): 
-            name=names[i]
-            cname = center_text(name,max_lens[i])
-            header.append(cname)
-
+        for name,length in zip(names,widths):
+            header.append( center_text(name,length) )
         header=' | '.join(header)
 
         fobj.write(header)
@@ -520,27 +1239,151 @@ class CursorWriter(object):
         fobj.write(separator)
         fobj.write('\n')
 
-        for i,row in enumerate(strings):
-            if (((i+1) % 50) == 0):
-                fobj.write(separator)
-                fobj.write('\n')
-                fobj.write(header)
-                fobj.write('\n')
-                fobj.write(separator)
-                fobj.write('\n')
-            
-            fobj.write(row_fmt % tuple(row))
-            fobj.write('\n')
+        # repeat the header every 50 rows
+        repeat='\n'.join([separator,header,separator])
+
+        nrows=0
+        chunks=itertools.chain([first,second], cursor_chunks(curs))
+        for ichunk,rows in enumerate(chunks):
+            lines=[]
+            for row in rows:
+                if ichunk > 0:
+                    row=_pretty_strings(row)
+                    if overflow=='truncate':
+                        row=_truncate_strings(row, widths)
+
+                if (((nrows+1) % 50) == 0):
+                    lines.append(repeat)
 
-        fobj.flush()
+                lines.append(row_fmt % tuple(row))
+                nrows += 1
 
+            if len(lines) > 0:
+                fobj.write('\n'.join(lines))
+                fobj.write('\n')
+                fobj.flush()
 
         if self.file is not None:
             fobj.close()
 
-class ObjWriter(object):
-    def __init__(self, file=None, fmt='csv', header='names'):
-        self.fmt=fmt
+def get_pretty_widths(names, rows, desc=None, maxwidth=_PRETTY_MAXWIDTH):
+    """
+    Get the column widths for pretty output from the names and the
+    formatted rows.  If the description is sent, string columns are also
+    made wide enough for their declared size, up to maxwidth
+    """
+    widths=[len(name) for name in names]
+
+    for row in rows:
+        for i,colstr in enumerate(row):
+            l=len(colstr)
+            if l > widths[i]:
+                widths[i]=l
+
+    if desc is not None:
+        for i,d in enumerate(desc):
+            if d[1] in _pretty_string_types and d[2]:
+                widths[i]=max(widths[i], min(d[2],maxwidth))
+
+    return widths
+
+def _pretty_strings(row):
+    return [str(colval) for colval in row]
+
+def _truncate_strings(row, widths):
+    for i,colstr in enumerate(row):
+        if len(colstr) > widths[i]:
+            row[i] = colstr[:widths[i]-1] + '~'
+    return row
+
+def format_csv_chunk(rows, delim=',', nullstr=''):
+    """
+    Format a chunk of rows as delimited text, the same as csv.writer with
+    the excel dialect and minimal quoting.
+
+    The values are converted column by column and the lines joined into a
+    single string, which is much faster than writing row by row.
+
+    parameters
+    ----------
+    rows: list
+        List of row tuples, e.g. from curs.fetchmany()
+    delim: string, optional
+        The delimiter, default ','
+    nullstr: string, optional
+        Written for NULL values, default ''
+
+    returns
+    -------
+    The text, or None if a value would need quoting, in which case
+    the rows should be written with a csv.writer
+    """
+    if len(rows)==0:
+        return ''
+
+    specials=(delim, '"', '\n', '\r')
+
+    columns=list(zip(*rows))
+    ncol=len(columns)
+
+    strcols=[]
+    for col in columns:
+        types=set(map(type, col))
+        hasnull = (_NoneType in types)
+        if hasnull:
+            types.discard(_NoneType)
+
+        if types.issubset(_csv_int_types):
+            conv,check=str,False
+        elif types==_csv_float_types:
+            conv,check=repr,False
+        elif float in types:
+            # e.g. NUMBER columns holding both ints and floats
+            conv=format_csv_value
+            check=not types.issubset(_csv_number_types)
+        elif types==_csv_str_types:
+            conv,check=None,True
+        elif types.isdisjoint(_csv_nostr_types):
+            conv,check=str,True
+        else:
+            return None
+
+        if hasnull:
+            if conv is None:
+                strs=[nullstr if v is None else v for v in col]
+            else:
+                strs=[nullstr if v is None else conv(v) for v in col]
+        elif conv is None:
+            strs=col
+        else:
+            strs=list(map(conv, col))
+
+        if check:
+            joined='\x00'.join(strs)
+            for c in specials:
+                if c in joined:
+                    return None
+
+        if ncol==1 and '' in strs:
+            # a lone empty field is quoted
+            return None
+
+        strcols.append(strs)
+
+    return '\n'.join(map(delim.join, zip(*strcols))) + '\n'
+
+def format_csv_value(val):
+    """
+    Format a single value as done by csv.writer
+    """
+    if isinstance(val, float):
+        return repr(val)
+    else:
+        return str(val)
+
+class ObjWriter(object):
+    def __init__(self, file=None, fmt='csv', header='names'):
+        self.fmt=fmt
         self.header_type=header
         self.file=file
 
@@ -682,7 +1525,7 @@ def get_numpy_descr(meta):
 def center_text(text, width, spacer=' '):
     text = text.strip()
     space = width - len(text)
-    return spacer*(space/2) + text + spacer*(space/2 + space%2)
+    return spacer*(space//2) + text + spacer*(space//2 + space%2)
 
 
 class PasswordGetter:
@@ -813,6 +1656,10 @@ class PasswordGetter:
 
 def cursor2array(curs,
                  dtype=None,
+                 replace_none=None,
+                 null_mask=False,
+                 max_memory=None,
+                 spill_dir=None,
                  f4_digits=_defs['f4_digits'],
                  f8_digits=_defs['f8_digits'],
                  lower=_defs['lower']):
@@ -830,30 +1677,878 @@ def cursor2array(curs,
     dtype: numpy dtype or descr, optional
         A dtype for conversion.  If not sent it will be derived
         from the cursor.
+    replace_none: optional
+        Replace NULL values with this value.  By default a value is chosen
+        for each type, see get_null_sentinel
+    null_mask: bool, optional
+        If True, also return an array of bools with a field for each column
+        that can hold NULL, according to the null_ok entry of the cursor
+        description.  Values are True where the column was NULL.
+    max_memory: int, optional
+        Memory budget in bytes for the result.  Once the array would grow
+        past the budget, the rows are instead written to a temporary .npy
+        file and a numpy memmap of the file is returned.  The file is
+        removed once mapped, so the space is freed when the memmap is
+        deleted.  Only used for cursors
+    spill_dir: string, optional
+        Directory for the temporary file.  Default is get_spill_dir()
     f4_digits, f8_digits:  int
         The number of digits to demand when converting to these types from
         number(digits,n).  The default is 6 or less for floats and 7-15 for
         double, e.g. f4_digits=6, f8_digits=15  For example if you want
         everything to be double use f4_digits=0
 
+    For a cursor, the rows are fetched in chunks of arraysize and copied
+    into a single pre-allocated array that grows as needed.  This is faster
+    if the cursor was set up with numpy_outputtypehandler before it was
+    executed, as is done in Connection.quick(array=True)
+
     EXAMPLES
         curs=conn.cursor()
+        curs.outputtypehandler=numpy_outputtypehandler
         curs.execute(query)
-        arr = Cursor2Array(curs)
+        arr = cursor2array(curs)
+
+        # also get the mask for NULL values
+        arr, mask = cursor2array(curs, null_mask=True)
     """
     import numpy
+
+    desc=getattr(curs,'description',None)
+    if dtype is None:
+        dtype=get_numpy_descr(desc,
+                              f4_digits=f4_digits,
+                              f8_digits=f8_digits,
+                              lower=lower)
+    dtype=numpy.dtype(dtype)
+
+    if desc is not None:
+        nullable=get_nullable(desc)
+    else:
+        nullable=None
+
+    if not hasattr(curs, 'fetchmany'):
+        # a list of rows or some other iterator
+        return rows2array(list(curs), dtype,
+                          nullable=nullable,
+                          replace_none=replace_none,
+                          null_mask=null_mask)
+
+    arr=numpy.zeros(0, dtype=dtype)
+    if null_mask:
+        mask=numpy.zeros(0, dtype=get_null_mask_dtype(dtype, nullable))
+    else:
+        mask=None
+
+    if max_memory is not None:
+        row_bytes=dtype.itemsize
+        if mask is not None:
+            row_bytes += mask.dtype.itemsize
+        max_rows=max_memory//max(row_bytes,1)
+
+    prof=profiling.get_profile()
+
+    nrows=0
+    spill=None
+    try:
+        for rows in cursor_chunks(curs):
+            nnew=len(rows)
+
+            if spill is None and nrows+nnew > arr.size:
+                newsize=max(2*arr.size, nrows+nnew)
+                if max_memory is not None and newsize > max_rows:
+                    if nrows+nnew <= max_rows:
+                        newsize=max_rows
+                    else:
+                        # over budget; the rest goes to disk
+                        if mask is not None:
+                            mask=mask[:nrows]
+                        spill=_SpillFile(arr[:nrows], mask, spill_dir)
+                        arr,mask=None,None
+
+                if spill is None:
+                    arr.resize(newsize, refcheck=False)
+                    if mask is not None:
+                        mask.resize(newsize, refcheck=False)
+
+            if spill is not None:
+                with prof.timer('convert'):
+                    res=rows2array(rows, dtype,
+                                   nullable=nullable,
+                                   replace_none=replace_none,
+                                   null_mask=null_mask)
+                with prof.timer('write'):
+                    spill.write(res)
+                nrows += nnew
+                continue
+
+            with prof.timer('convert'):
+                _fill_chunk(rows, arr, mask, nrows,
+                            nullable=nullable,
+                            replace_none=replace_none)
+            nrows += nnew
+    except:
+        if spill is not None:
+            spill.abort()
+        raise
+
+    if spill is not None:
+        arr,mask=spill.finish()
+    elif nrows < arr.size:
+        arr.resize(nrows, refcheck=False)
+        if mask is not None:
+            mask.resize(nrows, refcheck=False)
+
+    if null_mask:
+        return arr, mask
+    else:
+        return arr
+
+def _fill_chunk(rows, arr, mask, nrows, nullable=None, replace_none=None):
+    """
+    copy the rows into arr, and the mask if sent, starting at nrows
+    """
+    nnew=len(rows)
+    if mask is not None:
+        submask=mask[nrows:nrows+nnew]
+    else:
+        submask=None
+
+    _fill_rows(rows, arr[nrows:nrows+nnew],
+               nullable=nullable,
+               replace_none=replace_none,
+               mask=submask)
+
+class _SpillFile(object):
+    """
+    Holds the rows of a result that went over its memory budget in a
+    temporary .npy file, and the mask if sent
+    """
+    def __init__(self, arr, mask=None, dir=None):
+        from . import npyio
+
+        if dir is None:
+            dir=get_spill_dir()
+
+        fd,fname=tempfile.mkstemp(prefix='desdb-spill-', suffix='.npy',
+                                  dir=dir)
+        os.close(fd)
+
+        self._writers=[npyio.NpyWriter(fname, arr.dtype)]
+        if mask is not None:
+            mask_fname=npyio.get_mask_fname(fname)
+            self._writers.append( npyio.NpyWriter(mask_fname, mask.dtype) )
+
+        self.write( (arr, mask) )
+
+    def write(self, res):
+        """
+        append an array, or (array, mask)
+        """
+        if not isinstance(res, tuple):
+            res=(res,)
+        for writer,data in zip(self._writers, res):
+            writer.write(data)
+
+    def finish(self):
+        """
+        close the files and get memory maps of them.  The files are removed
+        and the space freed when the maps are deleted
+        """
+        import numpy
+
+        maps=[]
+        for writer in self._writers:
+            writer.close()
+            maps.append( numpy.load(writer.fname, mmap_mode='r+') )
+            os.remove(writer.fname)
+
+        if len(maps)==1:
+            maps.append(None)
+        return maps
+
+    def abort(self):
+        for writer in self._writers:
+            writer.close()
+            if os.path.exists(writer.fname):
+                os.remove(writer.fname)
+
+def get_spill_dir():
+    """
+    Directory for results that go over their memory budget, see
+    cursor2array.  This is $DES_SCRATCH if set, otherwise the temporary
+    directory
+    """
+    from . import files
+    try:
+        return files.get_scratch_dir()
+    except ValueError:
+        return tempfile.gettempdir()
+
+def rows2array(rows, dtype, nullable=None, replace_none=None, null_mask=False):
+    """
+    Convert a list of row tuples to a numpy array with fields.
+
+    NULL values are replaced column by column.  Columns known not to hold
+    NULL are copied directly.
+
+    parameters
+    ----------
+    rows: list
+        List of row tuples, e.g. from curs.fetchmany()
+    dtype: numpy dtype or descr
+        The dtype of the output
+    nullable: sequence of bool, optional
+        Which columns can hold NULL, see get_nullable().  If not sent,
+        all columns are checked
+    replace_none: optional
+        Replace NULL values with this value.  By default a value is chosen
+        for each type, see get_null_sentinel
+    null_mask: bool, optional
+        If True, also return an array of bools with a field for each
+        nullable column, True where the column was NULL.
+    """
+    import numpy
+
+    dtype=numpy.dtype(dtype)
+    arr=numpy.zeros(len(rows), dtype=dtype)
+
+    if null_mask:
+        mask=numpy.zeros(len(rows), dtype=get_null_mask_dtype(dtype, nullable))
+    else:
+        mask=None
+
+    _fill_rows(rows, arr, nullable=nullable, replace_none=replace_none, mask=mask)
+
+    if null_mask:
+        return arr, mask
+    else:
+        return arr
+
+def _fill_rows(rows, out, nullable=None, replace_none=None, mask=None):
+    """
+    copy the rows into the output array, replacing NULL values
+    """
+    import numpy
+
+    if nullable is not None and not any(nullable):
+        out[:] = rows
+        return
+
+    names=out.dtype.names
+    # transpose to columns
+    for i,col in enumerate(zip(*rows)):
+        name=names[i]
+        if (nullable is None or nullable[i]) and None in col:
+            vals=numpy.array(col, dtype=object)
+            isnull=numpy.equal(vals, None)
+            vals[isnull]=get_null_sentinel(out.dtype[name], replace_none)
+            out[name]=vals
+        else:
+            isnull=False
+            out[name]=col
+
+        if mask is not None and name in mask.dtype.names:
+            mask[name]=isnull
+
+def get_nullable(desc):
+    """
+    Get a list of bools, True for the columns that can hold NULL according
+    to the null_ok entry of the cursor description
+    """
+    return [bool(d[6]) for d in desc]
+
+def get_null_mask_dtype(dtype, nullable=None):
+    """
+    dtype for the NULL masks, with a bool field for each nullable column
+    """
+    import numpy
+
+    names=numpy.dtype(dtype).names
+    if nullable is None:
+        nullable=[True]*len(names)
+
+    return [(name,'?') for name,isnull in zip(names,nullable) if isnull]
+
+def get_null_sentinel(dtype, replace_none=None):
+    """
+    Get the value that replaces NULL for the input numpy type.
+
+    If replace_none is sent it is used, converted to a string for
+    string types.  Otherwise NaN for floating point, -9999 for signed
+    integers, 0 for unsigned integers and an empty string for strings.
+    """
+    import numpy
+
+    kind=numpy.dtype(dtype).kind
+    if replace_none is not None:
+        if kind in ('S','U'):
+            return str(replace_none)
+        return replace_none
+
+    if kind in ('S','U'):
+        return ''
+    return _null_sentinels.get(kind, 0)
+
+def numpy_outputtypehandler(cursor, name, default_type, size, precision, scale):
+    """
+    An output type handler for cx_Oracle cursors.
+
+    NUMBER columns that will end up as integers or floating point in a numpy
+    array are fetched by the driver as native 8-byte integers or doubles,
+    rather than being converted from the oracle number format to python
+    ints, floats or Decimals.  The choice follows get_numpy_type, and numbers
+    that would not fit are left alone.
+
+    Set it on the cursor before executing the query
+        curs.outputtypehandler = numpy_outputtypehandler
+    """
+    if default_type != cx_Oracle.NUMBER:
+        return None
+
+    if scale == 0:
+        if _NATIVE_INT is None or precision > 18:
+            return None
+        vtype=_NATIVE_INT
+    else:
+        if precision > _defs['f8_digits']:
+            return None
+        vtype=cx_Oracle.NATIVE_FLOAT
+
+    return cursor.var(vtype, arraysize=cursor.arraysize)
+
+def cursor_chunks(curs, nrows=None):
+    """
+    Yield lists of rows from the cursor as they are fetched.
+
+    parameters
+    ----------
+    curs: cursor
+        An executed cursor, or any object with a fetchmany method
+    nrows: int, optional
+        Number of rows to fetch each time.  Default is the arraysize
+        of the cursor (the prefetch)
+    """
+    prof=profiling.get_profile()
+
+    # cursors fetching in their own threads send the on_fetch_chunk hooks
+    # with the time taken by the server, rather than the time waited here
+    if curs_sends_fetch_hooks(curs):
+        funcs=()
+    else:
+        funcs=hooks.get_hooks('on_fetch_chunk')
+    timed=prof.enabled or len(funcs) > 0
+
+    try:
+        while True:
+            if timed:
+                tm0=time.time()
+
+            if nrows is None:
+                rows = curs.fetchmany()
+            else:
+                rows = curs.fetchmany(nrows)
+
+            if timed:
+                seconds=time.time()-tm0
+                prof.add_time('fetch', seconds)
+
+            if len(rows)==0:
+                break
+
+            if timed:
+                prof.add_rows(len(rows))
+                hooks.call(funcs, nrows=len(rows), seconds=seconds)
+
+            yield rows
+    except KeyboardInterrupt:
+        curs.close()
+        raise RuntimeError("Interrupt encountered")
+
+def curs_sends_fetch_hooks(curs):
+    """
+    True for cursor wrappers that fetch in their own threads and send the
+    on_fetch_chunk hooks themselves
+    """
+    return isinstance(curs, CursorWrapper) and curs._sends_fetch_hooks
+
+def timed_fetchmany(curs, funcs):
+    """
+    Fetch a chunk of rows, sending the time taken to the on_fetch_chunk
+    hooks from hooks.get_hooks.  Used by the threads of cursor wrappers
+    that fetch in the background
+    """
+    if not funcs:
+        return curs.fetchmany()
+
+    tm0=time.time()
+    rows=curs.fetchmany()
+    if len(rows) > 0:
+        hooks.call(funcs, nrows=len(rows), seconds=time.time()-tm0)
+    return rows
+
+def write_chunk(write, data, fmt=None, file=None, nrows=0, nbytes=None):
+    """
+    Call write(data), adding the time and size to the active profile and
+    sending them to the on_write_chunk hooks.  See desdb.profiling and
+    desdb.hooks
+
+    parameters
+    ----------
+    write: function
+        Writes the data, e.g. fobj.write
+    data:
+        The data to write
+    fmt: string, optional
+        The output format
+    file: string, optional
+        The output file, None for standard output
+    nrows: int, optional
+        Number of rows in the data
+    nbytes: int, optional
+        Size of the data in bytes, if known
+    """
+    prof=profiling.get_profile()
+    funcs=hooks.get_hooks('on_write_chunk')
+    if not prof.enabled and not funcs:
+        write(data)
+        return
+
+    tm0=time.time()
+    write(data)
+    seconds=time.time()-tm0
+
+    prof.add_time('write', seconds)
+    if nbytes is not None:
+        prof.add_bytes(nbytes)
+
+    hooks.call(funcs,
+               fmt=fmt,
+               file=file,
+               nrows=nrows,
+               nbytes=nbytes,
+               seconds=seconds)
+
+def get_fobj_name(fobj):
+    """
+    The name of an output file object, None for standard output
+    """
+    if fobj is sys.stdout:
+        return None
+    return getattr(fobj, 'name', None)
+
+def get_row_bytes(desc):
+    """
+    Estimate the memory used for each fetched row from the internal sizes in
+    the cursor description.  Includes a rough overhead for the python
+    objects holding each value.
+    """
+    nbytes=0
+    for d in desc:
+        size=d[3]
+        if not size:
+            size=d[2]
+        if not size:
+            size=22
+
+        nbytes += size + _PYOBJ_BYTES
+
+    return nbytes
+
+def get_prefetch(desc, prefetch_bytes=_PREFETCH_BYTES):
+    """
+    Get the number of rows to fetch in each round trip such that the rows
+    take about prefetch_bytes of memory.
+
+    parameters
+    ----------
+    desc: sequence
+        The cursor description
+    prefetch_bytes: int, optional
+        The memory budget in bytes, default 32MB
+    """
+    nrows = prefetch_bytes//get_row_bytes(desc)
+    nrows = max(_PREFETCH_MIN, min(_PREFETCH_MAX, nrows))
+    return int(nrows)
+
+class CursorWrapper(object):
+    """
+    Base class for objects wrapping a cursor.  Sub-classes implement
+    fetchmany(); iteration and fetchall are built on it and other
+    attributes, such as the description, come from the wrapped cursor.
+    """
+    # set for sub-classes fetching in their own threads, which send the
+    # on_fetch_chunk hooks
+    _sends_fetch_hooks=False
+
+    def __init__(self, curs):
+        self._curs=curs
+
+    def fetchmany(self, nrows=None):
+        if nrows is None:
+            return self._curs.fetchmany()
+        else:
+            return self._curs.fetchmany(nrows)
+
+    def fetchall(self):
+        rows=[]
+        for chunk in cursor_chunks(self):
+            rows += chunk
+        return rows
+
+    def close(self):
+        self._curs.close()
+
+    def __iter__(self):
+        for rows in cursor_chunks(self):
+            for row in rows:
+                yield row
+
+    def __getattr__(self, name):
+        return getattr(self._curs, name)
+
+class AdaptivePrefetchCursor(CursorWrapper):
+    """
+    Wrap a cursor, adjusting the number of rows returned by each fetchmany()
+    from the observed fetch times.
+
+    Fetches faster than 0.1 second double the number of rows, up to the
+    arraysize the cursor was executed with, which sets the memory budget.
+    Fetches slower than 2 seconds halve it, so rows are handed on sooner
+    and fewer are held at once.
+
+    Iteration and the other cursor attributes are passed on to the
+    wrapped cursor.
+
+    parameters
+    ----------
+    curs: cursor
+        An executed cursor
+    max_rows: int, optional
+        The largest number of rows for each fetch.  Default is the
+        arraysize of the cursor
+    """
+    def __init__(self, curs, max_rows=None):
+        super(AdaptivePrefetchCursor,self).__init__(curs)
+
+        if max_rows is None:
+            max_rows=curs.arraysize
+
+        self.max_rows=max_rows
+        self.nrows=max_rows
+
+    def fetchmany(self, nrows=None):
+        """
+        Fetch the next set of rows.  If nrows is not sent, the number
+        is chosen adaptively
+        """
+        if nrows is not None:
+            return self._curs.fetchmany(nrows)
+
+        nrows=self.nrows
+
+        tm0=time.time()
+        rows=self._curs.fetchmany(nrows)
+        tm=time.time()-tm0
+
+        if len(rows) == nrows:
+            if tm < _PREFETCH_FAST:
+                self.nrows = min(2*nrows, self.max_rows)
+            elif tm > _PREFETCH_SLOW:
+                self.nrows = max(nrows//2, _PREFETCH_MIN)
+
+        return rows
+
+class ThreadedCursor(CursorWrapper):
+    """
+    Wrap a cursor, fetching chunks of rows in a background thread.
+
+    The thread keeps calling fetchmany() on the wrapped cursor and puts the
+    chunks on a bounded queue, so the next chunk is transferred while the
+    current one is converted or written.  Errors in the thread are raised
+    from fetchmany() in the reading thread.
+
+    The on_fetch_chunk hooks are called from the thread, with the time
+    taken by each fetch from the server.
+
+    Do not use the wrapped cursor directly once it has been wrapped, and
+    always call close() so the thread is stopped.
+
+    parameters
+    ----------
+    curs: cursor
+        An executed cursor, or any object with a fetchmany method
+    depth: int, optional
+        Maximum number of chunks waiting to be read, default 2
+    """
+    _sends_fetch_hooks=True
+
+    def __init__(self, curs, depth=_FETCH_DEPTH):
+        super(ThreadedCursor,self).__init__(curs)
+
+        self._queue=queue.Queue(maxsize=depth)
+        self._stop=threading.Event()
+        self._done=False
+
+        self._thread=threading.Thread(target=self._produce)
+        self._thread.daemon=True
+        self._thread.start()
+
+    def fetchmany(self, nrows=None):
+        """
+        Get the next chunk of rows fetched by the thread.  The chunks are
+        the size set by the wrapped cursor, so nrows is ignored
+        """
+        if self._done:
+            return []
+
+        # a timeout so the main thread can still be interrupted
+        while True:
+            try:
+                item=self._queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+
+        if isinstance(item, _FetchError):
+            self._done=True
+            raise item.err
+
+        if len(item)==0:
+            self._done=True
+
+        return item
+
+    def close(self):
+        """
+        Stop the thread and close the wrapped cursor
+        """
+        self._stop.set()
+        self._thread.join()
+        self._curs.close()
+
+    def _produce(self):
+        funcs=hooks.get_hooks('on_fetch_chunk')
+        try:
+            while not self._stop.is_set():
+                rows=timed_fetchmany(self._curs, funcs)
+                self._put(rows)
+                if len(rows)==0:
+                    break
+        except BaseException as err:
+            self._put(_FetchError(err))
+
+    def _put(self, item):
+        _put_unless_stopped(self._queue, item, self._stop)
+
+def _put_unless_stopped(q, item, stop):
+    """
+    put the item on the queue, waiting for room unless the stop event is
+    set.  The timeout lets the thread notice the stop
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+class _FetchError(object):
+    """
+    carries an exception from the fetch thread
+    """
+    def __init__(self, err):
+        self.err=err
+
+def cursor2array_chunks(curs,
+                        replace_none=None,
+                        null_mask=False,
+                        dtype=None,
+                        f4_digits=_defs['f4_digits'],
+                        f8_digits=_defs['f8_digits'],
+                        lower=_defs['lower']):
+    """
+    Yield numpy arrays with fields for each chunk of rows fetched
+    from the cursor.  If null_mask is True, (array, mask) pairs
+    are yielded.
+
+    See cursor2array for the meaning of the parameters.
+    """
     if dtype is None:
         dtype=get_numpy_descr(curs.description, 
                               f4_digits=f4_digits,
                               f8_digits=f8_digits,
                               lower=lower)
-    arr = numpy.fromiter(curs, dtype=dtype)
-    return arr
+
+    prof=profiling.get_profile()
+
+    nullable=get_nullable(curs.description)
+    for rows in cursor_chunks(curs):
+        with prof.timer('convert'):
+            res=rows2array(rows, dtype,
+                           nullable=nullable,
+                           replace_none=replace_none,
+                           null_mask=null_mask)
+        yield res
+
+def cursor2npy(fname,
+               curs,
+               replace_none=None,
+               null_mask=False,
+               dtype=None,
+               f4_digits=_defs['f4_digits'],
+               f8_digits=_defs['f8_digits'],
+               lower=_defs['lower']):
+    """
+    Write the rows from the cursor to a .npy file chunk by chunk, so the
+    full result is never held in memory.  The file can be read with
+    numpy.load, for example as a memory map with mmap_mode='r'
+
+    parameters
+    ----------
+    fname: string
+        The file to write
+    curs: cursor
+        An executed cursor
+    null_mask: bool, optional
+        If True, also write the mask for NULL values to a second file,
+        see cursor2array and desdb.npyio.get_mask_fname
+
+    See cursor2array for the other parameters.
+
+    returns
+    -------
+    The number of rows written
+    """
+    from . import npyio
+
+    if dtype is None:
+        dtype=get_numpy_descr(curs.description,
+                              f4_digits=f4_digits,
+                              f8_digits=f8_digits,
+                              lower=lower)
+
+    writer=npyio.NpyWriter(fname, dtype)
+    mask_writer=None
+    try:
+        if null_mask:
+            nullable=get_nullable(curs.description)
+            mask_dtype=get_null_mask_dtype(writer.dtype, nullable)
+            mask_writer=npyio.NpyWriter(npyio.get_mask_fname(fname),
+                                        mask_dtype)
+
+        def write(res):
+            if null_mask:
+                writer.write(res[0])
+                mask_writer.write(res[1])
+            else:
+                writer.write(res)
+
+        for res in cursor2array_chunks(curs,
+                                       replace_none=replace_none,
+                                       null_mask=null_mask,
+                                       dtype=writer.dtype):
+            if null_mask:
+                nrows,nbytes=res[0].size, res[0].nbytes + res[1].nbytes
+            else:
+                nrows,nbytes=res.size, res.nbytes
+
+            write_chunk(write, res,
+                        fmt='npy',
+                        file=fname,
+                        nrows=nrows,
+                        nbytes=nbytes)
+    finally:
+        writer.close()
+        if mask_writer is not None:
+            mask_writer.close()
+
+    return writer.nrows
+
+def cursor2columnar(dirname,
+                    curs,
+                    replace_none=None,
+                    dtype=None,
+                    f4_digits=_defs['f4_digits'],
+                    f8_digits=_defs['f8_digits'],
+                    lower=_defs['lower']):
+    """
+    Write the rows from the cursor to a directory with one .npy file per
+    column and a schema.json file, chunk by chunk.  Read it back with
+    desdb.npyio.read_columnar
+
+    parameters
+    ----------
+    dirname: string
+        The directory to write
+    curs: cursor
+        An executed cursor
+
+    See cursor2array for the other parameters.
+
+    returns
+    -------
+    The number of rows written
+    """
+    from . import npyio
+
+    if dtype is None:
+        dtype=get_numpy_descr(curs.description,
+                              f4_digits=f4_digits,
+                              f8_digits=f8_digits,
+                              lower=lower)
+
+    with npyio.ColumnarWriter(dirname, dtype) as writer:
+        for data in cursor2array_chunks(curs,
+                                        replace_none=replace_none,
+                                        dtype=writer.dtype):
+            write_chunk(writer.write, data,
+                        fmt='npydir',
+                        file=dirname,
+                        nrows=data.size,
+                        nbytes=data.nbytes)
+
+    return writer.nrows
+
+def cursor2shared(curs, shared=True, null_mask=False, **keys):
+    """
+    Write the rows from the cursor to a .npy file, by default in shared
+    memory, and return a desdb.npyio.SharedArray handle.  Workers attach
+    to the data with handle.attach()
+
+    parameters
+    ----------
+    curs: cursor
+        An executed cursor
+    shared: True or string, optional
+        Where to write the file, see desdb.npyio.get_shared_fname
+    null_mask: bool, optional
+        If True, also write the mask for NULL values
+
+    Other keywords are sent to cursor2npy
+    """
+    from . import npyio
+
+    fname=npyio.get_shared_fname(shared)
+    if null_mask:
+        mask_fname=npyio.get_mask_fname(fname)
+    else:
+        mask_fname=None
+
+    handle=npyio.SharedArray(fname, mask_fname=mask_fname)
+    try:
+        cursor2npy(fname, curs, null_mask=null_mask, **keys)
+    except:
+        handle.unlink()
+        raise
+
+    return handle
 
 def cursor2fits(fitsfile,
                 curs,
                 replace_none=None,
                 dtype=None,
+                index_by=None,
                 f4_digits=_defs['f4_digits'],
                 f8_digits=_defs['f8_digits'],
                 lower=_defs['lower']):
@@ -865,6 +2560,14 @@ def cursor2fits(fitsfile,
 
     parameters
     ----------
+    replace_none: optional
+        Replace NULL values with this value.  By default a value is chosen
+        for each type, see get_null_sentinel
+    index_by: string or sequence, optional
+        Add a sorted index for each of these columns as extra extensions,
+        for fast lookups with desdb.fitsindex.FitsIndex.  A comma
+        separated string or a sequence.  The column values are held
+        in memory until the end
     dtype: numpy dtype or descr, optional
         A dtype for conversion.  If not sent it will be derived
         from the cursor.
@@ -888,27 +2591,296 @@ def cursor2fits(fitsfile,
                               f8_digits=f8_digits,
                               lower=lower)
     
-    with fitsio.FITS(fitsfile,'rw',clobber=True) as fits:
+    index_cols=get_index_columns(index_by)
+    index_keys=dict( (col,[]) for col in index_cols )
 
-        first=True
-        while True:
-            # we rely on the user setting a sensible arraysize (prefetch)
-            rows = curs.fetchmany()
-            if len(rows)==0:
-                break
+    prof=profiling.get_profile()
 
-            if replace_none:
-                rows = replace_none_rows(rows, replace_none)
+    with fitsio.FITS(fitsfile,'rw',clobber=True) as fits:
 
-            data = cursor2array(
-                rows,
-                dtype=dtype,
-            )
+        first=True
+        # we rely on the user setting a sensible arraysize (prefetch)
+        chunks=cursor2array_chunks(curs,
+                                   replace_none=replace_none,
+                                   dtype=dtype)
+        for data in chunks:
             if first:
                 first=False
-                fits.write(data)
+                missing=[c for c in index_cols if c not in data.dtype.names]
+                if len(missing) > 0:
+                    raise ValueError("index columns not found in the "
+                                     "results: %s" % ', '.join(missing))
+                write=fits.write
             else:
-                fits[-1].append(data)
+                write=fits[-1].append
+
+            write_chunk(write, data,
+                        fmt='fits',
+                        file=fitsfile,
+                        nrows=data.size,
+                        nbytes=data.nbytes)
+
+            for col in index_cols:
+                index_keys[col].append( data[col].copy() )
+
+        if not first and len(index_cols) > 0:
+            from . import fitsindex
+
+            for col in index_cols:
+                keys=numpy.concatenate(index_keys.pop(col))
+                with prof.timer('write'):
+                    fitsindex.write_index(fits, keys, col)
+
+def get_index_columns(index_by):
+    """
+    Get a list of lower case column names from a sequence or a comma
+    separated string.  None gives an empty list
+    """
+    if index_by is None:
+        return []
+
+    from . import split
+    return split.get_split_columns(index_by)
+
+def queries2fits(fitsfile,
+                 queries,
+                 conn=None,
+                 nconcurrent=1,
+                 replace_none=None,
+                 prefetch=_PREFETCH,
+                 show=False,
+                 **keys):
+    """
+    Run several named queries and write each result as an extension of one
+    fits file, with the extension name set to the query name.  Empty results
+    give empty extensions.
+
+    With nconcurrent > 1 the queries are run at the same time on pooled
+    sessions.  Each result is written to a temporary .npy file in the
+    output directory, and these are copied into the fits file in order at
+    the end
+
+    parameters
+    ----------
+    fitsfile: string
+        The file to write
+    queries: sequence or dict
+        A sequence of (name, query) or (name, query, params), or a dict
+        of queries keyed by name.  Use an OrderedDict to set the order
+        of the extensions
+    conn: Connection, optional
+        Run the queries on this connection.  For nconcurrent > 1, pooled
+        sessions with the same parameters are used.  If not sent, pooled
+        sessions for the keywords are used
+    nconcurrent: int, optional
+        Number of queries run at once.  Default 1
+    replace_none: optional
+        Replace NULL values with this value.  By default a value is chosen
+        for each type, see get_null_sentinel
+    prefetch: int or 'auto', optional
+        Number of rows to fetch in each round trip
+    show: bool, optional
+        If True, print the queries to stderr
+    **keys:
+        Keywords for the pooled sessions, e.g. user,password,host
+
+    returns
+    -------
+    A dict with the number of rows in each extension
+    """
+    import fitsio
+
+    queries=get_named_queries(queries)
+
+    if conn is not None:
+        keys=conn._get_conn_keys()
+
+    if nconcurrent > 1 and len(queries) > 1:
+        staged=_stage_queries(fitsfile, queries, nconcurrent,
+                              replace_none, prefetch, show, keys)
+    else:
+        staged=None
+
+    nrows={}
+    try:
+        with fitsio.FITS(fitsfile,'rw',clobber=True) as fits:
+            for name,query,params in queries:
+                if staged is not None:
+                    nrows[name]=_copy_npy_to_fits(fits, name, staged[name])
+                elif conn is not None:
+                    nrows[name]=_query_to_fits(conn, fits, fitsfile, name,
+                                               query, params, replace_none,
+                                               prefetch, show)
+                else:
+                    from . import pool
+                    with pool.session(**keys) as pconn:
+                        nrows[name]=_query_to_fits(pconn, fits, fitsfile,
+                                                   name, query, params,
+                                                   replace_none, prefetch,
+                                                   show)
+    finally:
+        if staged is not None:
+            for fname in staged.values():
+                if os.path.exists(fname):
+                    os.remove(fname)
+
+    return nrows
+
+def get_named_queries(queries):
+    """
+    Get a list of (name, query, params) from a sequence of (name, query) or
+    (name, query, params), or from a dict of queries keyed by name
+    """
+    if isinstance(queries, dict):
+        queries=list(queries.items())
+
+    named=[]
+    for q in queries:
+        if len(q)==2:
+            name,query=q
+            params=None
+        else:
+            name,query,params=q
+        named.append( (name,query,params) )
+
+    names=[n[0] for n in named]
+    if len(names)==0:
+        raise ValueError("no queries were sent")
+    if len(set(names)) != len(names):
+        raise ValueError("query names must be unique, got %s" % names)
+
+    return named
+
+def _query_to_fits(conn, fits, fitsfile, name, query, params, replace_none,
+                   prefetch, show):
+    """
+    run the query and write the result as a new extension
+    """
+    curs=conn._execute(query, params=params, prefetch=prefetch, show=show,
+                       numpy_types=True)
+    if curs.description is None:
+        raise ValueError("query '%s' returned no rows or columns" % name)
+
+    def write_first(data):
+        fits.write(data, extname=name)
+
+    curs=ThreadedCursor(curs)
+    try:
+        dtype=get_numpy_descr(curs.description)
+        nrows=0
+        for data in cursor2array_chunks(curs,
+                                        replace_none=replace_none,
+                                        dtype=dtype):
+            if nrows==0:
+                write=write_first
+            else:
+                write=fits[name].append
+
+            write_chunk(write, data,
+                        fmt='fits',
+                        file=fitsfile,
+                        nrows=data.size,
+                        nbytes=data.nbytes)
+            nrows += data.size
+
+        if nrows==0:
+            import numpy
+            fits.write(numpy.zeros(0, dtype=dtype), extname=name)
+    finally:
+        curs.close()
+
+    return nrows
+
+def _copy_npy_to_fits(fits, name, fname, nper=1000000):
+    """
+    copy a staged result into a new extension, nper rows at a time
+    """
+    from . import npyio
+
+    arr=npyio.read_npy(fname, mmap=True)
+    nrows=arr.size
+
+    fits.write(arr[0:nper], extname=name)
+    for start in range(nper, nrows, nper):
+        fits[name].append(arr[start:start+nper])
+
+    del arr
+    return nrows
+
+def _stage_queries(fitsfile, queries, nconcurrent, replace_none, prefetch,
+                   show, keys):
+    """
+    run the queries concurrently on pooled sessions, writing each
+    result to a temporary .npy file.  Returns a dict of file names
+    keyed by query name
+    """
+    from . import pool
+
+    dirname=os.path.dirname(os.path.abspath(fitsfile))
+
+    sessions=pool.get_pool(**keys)
+
+    staged={}
+    for name,query,params in queries:
+        fd,fname=tempfile.mkstemp(prefix='desdb-', suffix='.npy', dir=dirname)
+        os.close(fd)
+        staged[name]=fname
+
+    todo=list(queries)
+    errors=[]
+    lock=threading.Lock()
+
+    # the work in the threads is added to the caller's profile
+    prof=profiling.get_profile()
+
+    def work():
+        while True:
+            with lock:
+                if len(todo)==0 or len(errors) > 0:
+                    return
+                name,query,params=todo.pop(0)
+            try:
+                with profiling.using(prof), sessions.session() as conn:
+                    curs=conn._execute(query, params=params, prefetch=prefetch,
+                                       show=show, numpy_types=True)
+                    try:
+                        if curs.description is None:
+                            raise ValueError("query '%s' returned no rows "
+                                             "or columns" % name)
+                        cursor2npy(staged[name], curs,
+                                   replace_none=replace_none)
+                    finally:
+                        curs.close()
+            except Exception as err:
+                with lock:
+                    errors.append(err)
+
+    # the pool goes back to its size when the queries are done
+    with sessions.expanded(nconcurrent):
+        threads=[]
+        for i in range(min(nconcurrent, len(queries))):
+            thread=threading.Thread(target=work)
+            thread.daemon=True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    # a timeout so the main thread can still be interrupted
+                    thread.join(0.1)
+        except KeyboardInterrupt:
+            with lock:
+                del todo[:]
+            errors.append( RuntimeError("Interrupt encountered") )
+
+    if len(errors) > 0:
+        for fname in staged.values():
+            if os.path.exists(fname):
+                os.remove(fname)
+        raise errors[-1]
+
+    return staged
 
 
 def get_numpy_descr(odesc,
@@ -1457,11 +3429,6 @@ def replace_none_rows(old_rows, replace_value):
     return new_rows
 
 def replace_none_row(old_row, replace_value):
-    new_row=()
-    for val in old_row:
-        if val is None:
-            val=replace_value
-        new_row += (val,)
-    return new_row
+    return tuple([replace_value if val is None else val for val in old_row])
 
 
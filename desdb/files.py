@@ -7,6 +7,7 @@ from pprint import pprint
 
 try:
     from . import desdb
+    from . import pool
 except:
     # this is usually because the oracle libraries are not installed
     pass
@@ -88,7 +89,8 @@ def get_meds_info(release, **kw):
     bands: string or sequence, optional
         Optionally limit to the specified bands
     kw: keywords
-        Other keywods for the database connection
+        Other keywods for the database connection.  A pooled
+        session is used, see desdb.pool
 
     comments
     --------
@@ -111,19 +113,20 @@ def get_meds_info(release, **kw):
         miscfile m,
         file_archive_info fai
     where
-        t.tag='{release}' 
+        t.tag=:release
         and t.pfw_attempt_id=m.pfw_attempt_id
         and m.filetype='coadd_meds'
         and m.filename=fai.filename
-    """.format(release=release.upper())
+    """
+    params={'release':release.upper()}
 
     tilename=kw.pop('tilename',None)
     bands=kw.pop('bands',None)
     if bands is not None:
         bands=get_as_list(bands)
 
-    conn=desdb.Connection(**kw)
-    res=conn.quick(query)
+    with pool.session(**kw) as conn:
+        res=conn.quick(query, params=params)
 
     if bands is not None:
         res = [r for r in res if r['band'] in bands]
@@ -155,12 +158,15 @@ def get_coadd_se_psf_info(release, tilename, **kw):
     This is for the Y3 schema
     """
 
+    params={'release':release.upper(),
+            'tilename':tilename}
+
     bands=kw.pop('bands',None)
     if bands is not None:
         bands=get_as_list(bands)
-        bstr = str(bands).replace('[','').replace(']','')
+        bstr, bparams = get_sql_bind_list('band', bands)
         bstr="        and i.band in ({bstr})".format(bstr=bstr)
-
+        params.update(bparams)
     else:
         bstr=""
 
@@ -181,10 +187,10 @@ def get_coadd_se_psf_info(release, tilename, **kw):
         file_archive_info pfai 
 
     where
-        t.tag='{release}' 
+        t.tag=:release
         and t.pfw_attempt_id=av.pfw_attempt_id 
         and av.key='tilename' 
-        and av.val='{tilename}' 
+        and av.val=:tilename
         and t.pfw_attempt_id=a.id 
         and t.root_task_id=a.task_id 
         and t.id=u.task_id  
@@ -196,14 +202,12 @@ def get_coadd_se_psf_info(release, tilename, **kw):
         and m.filename=pfai.filename 
         and i.ccdnum=m.ccdnum 
         {bstr}
-    """ .format(release=release.upper(),
-                tilename=tilename,
-                bstr=bstr)
+    """ .format(bstr=bstr)
 
     print(query, file=stderr)
 
-    conn=desdb.Connection(**kw)
-    res=conn.quick(query)
+    with pool.session(**kw) as conn:
+        res=conn.quick(query, params=params)
 
     _add_local_and_remote_info(res)
 
@@ -229,12 +233,14 @@ def get_coadd_se_info(release, tilename, **kw):
     This is for the Y3 schema
     """
 
+    params={'tilename':tilename}
+
     bands=kw.pop('bands',None)
     if bands is not None:
         bands=get_as_list(bands)
-        bstr = str(bands).replace('[','').replace(']','')
+        bstr, bparams = get_sql_bind_list('band', bands)
         bstr="        and i.band in ({bstr})".format(bstr=bstr)
-
+        params.update(bparams)
     else:
         bstr=""
 
@@ -261,7 +267,7 @@ def get_coadd_se_info(release, tilename, **kw):
         t.tag='Y3A1_COADD' 
         and t.pfw_attempt_id=av.pfw_attempt_id 
         and av.key='tilename' 
-        and av.val='{tilename}' 
+        and av.val=:tilename
         and t.pfw_attempt_id=a.id 
         and t.root_task_id=a.task_id 
         and t.id=u.task_id  
@@ -274,14 +280,12 @@ def get_coadd_se_info(release, tilename, **kw):
         and i.ccdnum=m.ccdnum 
         and i.filename=ifai.filename
         {bstr}
-    """ .format(release=release.upper(),
-                tilename=tilename,
-                bstr=bstr)
+    """ .format(bstr=bstr)
 
     print(query, file=stderr)
 
-    conn=desdb.Connection(**kw)
-    res=conn.quick(query)
+    with pool.session(**kw) as conn:
+        res=conn.quick(query, params=params)
 
     _add_local_and_remote_info(res, types=['im','psf'])
 
@@ -302,11 +306,11 @@ def get_release_magzp_ref(release, band):
     """
     id=get_release_ref_image(release, band)
     query="""
-    select distinct(mag_zero) from zeropoint where source='GCM' and imageid=%s
-    \n""" % id
+    select distinct(mag_zero) from zeropoint where source='GCM' and imageid=:id
+    \n"""
 
-    conn=desdb.Connection()
-    res=conn.quick(query)
+    with pool.session() as conn:
+        res=conn.quick(query, params={'id':id})
 
     magzp_ref = res[0]['mag_zero']
     return magzp_ref
@@ -322,6 +326,33 @@ def get_sql_release_list(release):
 
     return ','.join( ["'%s'" % r.upper() for r in release] )
 
+def get_sql_bind_list(name, values):
+    """
+    For use in an sql "in" clause with bind variables
+
+    parameters
+    ----------
+    name: string
+        Base name for the bind variables
+    values: sequence
+        The values
+
+    returns
+    -------
+    bind string, params
+
+    The bind string is of the form ':name0,:name1,...' and
+    params is a dict of values keyed by name0, name1, ...
+    """
+    names=[]
+    params={}
+    for i,val in enumerate(values):
+        bname='%s%d' % (name,i)
+        names.append(':'+bname)
+        params[bname]=val
+
+    return ','.join(names), params
+
 def get_coadd_run_bands(run, conn=None, **keys):
     query="""
     select
@@ -329,15 +360,17 @@ def get_coadd_run_bands(run, conn=None, **keys):
     from
         coadd
     where
-        run='%s'
-    """ % run
+        run=:run
+    """
+    params={'run':run}
 
     if conn is None:
-        conn=desdb.Connection(**keys)
-
-    res=conn.quick(query,**keys)
+        with pool.session(**keys) as conn:
+            res=conn.quick(query,params=params,container='columns',**keys)
+    else:
+        res=conn.quick(query,params=params,container='columns',**keys)
 
-    return [r['band'] for r in res]
+    return res['band']
 
 def get_testbed_runs(runconfig):
     import deswl
@@ -363,29 +396,37 @@ def get_testbed_runs(runconfig):
     return runs
 
 def get_release_runs(release, **keys):
-    rl = get_sql_release_list(release)
+    """
+    Get the runs for the release or list of releases
+
+    Send withbands= to only get coadd runs with all the listed bands.  Send
+    cache=True to keep the result in the on-disk query cache, see
+    Connection.quick
+    """
+    release=[r.upper() for r in get_as_list(release)]
+    rl, params = get_sql_bind_list('tag', release)
 
-    withbands=keys.get('withbands',None)
+    withbands=keys.pop('withbands',None)
     if withbands:
-        band_count = len(withbands)
-        bands_s = ",".join("'%s'"%b for b in withbands)
+        bands_s, bparams = get_sql_bind_list('band', withbands)
+        params.update(bparams)
+        params['nband'] = len(withbands)
         query = """
         select distinct(rt.run)
             from runtag rt
         where rt.tag in (%s)
         and
-        (select count(c.band) from coadd c where run=rt.run and c.band in (%s))=%d
-        """ % (rl, bands_s, band_count)
+        (select count(c.band) from coadd c where run=rt.run and c.band in (%s))=:nband
+        """ % (rl, bands_s)
     else:
         query="""
         select distinct(run) from runtag where tag in (%s)
         """ % rl
 
 
-    conn=desdb.Connection(**keys)
-    res=conn.quick(query,**keys)
-    runs = [r['run'] for r in res]
-    conn.close()
+    with pool.session(**keys) as conn:
+        res=conn.quick(query,params=params,container='columns',**keys)
+    runs = res['run']
     return runs
 
 # these are sub-chunks we like to work with, but which are not defined
@@ -544,7 +585,7 @@ def get_coadd_info_by_release(release, band, withbands=None):
     data = get_coadd_info_by_runlist(runlist, band)
     return data
 
-def get_coadd_srclist_by_release(release, withbands, **keys):
+def get_coadd_srclist_by_release(release, withbands, nconcurrent=1, **keys):
     """
     Get all the coadd runs associated with the release, and then
     grab the source information for the SE images that made up
@@ -552,6 +593,10 @@ def get_coadd_srclist_by_release(release, withbands, **keys):
 
     See the _load_srclist method in the Coadd object for what
     fields will be present
+
+    If nconcurrent > 1, the source lists are loaded concurrently on
+    that many pooled sessions using desdb.aio.  This requires python 3
+    and is not done if a connection is sent with conn=
     """
 
     print('getting coadd_runs with bands:',withbands, file=stderr)
@@ -562,33 +607,65 @@ def get_coadd_srclist_by_release(release, withbands, **keys):
     ncoadd=len(coadd_runs)
     print('extracting source lists', file=stderr)
 
+    if nconcurrent > 1 and keys.get('conn',None) is None:
+        coadds=_load_srclists_concurrent(coadd_runs, withbands,
+                                         nconcurrent, **keys)
+    else:
+        coadds=[]
+        for i,coadd_run in enumerate(coadd_runs):
+            print('%d/%d' % (i+1,ncoadd),coadd_run, file=stderr, end='')
+            for band in withbands:
+                print(band,file=stderr,end='')
+                coadds.append( _load_srclist(coadd_run, band, **keys) )
+            print("", file=stderr)
+
+    if len(coadds) > 0:
+        print('\n', file=stderr)
+        pprint(coadds[0].srclist[0],stream=stderr)
+        print('\n', file=stderr)
+
     # use dict so we only get unique ones
     fdict={}
-    for i,coadd_run in enumerate(coadd_runs):
-        print('%d/%d' % (i+1,ncoadd),coadd_run, file=stderr, end='')
-        for band in withbands:
-            print(band,file=stderr,end='')
-            cf=Coadd(coadd_run=coadd_run, band=band, **keys)
-
-            cf.load(srclist=True)
-            if i==0 and band==withbands[0]:
-                print('\n', file=stderr)
-                pprint(cf.srclist[0],stream=stderr)
-                print('\n', file=stderr)
-
-            for fd in cf.srclist:
-                key='%s-%s' % (fd['expname'], fd['ccd'])
-                fdict[key] = fd
-
-        print("", file=stderr)
+    for cf in coadds:
+        for fd in cf.srclist:
+            key='%s-%s' % (fd['expname'], fd['ccd'])
+            fdict[key] = fd
 
     print('converting to list of dicts', file=stderr)
     data = [fdict[key] for key in fdict]
     return data
 
+def _load_srclist(coadd_run, band, **keys):
+    cf=Coadd(coadd_run=coadd_run, band=band, **keys)
+    cf.load(srclist=True)
+    return cf
+
+def _load_srclists_concurrent(coadd_runs, withbands, nconcurrent, **keys):
+    """
+    load the Coadd source lists on nconcurrent pooled sessions
+    """
+    from . import aio
+
+    conn_keys=dict( (k,keys[k]) for k in ('user','password','host')
+                    if k in keys )
+    sessions=pool.get_pool(**conn_keys)
+
+    runbands=[(r,b) for r in coadd_runs for b in withbands]
+    print('loading %d source lists with %d sessions' % (len(runbands),
+                                                       nconcurrent),
+          file=stderr)
+
+    def load(runband):
+        return _load_srclist(runband[0], runband[1], **keys)
+
+    # the pool goes back to its size when the lists are loaded
+    with sessions.expanded(nconcurrent):
+        return aio.run(aio.amap(load, runbands, **conn_keys))
+
+# bind variables :desdata, :run, :expname
 _runexp_template="""
 select
-    '%(desdata)s/' || loc.project || '/red/' || image.run || '/red/' || loc.exposurename || '/' || image.imagename || '.fz' as image_url,
+    :desdata || '/' || loc.project || '/red/' || image.run || '/red/' || loc.exposurename || '/' || image.imagename || '.fz' as image_url,
     loc.exposurename as expname,
     loc.band,
     image.ccd,
@@ -597,15 +674,16 @@ select
 from
     image, location loc
 where
-    image.run = '%(run)s'
-    and loc.exposurename = '%(expname)s'
+    image.run = :run
+    and loc.exposurename = :expname
     and loc.id=image.id
     and image.imagetype='red'
     and image.ccd not in (%(skip_ccds)s)\n"""
 
+# bind variables :desdata, :run
 _run_template="""
 select
-    '%(desdata)s/' || loc.project || '/red/' || image.run || '/red/' || loc.exposurename || '/' || image.imagename || '.fz' as image_url,
+    :desdata || '/' || loc.project || '/red/' || image.run || '/red/' || loc.exposurename || '/' || image.imagename || '.fz' as image_url,
     loc.exposurename as expname,
     loc.band,
     image.ccd,
@@ -614,12 +692,13 @@ select
 from
     image, location loc
 where
-    image.run = '%(run)s'
+    image.run = :run
     and loc.id=image.id
     and image.imagetype='red'
     and image.ccd not in (%(skip_ccds)s)\n"""
 
-def get_red_info_by_run(run, expname=None, skip_ccds=SKIP_CCDS, conn=None, **keys):
+def get_red_info_by_run(run, expname=None, skip_ccds=SKIP_CCDS, conn=None,
+                        container=None, **keys):
     """
     Get some red info for the input run and possibly exposurename
 
@@ -629,24 +708,29 @@ def get_red_info_by_run(run, expname=None, skip_ccds=SKIP_CCDS, conn=None, **key
         run identifier
     expname: optional
         exposurename
+    container: string, optional
+        Form of the result, e.g. 'records' for a compact list of rows
+        that still support r['image_url'].  See Connection.quick.
+        Default is a list of dicts
     """
 
-    if conn is None:
-        conn=desdb.Connection(**keys)
-
     skip_ccds=','.join([str(nm) for nm in skip_ccds])
     desdata=get_des_rootdir()
+    params={'run':run,
+            'desdata':desdata}
+
+    # the skip list is fixed, so the statement is still reused
     if expname is not None:
-        query=_runexp_template % {'run':run,
-                                  'expname':expname,
-                                  'desdata':desdata,
-                                  'skip_ccds':skip_ccds}
+        query=_runexp_template % {'skip_ccds':skip_ccds}
+        params['expname']=expname
     else:
-        query=_run_template % {'run':run,
-                               'desdata':desdata,
-                               'skip_ccds':skip_ccds}
+        query=_run_template % {'skip_ccds':skip_ccds}
 
-    data=conn.quick(query)
+    if conn is None:
+        with pool.session(**keys) as conn:
+            data=conn.quick(query, params=params, container=container)
+    else:
+        data=conn.quick(query, params=params, container=container)
 
     return data
 
@@ -657,26 +741,23 @@ def get_red_info_by_runlist(runlist,
     runlist and explist are paired
     """
 
-    conn=desdb.Connection(**keys)
-
-    desdata=get_des_rootdir()
     dlist=[]
 
-    if explist is not None:
-        for run,expname in zip(runlist,explist):
+    with pool.session(**keys) as conn:
+        if explist is not None:
+            for run,expname in zip(runlist,explist):
 
-            data = get_red_info_by_run(run, expname=expname)
-            data=conn.quick(query)
+                data = get_red_info_by_run(run, expname=expname, conn=conn)
 
-            dlist += data
-    else:
-        nrun=len(runlist)
-        for i,run in enumerate(runlist):
+                dlist += data
+        else:
+            nrun=len(runlist)
+            for i,run in enumerate(runlist):
 
-            print("    %d/%d %s" % (i+1,nrun,run), file=stderr)
+                print("    %d/%d %s" % (i+1,nrun,run), file=stderr)
 
-            data = get_red_info_by_run(run)
-            dlist += data
+                data = get_red_info_by_run(run, conn=conn)
+                dlist += data
 
     return dlist
 
@@ -694,8 +775,6 @@ def get_red_info_by_runlist_old(runlist,
     Get all image and cat info for the input list of runs
     """
 
-    conn=desdb.Connection(user=user,password=password,host=host)
-
     runcsv = ','.join(runlist)
     runcsv = ["'%s'" % r for r in runlist]
     runcsv = ','.join(runcsv)
@@ -720,11 +799,12 @@ def get_red_info_by_runlist_old(runlist,
                    'desdata':desdata,
                    'SKIP_CCDS':SKIP_CCDS_CSV}
 
-    if doprint:
-        conn.quickWrite(query,fmt=fmt,show=show)
-    else:
-        data=conn.quick(query,show=show)
-        return data
+    with pool.session(user=user,password=password,host=host) as conn:
+        if doprint:
+            conn.quickWrite(query,fmt=fmt,show=show)
+        else:
+            data=conn.quick(query,show=show)
+            return data
 
 def _read_runexp(fname):
     runlist=[]
@@ -813,10 +893,9 @@ class Red(dict):
 
         self.verbose=verbose
 
-        if conn is None:
-            self.conn=desdb.Connection(user=user,password=password)
-        else:
-            self.conn=conn
+        # if no connection is sent, queries are run on pooled sessions
+        self.conn=conn
+        self._conn_keys={'user':user,'password':password}
 
     def load(self):
 
@@ -836,6 +915,17 @@ class Red(dict):
                                  ccd=self['ccd'])
 
 
+    def _quick(self, query, **keys):
+        """
+        run the query on our connection, or a pooled session if
+        none was sent
+        """
+        if self.conn is not None:
+            return self.conn.quick(query, **keys)
+
+        with pool.session(**self._conn_keys) as conn:
+            return conn.quick(query, **keys)
+
     def _get_info_by_id(self):
         query="""
         select
@@ -851,9 +941,11 @@ class Red(dict):
         where
             cat.catalogtype='red_cat'
             and cat.parentid = im.id
-            and im.id = %(id)s\n""" % {'id':self['image_id']}
+            and im.id = :id\n"""
 
-        res=self.conn.quick(query,show=self.verbose)
+        res=self._quick(query,
+                        params={'id':self['image_id']},
+                        show=self.verbose)
 
         if len(res) > 1:
             raise ValueError("Expected a single result, found %d")
@@ -876,12 +968,12 @@ class Red(dict):
         where
             cat.filetype='red_cat'
             and cat.catalog_parentid = im.id
-            and cat.file_exposure_name = '%(expname)s'
-            and cat.ccd = %(ccd)s\n""" % {'expname':self['expname'],
-                                          'ccd':self['ccd'],
-                                          'release':self['release']}
+            and cat.file_exposure_name = :expname
+            and cat.ccd = :ccd\n""" % {'release':self['release']}
 
-        res=self.conn.quick(query,show=self.verbose)
+        params={'expname':self['expname'],
+                'ccd':self['ccd']}
+        res=self._quick(query,params=params,show=self.verbose)
         if len(res) != 1:
             raise ValueError("Expected a single result, found %d" % len(res))
 
@@ -926,10 +1018,9 @@ class Coadd(dict):
         self.coadd_run=coadd_run
         self.band=band
 
-        if conn is None:
-            self.conn=desdb.Connection(user=user,password=password,host=host)
-        else:
-            self.conn=conn
+        # if no connection is sent, queries are run on pooled sessions
+        self.conn=conn
+        self._conn_keys={'user':user,'password':password,'host':host}
 
     def load(self, srclist=False):
 
@@ -957,6 +1048,17 @@ class Coadd(dict):
             self._load_srclist()
         
 
+    def _quick(self, query, **keys):
+        """
+        run the query on our connection, or a pooled session if
+        none was sent
+        """
+        if self.conn is not None:
+            return self.conn.quick(query, **keys)
+
+        with pool.session(**self._conn_keys) as conn:
+            return conn.quick(query, **keys)
+
     def _get_info_by_runband(self):
         query="""
         select
@@ -972,11 +1074,12 @@ class Coadd(dict):
         where
             cat.catalogtype='coadd_cat'
             and cat.parentid = im.id
-            and im.run = '%(run)s'
-            and im.band = '%(band)s'\n""" % {'run':self.coadd_run,
-                                             'band':self.band}
+            and im.run = :run
+            and im.band = :band\n"""
 
-        res=self.conn.quick(query,show=self.verbose)
+        params={'run':self.coadd_run,
+                'band':self.band}
+        res=self._quick(query,params=params,show=self.verbose)
 
         if len(res) > 1:
             vals=(len(res),self.coadd_run,self.band)
@@ -1005,9 +1108,11 @@ class Coadd(dict):
         where
             cat.catalogtype='coadd_cat'
             and cat.parentid = im.id
-            and im.id = %(id)s\n""" % {'id':self.image_id}
+            and im.id = :id\n"""
 
-        res=self.conn.quick(query,show=self.verbose)
+        res=self._quick(query,
+                        params={'id':self.image_id},
+                        show=self.verbose)
 
         if len(res) > 1:
             raise ValueError("Expected a single result, found %d")
@@ -1040,20 +1145,19 @@ class Coadd(dict):
         FROM
             coadd_src,coadd,image c,image d, location loc
         WHERE
-            coadd.band='{band}'
+            coadd.band=:band
             and coadd_src.coadd_imageid=coadd.id
-            and coadd.run='{coadd_run}'
+            and coadd.run=:coadd_run
             and c.id=coadd_src.src_imageid
             and c.parentid=d.id
             and loc.id = d.id
         ORDER BY
             d.id\n"""
 
+        params={'band':self['band'],
+                'coadd_run':self['coadd_run']}
 
-        query=query.format(band=self['band'],
-                           coadd_run=self['coadd_run'])
-
-        res = self.conn.quick(query, show=self.verbose)
+        res = self._quick(query, params=params, show=self.verbose)
 
         
 
@@ -1097,7 +1201,7 @@ class Coadd(dict):
         query=query.format(band=self['band'],
                            coadd_run=self['coadd_run'])
 
-        res = self.conn.quick(query, show=self.verbose)
+        res = self._quick(query, show=self.verbose)
 
  
         idlist=[]
@@ -1119,7 +1223,7 @@ class Coadd(dict):
             id in (%(idcsv)s) 
         order by id\n""" % {'idcsv':idcsv}
 
-        res = self.conn.quick(query)
+        res = self._quick(query)
         if len(res) != len(zpdict):
             raise ValueError("expected %d sources but "
                              "got %d" % (len(zpdict),len(res)))
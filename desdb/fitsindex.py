@@ -0,0 +1,245 @@
+"""
+Sorted key indexes stored in FITS files, for fast lookups of rows.
+
+When a table is written with an index on a column, an extra binary table
+extension is added holding the column values in sorted order and the row
+number of each in the data table.  FitsIndex finds the rows for a value, or
+a range of values, with a binary search: a sample of every 4096th key is
+held in memory, and one block of the index is read from disk, followed by
+the matching rows of the data table.  Only a few small reads are needed,
+however large the table.
+
+examples
+--------
+
+    import desdb
+
+    # write objects.fits with indexes on two columns, e.g.
+    # des-query -f fits --index-by coadd_objects_id -o objects.fits
+    conn=desdb.Connection()
+    conn.quickWrite(query, fmt='fits', file='objects.fits',
+                    index_by=['coadd_objects_id','tilename'])
+
+    with desdb.fitsindex.FitsIndex('objects.fits','coadd_objects_id') as ind:
+        data=ind.lookup(123456)
+        data=ind.lookup_range(100000, 200000, columns=['ra','dec'])
+"""
+from __future__ import print_function
+
+import numpy
+
+# keys held in memory are one for each block of this many rows
+_BLOCKSIZE=4096
+
+# rows of the index written at once
+_WRITE_ROWS=1000000
+
+def write_index(fits, keys, column, data_ext=1):
+    """
+    Sort the keys and write the index as a new extension
+
+    parameters
+    ----------
+    fits: fitsio.FITS
+        The file, opened for writing
+    keys: array
+        The values of the column for each row of the data table
+    column: string
+        Name of the indexed column
+    data_ext: int, optional
+        The extension holding the data table, default 1
+    """
+    # stable, so the rows for equal keys are in order
+    rows=numpy.argsort(keys, kind='mergesort')
+
+    dtype=[('key',keys.dtype.descr[0][1]), ('row','i8')]
+
+    header=[
+        {'name':'IDXCOL', 'value':column, 'comment':'indexed column'},
+        {'name':'IDXEXT', 'value':data_ext, 'comment':'data extension'},
+    ]
+
+    extname=get_index_extname(column)
+    nrows=keys.size
+    start=0
+    while True:
+        stop=min(start+_WRITE_ROWS, nrows)
+
+        index=numpy.zeros(stop-start, dtype=dtype)
+        index['row']=rows[start:stop]
+        index['key']=keys[index['row']]
+
+        if start==0:
+            fits.write(index, extname=extname, header=header)
+        else:
+            fits[extname].append(index)
+
+        start=stop
+        if start >= nrows:
+            break
+
+def get_index_extname(column):
+    """
+    The name of the extension holding the index for the column
+    """
+    return '%s_index' % column.lower()
+
+class FitsIndex(object):
+    """
+    Look up rows of a FITS table through an index written with
+    cursor2fits(index_by=)
+
+    parameters
+    ----------
+    fname: string
+        The FITS file
+    column: string
+        The indexed column
+    blocksize: int, optional
+        Number of index rows for each key held in memory.  Default 4096
+    """
+    def __init__(self, fname, column, blocksize=_BLOCKSIZE):
+        import fitsio
+
+        self.fname=fname
+        self.column=column.lower()
+        self.blocksize=blocksize
+
+        self._fits=fitsio.FITS(fname)
+        try:
+            extname=get_index_extname(self.column)
+            if extname not in self._fits:
+                raise ValueError("no index for column '%s' in %s" % (column,
+                                                                     fname))
+            self._index=self._fits[extname]
+
+            hdr=self._index.read_header()
+            self._data=self._fits[hdr['IDXEXT']]
+
+            self.nrows=self._index.get_nrows()
+
+            # every blocksize'th key
+            if self.nrows > 0:
+                fence_rows=numpy.arange(0, self.nrows, blocksize)
+                self._fence=self._index.read(columns=['key'],
+                                             rows=fence_rows)['key']
+            else:
+                self._fence=numpy.zeros(0)
+        except:
+            self._fits.close()
+            raise
+
+    def get_rows(self, value):
+        """
+        Get the sorted row numbers in the data table with the value
+        """
+        return self.get_rows_range(value, value)
+
+    def get_rows_range(self, lo, hi):
+        """
+        Get the sorted row numbers in the data table with lo <= value <= hi
+        """
+        start=self._search(lo, 'left')
+        stop=self._search(hi, 'right')
+        if stop <= start:
+            return numpy.zeros(0, dtype='i8')
+
+        rows=self._index['row'][start:stop]
+        rows.sort()
+        return rows
+
+    def lookup(self, value, columns=None):
+        """
+        Read the rows of the data table with the value
+
+        parameters
+        ----------
+        value:
+            The value of the indexed column
+        columns: sequence, optional
+            Columns to read, default all
+
+        returns
+        -------
+        A structured array, empty if there are no matches
+        """
+        return self.lookup_range(value, value, columns=columns)
+
+    def lookup_range(self, lo, hi, columns=None):
+        """
+        Read the rows of the data table with lo <= value <= hi
+
+        parameters
+        ----------
+        lo, hi:
+            The range of values of the indexed column, inclusive
+        columns: sequence, optional
+            Columns to read, default all
+
+        returns
+        -------
+        A structured array sorted by row number, empty if there are
+        no matches
+        """
+        rows=self.get_rows_range(lo, hi)
+        if rows.size==0:
+            # an empty array with the columns of the table
+            return self._data.read(columns=columns, rows=[0])[0:0]
+
+        return self._data.read(columns=columns, rows=rows)
+
+    def close(self):
+        """
+        close the file
+        """
+        self._fits.close()
+
+    def _search(self, value, side):
+        """
+        The position of the value in the sorted keys, as for
+        numpy.searchsorted, reading one block of keys
+        """
+        if self.nrows==0:
+            return 0
+
+        value=self._get_search_value(value)
+
+        iblock=numpy.searchsorted(self._fence, value, side=side)
+        if iblock==0:
+            return 0
+
+        start=(iblock-1)*self.blocksize
+        stop=min(iblock*self.blocksize, self.nrows)
+        keys=self._index['key'][start:stop]
+        return start + numpy.searchsorted(keys, value, side=side)
+
+    def _get_search_value(self, value):
+        """
+        The value as an array of its own type.  It is not converted to the
+        type of the keys, which could change it, e.g. 1.5 to 1 for integer
+        keys; numpy compares the two in a type that holds both.  Strings
+        are only converted between bytes and unicode to match the keys
+        """
+        value=numpy.array(value)
+
+        kind=self._fence.dtype.kind
+        if kind=='S' and value.dtype.kind=='U':
+            value=numpy.array(value.item().encode('utf-8'))
+        elif kind=='U' and value.dtype.kind=='S':
+            value=numpy.array(value.item().decode('utf-8'))
+
+        return value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        rep=["DESDB FitsIndex"]
+        indent=' '*4
+        rep.append("%sfile:   %s" % (indent,self.fname))
+        rep.append("%scolumn: %s" % (indent,self.column))
+        rep.append("%snrows:  %s" % (indent,self.nrows))
+        return '\n'.join(rep)
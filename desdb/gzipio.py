@@ -0,0 +1,164 @@
+"""
+Compressed output written with several threads.
+
+Text written to a ParallelGzipWriter is cut into blocks, and each block is
+compressed in a thread pool as a separate gzip member.  zlib releases the GIL
+while compressing, so the threads run in parallel.  The members are written
+in order, giving a standard multi-member gzip file that gzip, zcat and the
+python gzip module read as one stream.
+
+open_output is used by the writers in desdb.desdb, so any output file name
+ending in .gz is compressed this way, e.g.
+
+    des-query -o out.csv.gz < sql_file
+"""
+from __future__ import print_function
+import sys
+import zlib
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# uncompressed size of each gzip member
+_BLOCKSIZE=1024*1024
+
+# default compression level, the same as gzip
+_LEVEL=6
+
+# default number of compression threads
+_MAX_THREADS=4
+
+def open_output(fname, nthreads=None, append=False):
+    """
+    Open a file for writing text output.  Names ending in .gz are
+    compressed with a ParallelGzipWriter.  If fname is None,
+    standard output is returned.  If append is True, the output is
+    added to the end of an existing file
+    """
+    if fname is None:
+        return sys.stdout
+    elif fname.endswith('.gz'):
+        return ParallelGzipWriter(fname, nthreads=nthreads, append=append)
+    elif append:
+        return open(fname,'a')
+    else:
+        return open(fname,'w')
+
+class ParallelGzipWriter(object):
+    """
+    A write-only file object producing a multi-member gzip file, with the
+    blocks compressed in a pool of threads.
+
+    parameters
+    ----------
+    fname: string
+        The file to write
+    nthreads: int, optional
+        Number of compression threads.  Default is the number of cpus,
+        up to 4
+    blocksize: int, optional
+        Uncompressed bytes in each gzip member, default 1MB
+    level: int, optional
+        Compression level 1-9, default 6
+    append: bool, optional
+        If True, add new gzip members to the end of an existing file.
+        Default False
+    """
+    def __init__(self, fname, nthreads=None, blocksize=_BLOCKSIZE, level=_LEVEL,
+                 append=False):
+        if nthreads is None:
+            nthreads=min(_MAX_THREADS, multiprocessing.cpu_count())
+
+        self.name=fname
+        self.nthreads=nthreads
+        self.blocksize=blocksize
+        self.level=level
+
+        if append:
+            self._fobj=open(fname,'ab')
+        else:
+            self._fobj=open(fname,'wb')
+        # started with the first full block, so small outputs do not pay
+        # for starting and stopping threads
+        self._pool=None
+        self._pending=collections.deque()
+        self._buffer=[]
+        self._nbuffer=0
+        self.closed=False
+
+    def write(self, text):
+        """
+        Write the text.  Unicode is encoded as utf-8
+        """
+        if not isinstance(text, bytes):
+            text=text.encode('utf-8')
+
+        self._buffer.append(text)
+        self._nbuffer += len(text)
+
+        if self._nbuffer >= self.blocksize:
+            self._submit()
+
+    def flush(self):
+        """
+        Write the blocks that are done.  Text still buffered waits for
+        a full block, so flushing does not make the file larger
+        """
+        while len(self._pending) > 0 and self._pending[0].ready():
+            self._fobj.write( self._pending.popleft().get() )
+        self._fobj.flush()
+
+    def close(self):
+        """
+        Compress the remaining text, write all blocks and close the file
+        """
+        if self.closed:
+            return
+
+        try:
+            if self._nbuffer > 0:
+                if self._pool is None:
+                    self._fobj.write( compress_block(b''.join(self._buffer),
+                                                     self.level) )
+                    self._buffer=[]
+                    self._nbuffer=0
+                else:
+                    self._submit()
+
+            while len(self._pending) > 0:
+                self._fobj.write( self._pending.popleft().get() )
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+            self._fobj.close()
+            self.closed=True
+
+    def _submit(self):
+        block=b''.join(self._buffer)
+        self._buffer=[]
+        self._nbuffer=0
+
+        if self._pool is None:
+            self._pool=ThreadPool(self.nthreads)
+
+        self._pending.append(
+            self._pool.apply_async(compress_block, (block, self.level))
+        )
+
+        # keep a bounded number of blocks in memory
+        while len(self._pending) > 2*self.nthreads:
+            self._fobj.write( self._pending.popleft().get() )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+def compress_block(data, level=_LEVEL):
+    """
+    Compress the data as a complete gzip member
+    """
+    # wbits 31 gives the gzip header and trailer
+    comp=zlib.compressobj(level, zlib.DEFLATED, 31)
+    return comp.compress(data) + comp.flush()
@@ -0,0 +1,107 @@
+"""
+Callbacks for database and transfer events, e.g. for monitoring.
+
+Functions registered for an event are called with keywords describing it
+
+    on_execute:     a query was executed by a Connection
+                    query, params, dbname, seconds, error
+                    error is None, or the exception raised by the execute
+    on_fetch_chunk: a chunk of rows was fetched
+                    nrows, seconds
+                    seconds is the time taken by the server, also when
+                    the rows are fetched in a background thread
+    on_write_chunk: a chunk of rows was written by one of the writers
+                    fmt, file, nrows, nbytes, seconds
+                    file is None for standard output, and nbytes is None
+                    when not known
+    on_file_synced: a file was copied by a sync.Synchronizer
+                    url, file, nbytes, seconds
+
+Hooks are called in the thread doing the work, which may not be the main
+thread, so they should be thread safe.  Exceptions raised by a hook are
+printed to stderr and otherwise ignored, so a broken hook cannot stop a
+query or an export.  When no hooks are registered for an event, the cost is
+one dict lookup for each chunk of rows.
+
+See desdb.metrics for a registry that collects counters and histograms
+from these events.
+
+examples
+--------
+
+    import desdb
+
+    def show_execute(query=None, seconds=None, **info):
+        print('%.3f s for %s' % (seconds, query))
+
+    desdb.hooks.register('on_execute', show_execute)
+    ...
+    desdb.hooks.unregister('on_execute', show_execute)
+"""
+from __future__ import print_function
+import sys
+import threading
+import traceback
+
+EVENTS=('on_execute','on_fetch_chunk','on_write_chunk','on_file_synced')
+
+# a tuple of functions for each event, replaced rather than modified so
+# it can be read without the lock
+_hooks=dict( (event,()) for event in EVENTS )
+_lock=threading.Lock()
+
+def register(event, func):
+    """
+    Call func(**info) for each event, see the module docs.  Returns func
+    """
+    _check_event(event)
+    with _lock:
+        if func not in _hooks[event]:
+            _hooks[event] = _hooks[event] + (func,)
+    return func
+
+def unregister(event, func):
+    """
+    Stop calling func for the event.  Functions not registered are
+    ignored
+    """
+    _check_event(event)
+    with _lock:
+        _hooks[event] = tuple(f for f in _hooks[event] if f != func)
+
+def clear(event=None):
+    """
+    Remove all hooks for the event, or for all events if not sent
+    """
+    with _lock:
+        if event is None:
+            events=EVENTS
+        else:
+            _check_event(event)
+            events=[event]
+
+        for event in events:
+            _hooks[event]=()
+
+def get_hooks(event):
+    """
+    Get the tuple of functions registered for the event, empty if none
+    """
+    return _hooks[event]
+
+def call(funcs, **info):
+    """
+    Call each of the functions from get_hooks with the info.  Exceptions
+    raised by the functions are printed to stderr and not raised
+    """
+    for func in funcs:
+        try:
+            func(**info)
+        except Exception:
+            print("error in desdb hook %r:" % func, file=sys.stderr)
+            traceback.print_exc()
+
+def _check_event(event):
+    if event not in _hooks:
+        raise ValueError("event should be one of %s, "
+                         "got '%s'" % (', '.join(EVENTS),event))
@@ -0,0 +1,354 @@
+"""
+Counters and histograms collected from the desdb.hooks events, written as a
+Prometheus textfile or JSON.
+
+Once installed, a MetricsRegistry counts queries, rows fetched, rows and
+bytes written and files synced, and keeps histograms of the time taken by
+each execute, fetch, write and file copy
+
+    desdb_queries_total                  queries executed
+    desdb_query_errors_total             queries that raised an error
+    desdb_execute_seconds                histogram of execute times
+    desdb_rows_fetched_total             rows fetched
+    desdb_fetch_seconds                  histogram of times to fetch a chunk
+                                         from the server
+    desdb_rows_written_total{format=}    rows written
+    desdb_bytes_written_total{format=}   bytes written, before compression
+    desdb_write_seconds{format=}         histogram of times to write a chunk
+    desdb_files_synced_total             files copied by sync.Synchronizer
+    desdb_bytes_synced_total             bytes copied
+    desdb_sync_seconds                   histogram of times to copy a file
+
+The Prometheus file is written in the text exposition format, for the
+textfile collector of the node exporter.
+
+examples
+--------
+
+    import desdb
+
+    registry=desdb.metrics.get_registry()
+    registry.install()
+
+    conn=desdb.Connection()
+    conn.quickWrite(query, fmt='fits', file='objects.fits')
+
+    registry.write_prometheus('/var/lib/node_exporter/desdb.prom')
+    registry.write_json('metrics.json')
+
+    # or from the command line
+    des-query --metrics desdb.prom -f fits -o objects.fits < sql_file
+"""
+from __future__ import print_function
+import os
+import json
+import threading
+from collections import OrderedDict
+
+from . import hooks
+
+# upper bounds of the histogram buckets in seconds; there is always
+# a +Inf bucket
+_BUCKETS=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+          1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_PREFIX='desdb'
+
+_registry=None
+
+def get_registry():
+    """
+    Get the default registry, made on the first call
+    """
+    global _registry
+    if _registry is None:
+        _registry=MetricsRegistry()
+    return _registry
+
+class MetricsRegistry(object):
+    """
+    Counters and histograms with labels, safe to update from several
+    threads.  Call install() to collect metrics from the desdb.hooks
+    events
+
+    parameters
+    ----------
+    prefix: string, optional
+        Prefix for the names of the metrics from the hooks, default 'desdb'
+    buckets: sequence, optional
+        Upper bounds of the histogram buckets, in seconds for the
+        metrics from the hooks
+    """
+    def __init__(self, prefix=_PREFIX, buckets=_BUCKETS):
+        self.prefix=prefix
+        self.buckets=tuple(sorted(buckets))
+
+        self._lock=threading.Lock()
+        self._metrics=OrderedDict()
+        self._installed=False
+
+    def inc(self, name, value=1, help=None, **labels):
+        """
+        Add the value to a counter
+
+        parameters
+        ----------
+        name: string
+            Name of the counter
+        value: number, optional
+            Amount to add, default 1
+        help: string, optional
+            Description of the metric
+        **labels:
+            Labels for the value, e.g. format='csv'
+        """
+        with self._lock:
+            metric=self._get_metric(name, 'counter', help)
+            key=_get_label_key(labels)
+            metric['values'][key]=metric['values'].get(key,0) + value
+
+    def observe(self, name, value, help=None, **labels):
+        """
+        Add an observation to a histogram
+
+        parameters
+        ----------
+        name: string
+            Name of the histogram
+        value: number
+            The observed value
+        help: string, optional
+            Description of the metric
+        **labels:
+            Labels for the value, e.g. format='csv'
+        """
+        with self._lock:
+            metric=self._get_metric(name, 'histogram', help)
+            key=_get_label_key(labels)
+
+            hist=metric['values'].get(key,None)
+            if hist is None:
+                hist={'counts':[0]*len(self.buckets), 'sum':0.0, 'count':0}
+                metric['values'][key]=hist
+
+            for i,upper in enumerate(self.buckets):
+                if value <= upper:
+                    hist['counts'][i] += 1
+                    break
+
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def install(self):
+        """
+        Register hooks so the events are recorded
+        """
+        if self._installed:
+            return
+
+        hooks.register('on_execute', self._on_execute)
+        hooks.register('on_fetch_chunk', self._on_fetch_chunk)
+        hooks.register('on_write_chunk', self._on_write_chunk)
+        hooks.register('on_file_synced', self._on_file_synced)
+        self._installed=True
+
+    def uninstall(self):
+        """
+        Remove the hooks registered by install()
+        """
+        hooks.unregister('on_execute', self._on_execute)
+        hooks.unregister('on_fetch_chunk', self._on_fetch_chunk)
+        hooks.unregister('on_write_chunk', self._on_write_chunk)
+        hooks.unregister('on_file_synced', self._on_file_synced)
+        self._installed=False
+
+    def clear(self):
+        """
+        Remove all metrics
+        """
+        with self._lock:
+            self._metrics=OrderedDict()
+
+    def asdict(self):
+        """
+        Get the metrics as a dict keyed by name.  Each has the 'type',
+        'help' and a list of 'values', each with the 'labels' and the
+        'value' for counters, or the 'buckets', 'sum' and 'count' for
+        histograms.  The bucket counts are cumulative, as for Prometheus
+        """
+        output=OrderedDict()
+        with self._lock:
+            for name,metric in self._metrics.items():
+                values=[]
+                for key,val in metric['values'].items():
+                    entry=OrderedDict([('labels',OrderedDict(key))])
+                    if metric['type']=='counter':
+                        entry['value']=val
+                    else:
+                        entry['buckets']=OrderedDict(
+                            zip([_format_number(b) for b in self.buckets],
+                                _cumulative(val['counts']))
+                        )
+                        entry['buckets']['+Inf']=val['count']
+                        entry['sum']=val['sum']
+                        entry['count']=val['count']
+                    values.append(entry)
+
+                output[name]=OrderedDict([
+                    ('type',metric['type']),
+                    ('help',metric['help']),
+                    ('values',values),
+                ])
+
+        return output
+
+    def get_prometheus_text(self):
+        """
+        Get the metrics in the Prometheus text exposition format
+        """
+        lines=[]
+        for name,metric in self.asdict().items():
+            if metric['help'] is not None:
+                lines.append('# HELP %s %s' % (name,
+                                               _escape_help(metric['help'])))
+            lines.append('# TYPE %s %s' % (name,metric['type']))
+
+            for entry in metric['values']:
+                labels=entry['labels']
+                if metric['type']=='counter':
+                    lines.append('%s%s %s' % (name,
+                                              _format_labels(labels),
+                                              _format_number(entry['value'])))
+                    continue
+
+                for upper,count in entry['buckets'].items():
+                    blabels=OrderedDict(labels)
+                    blabels['le']=upper
+                    lines.append('%s_bucket%s %d' % (name,
+                                                     _format_labels(blabels),
+                                                     count))
+                lines.append('%s_sum%s %s' % (name,
+                                              _format_labels(labels),
+                                              _format_number(entry['sum'])))
+                lines.append('%s_count%s %d' % (name,
+                                                _format_labels(labels),
+                                                entry['count']))
+
+        return ''.join(line+'\n' for line in lines)
+
+    def write_prometheus(self, fname):
+        """
+        Write the metrics to a Prometheus textfile.  The file is written
+        under a temporary name and renamed, so a collector never reads a
+        partial file
+        """
+        _write_atomic(fname, self.get_prometheus_text())
+
+    def write_json(self, fname):
+        """
+        Write the metrics from asdict() as JSON
+        """
+        _write_atomic(fname, json.dumps(self.asdict(), indent=1) + '\n')
+
+    def write(self, fname):
+        """
+        Write JSON for names ending in .json, otherwise a Prometheus textfile
+        """
+        if fname.endswith('.json'):
+            self.write_json(fname)
+        else:
+            self.write_prometheus(fname)
+
+    def _get_metric(self, name, type, help):
+        metric=self._metrics.get(name,None)
+        if metric is None:
+            metric={'type':type, 'help':help, 'values':OrderedDict()}
+            self._metrics[name]=metric
+        elif metric['type'] != type:
+            raise ValueError("metric %s is a %s, not a %s" % (name,
+                                                              metric['type'],
+                                                              type))
+        return metric
+
+    def _name(self, name):
+        return '%s_%s' % (self.prefix, name)
+
+    def _on_execute(self, seconds=None, error=None, **info):
+        self.inc(self._name('queries_total'),
+                 help='Queries executed')
+        if error is not None:
+            self.inc(self._name('query_errors_total'),
+                     help='Queries that raised an error')
+        self.observe(self._name('execute_seconds'), seconds,
+                     help='Time to execute a query')
+
+    def _on_fetch_chunk(self, nrows=None, seconds=None, **info):
+        self.inc(self._name('rows_fetched_total'), nrows,
+                 help='Rows fetched')
+        self.observe(self._name('fetch_seconds'), seconds,
+                     help='Time to fetch a chunk of rows from the server')
+
+    def _on_write_chunk(self, fmt=None, nrows=None, nbytes=None,
+                        seconds=None, **info):
+        self.inc(self._name('rows_written_total'), nrows,
+                 help='Rows written', format=fmt)
+        if nbytes is not None:
+            self.inc(self._name('bytes_written_total'), nbytes,
+                     help='Bytes written, before compression', format=fmt)
+        self.observe(self._name('write_seconds'), seconds,
+                     help='Time to write a chunk of rows', format=fmt)
+
+    def _on_file_synced(self, nbytes=None, seconds=None, **info):
+        self.inc(self._name('files_synced_total'),
+                 help='Files copied')
+        self.inc(self._name('bytes_synced_total'), nbytes,
+                 help='Bytes copied')
+        self.observe(self._name('sync_seconds'), seconds,
+                     help='Time to copy a file')
+
+    def __repr__(self):
+        rep=["DESDB MetricsRegistry"]
+        indent=' '*4
+        rep.append("%sinstalled: %s" % (indent,self._installed))
+        rep.append("%smetrics:   %d" % (indent,len(self._metrics)))
+        return '\n'.join(rep)
+
+def _get_label_key(labels):
+    """
+    a hashable key for the labels, sorted by name; None values are dropped
+    """
+    return tuple(sorted(
+        (name,str(val)) for name,val in labels.items() if val is not None
+    ))
+
+def _cumulative(counts):
+    output=[]
+    tot=0
+    for count in counts:
+        tot += count
+        output.append(tot)
+    return output
+
+def _format_number(val):
+    if isinstance(val, float):
+        return repr(val)
+    return str(val)
+
+def _format_labels(labels):
+    if len(labels)==0:
+        return ''
+    parts=['%s="%s"' % (name,_escape_label(val))
+           for name,val in labels.items()]
+    return '{' + ','.join(parts) + '}'
+
+def _escape_label(val):
+    return val.replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def _escape_help(text):
+    return text.replace('\\','\\\\').replace('\n','\\n')
+
+def _write_atomic(fname, text):
+    tmpname=fname+'.tmp'
+    with open(tmpname,'w') as fobj:
+        fobj.write(text)
+    os.rename(tmpname, fname)
@@ -0,0 +1,507 @@
+"""
+Reading and writing numpy .npy files chunk by chunk.
+
+Query results arrive in chunks, and the total number of rows is not known
+until the last chunk.  NpyWriter appends each chunk to the file and fills in
+the number of rows in the header when it is closed, so the result never has
+to be held in memory.  The files are ordinary .npy files that can be read
+with numpy.load, including as a read-only memory map.
+
+SharedArray is a small handle to such a file.  It can be pickled cheaply and
+sent to worker processes, which attach to the data as a read-only memory map
+without copying it.
+
+ColumnarWriter writes a directory with one .npy file per column and a
+schema.json file.  Reading back a few columns with read_columnar only touches
+the files for those columns, which are memory mapped.
+
+examples
+--------
+
+    import desdb
+
+    conn=desdb.Connection()
+
+    # the result is written once into shared memory
+    sh=conn.quick(query, array=True, shared=True)
+
+    # in the workers
+    data=sh.attach()
+
+    # when done
+    sh.unlink()
+
+    # write a columnar directory, e.g. des-query -f npydir -o objects.npydir
+    conn.quickWrite(query, fmt='npydir', file='objects.npydir')
+
+    # read two of the columns as memory maps
+    data=desdb.npyio.read_columnar('objects.npydir', columns=['ra','dec'])
+    ra=data['ra']
+"""
+from __future__ import print_function
+import os
+import json
+import struct
+import tempfile
+
+import numpy
+from numpy.lib import format as npformat
+
+_MAGIC=b'\x93NUMPY'
+
+# room in the header for the largest number of rows
+_MAX_ROWS=10**20
+
+# alignment of the start of the data
+_ALIGN=64
+
+_COLUMNAR_FORMAT='desdb-columnar'
+_COLUMNAR_VERSION=1
+
+class NpyWriter(object):
+    """
+    Write a one-dimensional .npy file chunk by chunk.  The number of rows in
+    the header is filled in when the file is closed.
+
+    parameters
+    ----------
+    fname: string
+        The file to write
+    dtype: numpy dtype or descr
+        The dtype of the array.  Object types are not allowed
+    append: bool, optional
+        If True and the file exists, add rows to the end of it.  The file
+        must have been written by an NpyWriter with the same dtype.
+        Default False
+
+    examples
+    --------
+
+        with NpyWriter(fname, dtype) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    """
+    def __init__(self, fname, dtype, append=False):
+        self.fname=fname
+        self.dtype=numpy.dtype(dtype)
+        if self.dtype.hasobject:
+            raise ValueError("object types cannot be written to npy files")
+
+        if append and os.path.exists(fname):
+            self._open_append()
+        else:
+            self.nrows=0
+            self._hlen=len( _get_header(self.dtype, _MAX_ROWS) )
+            self._fobj=open(fname,'wb')
+            self._fobj.write( _get_header(self.dtype, 0, hlen=self._hlen) )
+
+    def write(self, arr):
+        """
+        Append rows to the file
+
+        parameters
+        ----------
+        arr: array
+            An array with the dtype of the file
+        """
+        if arr.dtype != self.dtype:
+            raise ValueError("expected dtype %s, got %s" % (self.dtype,
+                                                           arr.dtype))
+        arr=numpy.ascontiguousarray(arr)
+        arr.tofile(self._fobj)
+        self.nrows += arr.size
+
+    def truncate(self, nrows):
+        """
+        Drop rows from the end, keeping the first nrows
+        """
+        if nrows > self.nrows:
+            raise ValueError("cannot truncate %s to %d rows, it "
+                             "has %d" % (self.fname,nrows,self.nrows))
+
+        self._fobj.seek(self._hlen + nrows*self.dtype.itemsize)
+        self._fobj.truncate()
+        self.nrows=nrows
+
+    def _open_append(self):
+        self._fobj=open(self.fname,'r+b')
+        try:
+            nrows,hlen=_read_header(self._fobj, self.dtype)
+
+            # the header must have room for the new number of rows
+            if hlen < len( _get_header(self.dtype, _MAX_ROWS) ):
+                raise ValueError("cannot append to %s, it was not written "
+                                 "by an NpyWriter" % self.fname)
+
+            # drop any partial row left by an interrupted write
+            self._fobj.seek(hlen + nrows*self.dtype.itemsize)
+            self._fobj.truncate()
+        except:
+            self._fobj.close()
+            raise
+
+        self.nrows=nrows
+        self._hlen=hlen
+
+    def close(self):
+        """
+        Write the number of rows in the header and close the file
+        """
+        if self._fobj is None:
+            return
+
+        self._fobj.seek(0)
+        self._fobj.write( _get_header(self.dtype, self.nrows, hlen=self._hlen) )
+        self._fobj.close()
+        self._fobj=None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+class ColumnarWriter(object):
+    """
+    Write a directory with one .npy file per column and a schema.json file
+    listing the columns and the number of rows.  Rows are appended chunk by
+    chunk, and the schema is written when the writer is closed.
+
+    parameters
+    ----------
+    dirname: string
+        The directory, created if needed.  Existing column files with
+        the same names are overwritten
+    dtype: numpy dtype or descr
+        A dtype with fields, one for each column
+    append: bool, optional
+        If True and the directory holds complete columnar output with
+        the same columns, add rows to it.  The old schema is kept until
+        the writer is closed.  Default False
+
+    examples
+    --------
+
+        with ColumnarWriter(dirname, dtype) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    """
+    def __init__(self, dirname, dtype, append=False):
+        self.dirname=dirname
+        self.dtype=numpy.dtype(dtype)
+        if self.dtype.names is None:
+            raise ValueError("the dtype must have fields")
+
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        schema_fname=get_schema_fname(dirname)
+        if append and os.path.exists(schema_fname):
+            self.nrows=self._check_schema()
+        else:
+            append=False
+            self.nrows=0
+
+        # a stale schema would describe the wrong columns.  When appending
+        # it still describes the rows already written, and is replaced
+        # on close
+        if not append and os.path.exists(schema_fname):
+            os.remove(schema_fname)
+
+        self._writers=[]
+        for name in self.dtype.names:
+            fname=get_column_fname(dirname, name)
+            self._writers.append( NpyWriter(fname, self.dtype[name],
+                                            append=append) )
+
+    def write(self, arr):
+        """
+        Append rows to the column files
+
+        parameters
+        ----------
+        arr: array
+            An array with the dtype of the writer
+        """
+        for name,writer in zip(self.dtype.names, self._writers):
+            writer.write(arr[name])
+        self.nrows += arr.size
+
+    def truncate(self, nrows):
+        """
+        Drop rows from the end, keeping the first nrows
+        """
+        for writer in self._writers:
+            writer.truncate(nrows)
+        self.nrows=nrows
+
+    def _check_schema(self):
+        """
+        check the existing output matches the dtype, and get the
+        number of rows
+        """
+        schema=read_columnar_schema(self.dirname)
+        columns=[(c['name'], numpy.dtype(c['dtype']))
+                 for c in schema['columns']]
+        expected=[(name, self.dtype[name]) for name in self.dtype.names]
+        if columns != expected:
+            raise ValueError("cannot append to %s, the columns "
+                             "differ" % self.dirname)
+        return schema['nrows']
+
+    def close(self):
+        """
+        Close the column files and write the schema
+        """
+        if self._writers is None:
+            return
+
+        for writer in self._writers:
+            writer.close()
+        self._writers=None
+
+        columns=[]
+        for name in self.dtype.names:
+            columns.append({'name':name,
+                            'dtype':self.dtype[name].str})
+
+        schema={'format':_COLUMNAR_FORMAT,
+                'version':_COLUMNAR_VERSION,
+                'nrows':self.nrows,
+                'columns':columns}
+
+        # write and rename, so a schema is never partial
+        fname=get_schema_fname(self.dirname)
+        with open(fname+'.tmp','w') as fobj:
+            json.dump(schema, fobj, indent=1)
+        os.rename(fname+'.tmp', fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is None:
+            self.close()
+        elif self._writers is not None:
+            # leave no schema, so the output is not taken as complete
+            for writer in self._writers:
+                writer.close()
+            self._writers=None
+
+def read_columnar(dirname, columns=None, mmap=True):
+    """
+    Read columns from a directory written by ColumnarWriter
+
+    parameters
+    ----------
+    dirname: string
+        The directory
+    columns: sequence, optional
+        Names of the columns to read.  Default all
+    mmap: bool, optional
+        If True, the columns are read-only memory maps, so only the
+        bytes used are read from disk.  Default True
+
+    returns
+    -------
+    A dict of arrays keyed by column name
+    """
+    schema=read_columnar_schema(dirname)
+    names=[c['name'] for c in schema['columns']]
+
+    if columns is None:
+        columns=names
+    else:
+        missing=[c for c in columns if c not in names]
+        if len(missing) > 0:
+            raise ValueError("columns not found in %s: %s" % (dirname,
+                                                             missing))
+
+    data={}
+    for name in columns:
+        data[name]=read_npy(get_column_fname(dirname, name), mmap=mmap)
+    return data
+
+def read_columnar_schema(dirname):
+    """
+    Read the schema for a directory written by ColumnarWriter.  This is
+    a dict with the number of rows, 'nrows', and a list of columns, each
+    with a 'name' and 'dtype'
+    """
+    fname=get_schema_fname(dirname)
+    if not os.path.exists(fname):
+        raise IOError("no schema found in %s; the directory is not "
+                      "complete or not columnar output" % dirname)
+
+    with open(fname) as fobj:
+        schema=json.load(fobj)
+
+    if schema.get('format',None) != _COLUMNAR_FORMAT:
+        raise ValueError("%s is not columnar output" % fname)
+
+    return schema
+
+def get_schema_fname(dirname):
+    return os.path.join(dirname, 'schema.json')
+
+def get_column_fname(dirname, name):
+    return os.path.join(dirname, name+'.npy')
+
+class SharedArray(object):
+    """
+    A handle to an array stored in a .npy file, for example in shared
+    memory under /dev/shm.  The handle is cheap to pickle, so it can be sent
+    to worker processes, which attach to the data as a read-only memory map.
+
+    Use as a context manager to remove the files on exit, or call unlink()
+
+    parameters
+    ----------
+    fname: string
+        The .npy file
+    mask_fname: string, optional
+        A .npy file holding a mask for NULL values, see
+        desdb.desdb.cursor2array
+    """
+    def __init__(self, fname, mask_fname=None):
+        self.fname=fname
+        self.mask_fname=mask_fname
+
+    def attach(self):
+        """
+        Get a read-only memory map of the array.  If there is a mask,
+        (array, mask) is returned
+        """
+        arr=read_npy(self.fname, mmap=True)
+        if self.mask_fname is not None:
+            mask=read_npy(self.mask_fname, mmap=True)
+            return arr, mask
+        else:
+            return arr
+
+    def unlink(self):
+        """
+        Remove the files.  Arrays already attached remain valid until
+        they are deleted
+        """
+        for fname in (self.fname, self.mask_fname):
+            if fname is not None and os.path.exists(fname):
+                os.remove(fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.unlink()
+
+    def __repr__(self):
+        rep=["DESDB SharedArray"]
+        indent=' '*4
+        rep.append("%sfname: %s" % (indent,self.fname))
+        if self.mask_fname is not None:
+            rep.append("%smask:  %s" % (indent,self.mask_fname))
+        return '\n'.join(rep)
+
+def read_npy(fname, mmap=False):
+    """
+    Read a .npy file, optionally as a read-only memory map
+    """
+    if mmap:
+        return numpy.load(fname, mmap_mode='r')
+    else:
+        return numpy.load(fname)
+
+def get_shared_dir():
+    """
+    The directory for shared results: $DESDB_SHM_DIR if set, else /dev/shm
+    if it exists, else the temporary directory
+    """
+    dir=os.environ.get('DESDB_SHM_DIR',None)
+    if dir is None:
+        if os.path.isdir('/dev/shm'):
+            dir='/dev/shm'
+        else:
+            dir=tempfile.gettempdir()
+    return dir
+
+def get_shared_fname(shared=True):
+    """
+    Get the file name for a shared result
+
+    parameters
+    ----------
+    shared: True or string
+        If True, a new file is made in get_shared_dir().  If a string
+        ending in .npy, it is the file name.  Otherwise it is the
+        directory in which to make a new file
+    """
+    if shared is not True and shared.endswith('.npy'):
+        return shared
+
+    if shared is True:
+        dir=get_shared_dir()
+    else:
+        dir=shared
+
+    fd,fname=tempfile.mkstemp(prefix='desdb-', suffix='.npy', dir=dir)
+    os.close(fd)
+    return fname
+
+def get_mask_fname(fname):
+    """
+    The file holding the NULL mask for the input .npy file
+    """
+    if fname.endswith('.npy'):
+        fname=fname[:-4]
+    return fname+'-mask.npy'
+
+def _read_header(fobj, dtype):
+    """
+    Read the header of a .npy file, checking it holds a one-dimensional
+    array with the input dtype.  Returns the number of rows and the length
+    of the header
+    """
+    version=npformat.read_magic(fobj)
+    if version==(1,0):
+        shape,fortran_order,file_dtype=npformat.read_array_header_1_0(fobj)
+    else:
+        shape,fortran_order,file_dtype=npformat.read_array_header_2_0(fobj)
+
+    if len(shape) != 1 or file_dtype != dtype:
+        raise ValueError("cannot append to %s, expected a one-dimensional "
+                         "array with dtype %s" % (fobj.name, dtype))
+
+    return shape[0], fobj.tell()
+
+def _get_header(dtype, nrows, hlen=None):
+    """
+    The magic string, version and header dict, padded to hlen bytes if sent
+    """
+    header="{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        npformat.dtype_to_descr(dtype), nrows)
+
+    if hlen is None:
+        total=10 + len(header) + 1
+        total += -total % _ALIGN
+        if total-10 > 65535:
+            # too long for version 1.0
+            total=12 + len(header) + 1
+            total += -total % _ALIGN
+    else:
+        total=hlen
+
+    # version 1.0 stores the header length in 2 bytes, 2.0 in 4
+    if total-10 <= 65535:
+        prefix_len=10
+    else:
+        prefix_len=12
+
+    header=header + ' '*(total - prefix_len - len(header) - 1) + '\n'
+    header=header.encode('latin1')
+
+    if prefix_len==10:
+        prefix=_MAGIC + b'\x01\x00' + struct.pack('<H', len(header))
+    else:
+        prefix=_MAGIC + b'\x02\x00' + struct.pack('<I', len(header))
+
+    return prefix + header
@@ -0,0 +1,523 @@
+"""
+Partitioned execution of a single large query over several sessions.
+
+The query is split into nparallel pieces by a predicate on one of its
+columns, and each piece is run on its own pooled session.  The rows from all
+pieces are merged into one cursor-like object, so the usual writers produce
+a single output file.
+
+partition methods
+-----------------
+
+    'mod':   mod(col, n) = i, for integer columns
+    'hash':  ora_hash(col, n-1) = i, for columns of any type
+    'range': lo_i <= col < hi_i, for numeric columns.  The limits come from a
+             min/max query run first.  With ordered=True the pieces are each
+             sorted and read in turn, so the output is sorted by col
+
+Rows with a NULL partition column all go to the last piece.
+
+examples
+--------
+
+    import desdb
+
+    # write the results to a single fits file
+    desdb.parallel.parallel_write(query, 4, 'coadd_objects_id',
+                                  fmt='fits', file='objects.fits')
+
+    # or use the merged cursor with the other writers
+    curs=desdb.parallel.ParallelCursor(query, 4, 'coadd_objects_id')
+    try:
+        data=desdb.desdb.cursor2array(curs)
+    finally:
+        curs.close()
+"""
+from __future__ import print_function
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import desdb
+from . import pool
+from . import hooks
+from . import profiling
+
+_METHODS=('mod','hash','range')
+
+def parallel_write(query,
+                   nparallel,
+                   partition_by,
+                   method='mod',
+                   ordered=False,
+                   fmt='csv',
+                   header='names',
+                   replace_none=None,
+                   file=None,
+                   params=None,
+                   prefetch=desdb._PREFETCH,
+                   split_by=None,
+                   max_open=None,
+                   index_by=None,
+                   show=False,
+                   **keys):
+    """
+    Execute the query in nparallel pieces on separate sessions and write
+    the merged results, as done by Connection.quickWrite.  The output is
+    written by a single writer in this thread.
+
+    parameters
+    ----------
+    query: string
+        A query to execute
+    nparallel: int
+        Number of pieces, each run on its own session
+    partition_by: string
+        Name of the column used to split the query.  It must appear
+        in the select list
+    method: string, optional
+        'mod', 'hash' or 'range'.  Default 'mod'
+    ordered: bool, optional
+        If True, sort the output by the partition column.  Requires
+        method='range'.  Default False
+    fmt: string, optional
+        The format for writing.  Default 'csv'
+    header: string, optional
+        If not False, write a header
+    replace_none: optional
+        Replace None with this value
+    file: string, optional
+        Write the results to the file rather than standard output
+    params: dict or sequence, optional
+        Values for bind variables in the query
+    prefetch: int or 'auto', optional
+        Number of rows to fetch in each round trip on each session
+    split_by: string or sequence, optional
+        Write a file for each value of these columns, with file the
+        template for the names.  See desdb.split
+    max_open: int, optional
+        Maximum number of files open at once with split_by
+    index_by: string or sequence, optional
+        For fits, add a sorted index on these columns.  See
+        desdb.fitsindex
+    show: bool, optional
+        If True, print the queries to stderr
+    **keys:
+        Keywords for the sessions, e.g. user,password,host,port,dbname
+    """
+    curs=ParallelCursor(query,
+                        nparallel,
+                        partition_by,
+                        method=method,
+                        ordered=ordered,
+                        params=params,
+                        prefetch=prefetch,
+                        numpy_types=(fmt in desdb._numpy_formats),
+                        show=show,
+                        **keys)
+    try:
+        if curs.description is not None:
+            desdb.write_cursor(curs,
+                               fmt=fmt,
+                               header=header,
+                               replace_none=replace_none,
+                               file=file,
+                               split_by=split_by,
+                               max_open=max_open,
+                               index_by=index_by)
+    finally:
+        curs.close()
+
+def get_partition_queries(query, nparallel, partition_by,
+                          method='mod', bounds=None, ordered=False):
+    """
+    Split the query into nparallel queries by a predicate on the
+    partition column
+
+    parameters
+    ----------
+    query: string
+        The query to split
+    nparallel: int
+        Number of pieces
+    partition_by: string
+        Name of the column used to split the query
+    method: string, optional
+        'mod', 'hash' or 'range'.  Default 'mod'
+    bounds: sequence, optional
+        (min, max) of the partition column, required for method='range'
+    ordered: bool, optional
+        If True, each piece is sorted by the partition column
+
+    returns
+    -------
+    list of queries
+    """
+    _check_method(method, ordered)
+    if nparallel < 1:
+        raise ValueError("nparallel must be >= 1, got %s" % nparallel)
+
+    col=partition_by
+    if method=='range':
+        if bounds is None:
+            raise ValueError("send bounds= for method='range'")
+        preds=_get_range_predicates(col, nparallel, bounds)
+    elif method=='mod':
+        preds=['mod(%s, %d) = %d' % (col,nparallel,i)
+               for i in range(nparallel)]
+    else:
+        preds=['ora_hash(%s, %d) = %d' % (col,nparallel-1,i)
+               for i in range(nparallel)]
+
+    # rows with a null partition column match none of the predicates
+    preds[-1] = '(%s) or %s is null' % (preds[-1],col)
+
+    queries=[]
+    for pred in preds:
+        q='select * from (\n%s\n) desdb_part\nwhere %s' % (query, pred)
+        if ordered:
+            q += '\norder by %s' % col
+        queries.append(q)
+
+    return queries
+
+def get_bounds(conn, query, partition_by, params=None, show=False):
+    """
+    Get the (min, max) of the partition column over the query results
+    """
+    q='select min(%s), max(%s) from (\n%s\n) desdb_part'
+    q=q % (partition_by, partition_by, query)
+
+    curs=conn._execute(q, params=params, show=show)
+    try:
+        res=curs.fetchall()
+    finally:
+        curs.close()
+
+    return res[0]
+
+class ParallelCursor(desdb.CursorWrapper):
+    """
+    Run the query in nparallel pieces on pooled sessions, and merge the rows
+    into a single cursor-like object with a description and fetchmany().
+
+    Each piece is fetched in its own thread, which puts chunks of rows on a
+    bounded queue.  Chunks are returned as they arrive, or piece by piece if
+    ordered=True.  Errors in the threads are raised from fetchmany().  The
+    on_fetch_chunk hooks are called from the threads.
+
+    Always call close() so the threads are stopped and the sessions go back
+    to the pool.
+
+    parameters
+    ----------
+    query: string
+        A query to execute
+    nparallel: int
+        Number of pieces, each run on its own session
+    partition_by: string
+        Name of the column used to split the query.  It must appear in
+        the select list
+    method: string, optional
+        'mod', 'hash' or 'range'.  Default 'mod'
+    ordered: bool, optional
+        If True, sort the output by the partition column.  Requires
+        method='range'.  The pieces get their sessions in order, so a
+        full pool delays the later pieces rather than the one being read.
+        Default False
+    params: dict or sequence, optional
+        Values for bind variables in the query
+    prefetch: int or 'auto', optional
+        Number of rows to fetch in each round trip on each session
+    numpy_types: bool, optional
+        Fetch numbers as native types, see Connection._execute
+    depth: int, optional
+        Maximum number of chunks waiting to be read for each piece,
+        default 2
+    show: bool, optional
+        If True, print the queries to stderr
+    **keys:
+        Keywords for the sessions, e.g. user,password,host,port,dbname.
+        The pool for these keywords is grown to nparallel sessions if
+        needed
+    """
+    _sends_fetch_hooks=True
+
+    def __init__(self,
+                 query,
+                 nparallel,
+                 partition_by,
+                 method='mod',
+                 ordered=False,
+                 params=None,
+                 prefetch=desdb._PREFETCH,
+                 numpy_types=False,
+                 depth=desdb._FETCH_DEPTH,
+                 show=False,
+                 **keys):
+
+        super(ParallelCursor,self).__init__(None)
+
+        _check_method(method, ordered)
+
+        self.nparallel=nparallel
+        self.ordered=ordered
+
+        self._pool=pool.get_pool(**keys)
+
+        bounds=None
+        if method=='range':
+            with self._pool.session() as conn:
+                bounds=get_bounds(conn, query, partition_by,
+                                  params=params, show=show)
+
+        queries=get_partition_queries(query, nparallel, partition_by,
+                                      method=method, bounds=bounds,
+                                      ordered=ordered)
+
+        self._params=params
+        self._prefetch=prefetch
+        self._numpy_types=numpy_types
+        self._show=show
+
+        if ordered:
+            nqueue=len(queries)
+        else:
+            nqueue=1
+            depth=depth*len(queries)
+        self._queues=[queue.Queue(maxsize=depth) for i in range(nqueue)]
+
+        self._description=None
+        self._error=None
+        self._described=threading.Event()
+        self._lock=threading.Lock()
+        self._stop=threading.Event()
+        self._conns={}
+
+        self._current=0
+        self._nfinished=0
+        self._done=False
+
+        # the next piece allowed to get a session, for ordered mode
+        self._next_acquire=0
+        self._turn=threading.Condition()
+
+        # the work in the threads is added to the caller's profile
+        self._profile=profiling.get_profile()
+
+        # the pool goes back to its size when the cursor is closed
+        self._pool.expand(nparallel)
+        self._expanded=True
+
+        self._threads=[]
+        for i,q in enumerate(queries):
+            thread=threading.Thread(target=self._produce, args=(i,q))
+            thread.daemon=True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def description(self):
+        """
+        The description of the first piece to be executed
+        """
+        while not self._described.is_set():
+            # a timeout so the main thread can still be interrupted
+            self._described.wait(0.1)
+
+        if self._error is not None:
+            raise self._error
+        return self._description
+
+    @property
+    def arraysize(self):
+        return self._prefetch
+
+    def fetchmany(self, nrows=None):
+        """
+        Get the next chunk of rows fetched by any of the threads.  The
+        chunks are the size set by the prefetch, so nrows is ignored
+        """
+        while not self._done:
+            item=self._get()
+
+            if isinstance(item, desdb._FetchError):
+                self._done=True
+                raise item.err
+
+            if len(item) > 0:
+                return item
+
+            # this piece is finished
+            self._nfinished += 1
+            if self.ordered:
+                self._current += 1
+            if self._nfinished == len(self._threads):
+                self._done=True
+
+        return []
+
+    def close(self):
+        """
+        Stop the threads, cancelling any running queries
+        """
+        self._stop.set()
+        with self._lock:
+            conns=list(self._conns.values())
+        for conn in conns:
+            try:
+                conn.cancel()
+            except Exception:
+                pass
+
+        for thread in self._threads:
+            thread.join()
+
+        if self._expanded:
+            self._expanded=False
+            self._pool.unexpand(self.nparallel)
+
+    def _get(self):
+        if self.ordered:
+            q=self._queues[self._current]
+        else:
+            q=self._queues[0]
+
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def _produce(self, ipart, query):
+        try:
+            with profiling.using(self._profile):
+                conn=self._acquire(ipart)
+                try:
+                    with self._lock:
+                        self._conns[ipart]=conn
+                    try:
+                        self._fetch(ipart, conn, query)
+                    finally:
+                        with self._lock:
+                            del self._conns[ipart]
+                except:
+                    self._pool.release(conn,
+                                       discard=not pool.is_alive(conn))
+                    raise
+                else:
+                    self._pool.release(conn)
+        except BaseException as err:
+            self._set_description(None, error=err)
+            self._put(ipart, desdb._FetchError(err))
+
+    def _acquire(self, ipart):
+        """
+        Get a session for the piece.  In ordered mode the pieces get their
+        sessions in order, so the piece being read always has a session
+        or is the next to get one; otherwise later pieces could hold all
+        the sessions with full queues while the current piece waits
+        """
+        if not self.ordered:
+            return self._pool.acquire()
+
+        with self._turn:
+            while self._next_acquire != ipart:
+                self._turn.wait()
+
+        try:
+            return self._pool.acquire()
+        finally:
+            with self._turn:
+                self._next_acquire += 1
+                self._turn.notify_all()
+
+    def _fetch(self, ipart, conn, query):
+        if self._stop.is_set():
+            return
+
+        curs=conn._execute(query,
+                           params=self._params,
+                           prefetch=self._prefetch,
+                           numpy_types=self._numpy_types,
+                           show=self._show)
+        try:
+            self._set_description(curs.description)
+
+            if curs.description is not None:
+                funcs=hooks.get_hooks('on_fetch_chunk')
+                while not self._stop.is_set():
+                    rows=desdb.timed_fetchmany(curs, funcs)
+                    if len(rows)==0:
+                        break
+                    self._put(ipart, rows)
+
+            self._put(ipart, [])
+        finally:
+            curs.close()
+
+    def _set_description(self, description, error=None):
+        with self._lock:
+            if not self._described.is_set():
+                self._description=description
+                self._error=error
+                self._described.set()
+
+    def _put(self, ipart, item):
+        if self.ordered:
+            q=self._queues[ipart]
+        else:
+            q=self._queues[0]
+
+        desdb._put_unless_stopped(q, item, self._stop)
+
+def _check_method(method, ordered):
+    if method not in _METHODS:
+        raise ValueError("method should be one of %s, "
+                         "got '%s'" % (_METHODS,method))
+    if ordered and method != 'range':
+        raise ValueError("ordered output requires method='range'")
+
+def _get_range_predicates(col, nparallel, bounds):
+    lo,hi=bounds
+    if lo is None:
+        # no rows; everything goes in the last piece
+        return ['1=0']*(nparallel-1) + ['1=1']
+
+    try:
+        span=hi-lo
+        float(span)
+    except TypeError:
+        raise ValueError("method='range' requires a numeric column, "
+                         "try method='hash'")
+
+    if isinstance(lo,float) or isinstance(hi,float):
+        edges=[lo + span*i/float(nparallel) for i in range(1,nparallel)]
+    else:
+        edges=[lo + (span*i)//nparallel for i in range(1,nparallel)]
+
+    edges=[_literal(e) for e in edges]
+
+    preds=[]
+    for i in range(nparallel):
+        if i==0:
+            if nparallel==1:
+                pred='1=1'
+            else:
+                pred='%s < %s' % (col,edges[0])
+        elif i==nparallel-1:
+            pred='%s >= %s' % (col,edges[i-1])
+        else:
+            pred='%s >= %s and %s < %s' % (col,edges[i-1],col,edges[i])
+        preds.append(pred)
+
+    return preds
+
+def _literal(val):
+    if isinstance(val,float):
+        return repr(val)
+    else:
+        return str(val)
@@ -0,0 +1,486 @@
+"""
+Process-wide pools of database sessions.
+
+Logging in to oracle, and parsing ~/.netrc to find the password, is slow
+compared to the small queries run by most of the helpers in desdb.files.  The
+pools here keep Connection objects open between calls so the login is paid
+once per process rather than once per query.
+
+Pools are keyed by the connection parameters, so code asking for sessions with
+the same user/host/port/dbname and session settings (threaded, stmtcachesize,
+prefetch_bytes) shares a pool.
+
+examples
+--------
+
+    import desdb
+
+    with desdb.pool.session() as conn:
+        res=conn.quick(query)
+
+    # or manage the pool directly
+    p=desdb.pool.get_pool(host=host, maxsize=8)
+    conn=p.acquire()
+    try:
+        res=conn.quick(query)
+    finally:
+        p.release(conn)
+"""
+from __future__ import print_function
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from . import desdb
+
+# default maximum number of sessions per pool
+_MAXSIZE=4
+
+# sessions idle longer than this many seconds are closed
+_MAX_IDLE=600.0
+
+# sessions idle longer than this many seconds are checked before being handed
+# out again
+_PING_INTERVAL=60.0
+
+# keywords that determine the session
+_CONN_KEYS=('user','password','host','port','dbname','threaded',
+            'stmtcachesize','prefetch_bytes')
+
+_pools={}
+_pools_lock=threading.Lock()
+_pools_pid=os.getpid()
+
+# pools inherited over a fork; we hold references so the parent's sessions
+# are never logged off from the child
+_orphans=[]
+
+def get_pool(maxsize=None, max_idle=None, ping_interval=None, **keys):
+    """
+    Get the process-wide pool for the input connection parameters,
+    creating it if needed.
+
+    parameters
+    ----------
+    maxsize: int, optional
+        Maximum number of open sessions.  Only used when the pool
+        is created.  Default 4
+    max_idle: float, optional
+        Close sessions idle for longer than this many seconds.
+        Only used when the pool is created.  Default 600
+    ping_interval: float, optional
+        Check sessions idle for longer than this many seconds before
+        handing them out.  Only used when the pool is created.  Default 60
+    **keys:
+        Keywords for the Connection, e.g. user,password,host,port,dbname
+    """
+    global _pools_pid
+
+    # other keywords are often passed along by the helpers in files.py
+    keys=dict( (k,keys[k]) for k in _CONN_KEYS if k in keys )
+    pkey=_get_pool_key(**keys)
+
+    with _pools_lock:
+        if os.getpid() != _pools_pid:
+            # we were forked; the sessions belong to the parent
+            _orphans.append(_pools.copy())
+            _pools.clear()
+            _pools_pid=os.getpid()
+
+        pool=_pools.get(pkey,None)
+        if pool is None:
+            pool=SessionPool(maxsize=maxsize,
+                             max_idle=max_idle,
+                             ping_interval=ping_interval,
+                             **keys)
+            _pools[pkey]=pool
+
+    return pool
+
+@contextmanager
+def session(**keys):
+    """
+    Context manager yielding a pooled session for the input
+    connection parameters.  The session is returned to the pool
+    on exit.
+
+    parameters
+    ----------
+    timeout: float, optional
+        Seconds to wait for a free session.  Default wait forever
+    **keys:
+        Keywords for get_pool
+    """
+    timeout=keys.pop('timeout',None)
+    pool=get_pool(**keys)
+    with pool.session(timeout=timeout) as conn:
+        yield conn
+
+def close_all():
+    """
+    Close all sessions in all pools for this process
+    """
+    with _pools_lock:
+        pools=list(_pools.values())
+        _pools.clear()
+
+    for pool in pools:
+        pool.close()
+
+class SessionPool(object):
+    """
+    A thread-safe pool of Connection objects sharing the same
+    connection parameters.
+
+    parameters
+    ----------
+    maxsize: int, optional
+        Maximum number of open sessions, default 4
+    max_idle: float, optional
+        Close sessions idle for longer than this many seconds, default 600
+    ping_interval: float, optional
+        Check sessions idle for longer than this many seconds before
+        handing them out, default 60.  Dead sessions are replaced.
+    timeout: float, optional
+        Default number of seconds to wait for a free session.  Default
+        is to wait forever
+    **keys:
+        Keywords for the Connection, e.g. user,password,host,port,dbname
+    """
+    def __init__(self,
+                 maxsize=None,
+                 max_idle=None,
+                 ping_interval=None,
+                 timeout=None,
+                 **keys):
+
+        if maxsize is None:
+            maxsize=_MAXSIZE
+        if max_idle is None:
+            max_idle=_MAX_IDLE
+        if ping_interval is None:
+            ping_interval=_PING_INTERVAL
+
+        if maxsize < 1:
+            raise ValueError("maxsize must be >= 1, got %s" % maxsize)
+
+        self.maxsize=maxsize
+        self.max_idle=max_idle
+
+        # maxsize is the largest of the size set by resize() and those
+        # requested by expand()
+        self._base_maxsize=maxsize
+        self._expanded=[]
+        self.ping_interval=ping_interval
+        self.timeout=timeout
+
+        self._keys=keys
+
+        # list of (conn, time last returned)
+        self._idle=[]
+        self._nbusy=0
+        self._closed=False
+        self._cond=threading.Condition()
+
+    @property
+    def keys(self):
+        """
+        the connection keywords for this pool
+        """
+        return self._keys.copy()
+
+    @property
+    def size(self):
+        """
+        number of open sessions, idle or in use
+        """
+        with self._cond:
+            return len(self._idle) + self._nbusy
+
+    def acquire(self, timeout=None):
+        """
+        Check out a session, creating one if the pool is not full.
+
+        parameters
+        ----------
+        timeout: float, optional
+            Seconds to wait for a free session.  Default is the
+            pool timeout.
+
+        returns
+        -------
+        A Connection, which must be given back with release()
+        """
+        if timeout is None:
+            timeout=self.timeout
+
+        if timeout is not None:
+            deadline=time.time() + timeout
+
+        to_close=[]
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("the session pool is closed")
+
+                to_close += self._pop_expired()
+
+                if len(self._idle) > 0:
+                    conn,last_used = self._idle.pop()
+                    break
+
+                if self._nbusy < self.maxsize:
+                    conn,last_used = None,None
+                    break
+
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining=deadline-time.time()
+                    if remaining <= 0:
+                        raise RuntimeError("timed out waiting for a free "
+                                           "session after %s seconds" % timeout)
+                    self._cond.wait(remaining)
+
+            self._nbusy += 1
+
+        # the slow bits are done without holding the lock
+        _close_sessions(to_close)
+        try:
+            if conn is not None:
+                if time.time()-last_used > self.ping_interval:
+                    if not is_alive(conn):
+                        _close_sessions([conn])
+                        conn=None
+
+            if conn is None:
+                conn=desdb.Connection(**self._keys)
+        except:
+            with self._cond:
+                self._nbusy -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def release(self, conn, discard=False):
+        """
+        Return a session to the pool
+
+        parameters
+        ----------
+        conn: Connection
+            A session from acquire()
+        discard: bool, optional
+            If True, close the session rather than keep it
+        """
+        with self._cond:
+            self._nbusy -= 1
+            full = (len(self._idle) + self._nbusy >= self.maxsize)
+            if discard or self._closed or full:
+                to_close=[conn]
+            else:
+                self._idle.append( (conn, time.time()) )
+                to_close=self._pop_expired()
+            self._cond.notify()
+
+        _close_sessions(to_close)
+
+    @contextmanager
+    def session(self, timeout=None):
+        """
+        Context manager to check out a session and return it to the pool
+        when done.  If an exception is raised, the session is only kept if
+        it is still alive.
+        """
+        conn=self.acquire(timeout=timeout)
+        try:
+            yield conn
+        except:
+            self.release(conn, discard=not is_alive(conn))
+            raise
+        else:
+            self.release(conn)
+
+    def resize(self, maxsize):
+        """
+        Change the maximum number of open sessions.  If the pool shrinks,
+        sessions in use are closed as they are released, until the pool
+        is within the new size.
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be >= 1, got %s" % maxsize)
+
+        with self._cond:
+            self._base_maxsize=maxsize
+            to_close=self._set_maxsize()
+
+        _close_sessions(to_close)
+
+    def expand(self, maxsize):
+        """
+        Allow at least maxsize open sessions until a matching call to
+        unexpand(maxsize).  Use this rather than resize() for work that
+        needs more sessions for a while, so the shared pool goes back to
+        its size when the work is done
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be >= 1, got %s" % maxsize)
+
+        with self._cond:
+            self._expanded.append(maxsize)
+            to_close=self._set_maxsize()
+
+        _close_sessions(to_close)
+
+    def unexpand(self, maxsize):
+        """
+        Undo a call to expand(maxsize).  Extra sessions are closed as they
+        are released
+        """
+        with self._cond:
+            if maxsize in self._expanded:
+                self._expanded.remove(maxsize)
+            to_close=self._set_maxsize()
+
+        _close_sessions(to_close)
+
+    @contextmanager
+    def expanded(self, maxsize):
+        """
+        Context manager allowing at least maxsize open sessions for the
+        duration of the block
+
+            with p.expanded(8):
+                ...
+        """
+        self.expand(maxsize)
+        try:
+            yield self
+        finally:
+            self.unexpand(maxsize)
+
+    def reap(self):
+        """
+        Close sessions that have been idle longer than max_idle
+        """
+        with self._cond:
+            to_close=self._pop_expired()
+        _close_sessions(to_close)
+
+    def close(self):
+        """
+        Close all idle sessions.  Sessions still checked out are closed
+        when they are released.
+        """
+        with self._cond:
+            self._closed=True
+            to_close=[c for c,t in self._idle]
+            self._idle=[]
+            self._cond.notify_all()
+
+        _close_sessions(to_close)
+
+    def _set_maxsize(self):
+        """
+        set maxsize from the base size and expansions, returning idle
+        sessions over the new size; call with the lock held
+        """
+        self.maxsize=max([self._base_maxsize] + self._expanded)
+
+        nextra=len(self._idle) + self._nbusy - self.maxsize
+        to_close=[]
+        while nextra > 0 and len(self._idle) > 0:
+            conn,last_used=self._idle.pop(0)
+            to_close.append(conn)
+            nextra -= 1
+        self._cond.notify_all()
+        return to_close
+
+    def _pop_expired(self):
+        """
+        remove sessions idle too long; call with the lock held
+        """
+        if len(self._idle) == 0:
+            return []
+
+        tm=time.time()
+        keep=[]
+        expired=[]
+        for conn,last_used in self._idle:
+            if tm-last_used > self.max_idle:
+                expired.append(conn)
+            else:
+                keep.append( (conn,last_used) )
+
+        self._idle=keep
+        return expired
+
+    def __repr__(self):
+        rep=["DESDB SessionPool"]
+        indent=' '*4
+        with self._cond:
+            rep.append("%smaxsize: %d" % (indent,self.maxsize))
+            rep.append("%sidle:    %d" % (indent,len(self._idle)))
+            rep.append("%sbusy:    %d" % (indent,self._nbusy))
+        return '\n'.join(rep)
+
+def is_alive(conn):
+    """
+    Check whether the session can still talk to the server
+    """
+    try:
+        if hasattr(conn,'ping'):
+            conn.ping()
+        else:
+            curs=conn.cursor()
+            curs.execute('select 1 from dual')
+            curs.fetchall()
+            curs.close()
+    except Exception:
+        return False
+
+    return True
+
+def _close_sessions(conns):
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def _get_pool_key(**keys):
+    """
+    Key the pools by the parameters that determine the session.  Settings
+    not sent get the defaults used by Connection, so sending a default
+    explicitly gives the same pool
+    """
+    host=keys.get('host',None)
+    if host is None:
+        host=desdb._defhost
+    port=keys.get('port',None)
+    if port is None:
+        port=desdb._defport
+    dbname=keys.get('dbname',None)
+    if dbname is None:
+        dbname=desdb._defdb
+
+    threaded=keys.get('threaded',None)
+    if threaded is None:
+        threaded=True
+    stmtcachesize=keys.get('stmtcachesize',None)
+    if stmtcachesize is None:
+        stmtcachesize=desdb._STMTCACHESIZE
+    prefetch_bytes=keys.get('prefetch_bytes',None)
+    if prefetch_bytes is None:
+        prefetch_bytes=desdb._PREFETCH_BYTES
+
+    return (keys.get('user',None),
+            keys.get('password',None),
+            host,
+            str(port),
+            dbname,
+            bool(threaded),
+            int(stmtcachesize),
+            int(prefetch_bytes))
@@ -0,0 +1,331 @@
+"""
+Timing the phases of a query and its output.
+
+While a QueryProfile is active, the code fetching and writing rows adds the
+time spent in each phase
+
+    connect: logging in, for connections made while the profile is active
+    execute: executing the query on the server, up to the first rows
+    fetch:   waiting for rows from the server.  With the fetch thread used
+             by quickWrite, only the part not overlapped with converting
+             and writing is counted
+    convert: converting rows to arrays, text or python containers
+    write:   writing the output, including compression
+
+along with the number of rows fetched and the bytes of output written, and
+the peak resident memory of the process.  The peak is for the whole process
+since it started, not only the profiled code.
+
+The profile is kept per thread, and when none is active the calls go to a
+NullProfile that does nothing, so the cost is a few method calls for each
+chunk of rows.  Code that runs queries in worker threads, such as
+desdb.parallel and des-query --hdu with --nconcurrent, makes the profile of
+the calling thread active in the workers with using().  The times from
+threads working at once are added, so the phases can sum to more than the
+total time.
+
+examples
+--------
+
+    import desdb
+
+    conn=desdb.Connection()
+
+    stats=conn.quickWrite(query, fmt='fits', file='objects.fits',
+                          profile=True)
+    print(stats)
+
+    data,stats=conn.quick(query, array=True, profile=True)
+
+    # any code
+    with desdb.profiling.profiled() as stats:
+        conn.quickWrite(query, file='objects.csv')
+    print(stats.rows_per_sec)
+
+    # in a worker thread
+    prof=desdb.profiling.get_profile()
+    def work():
+        with desdb.profiling.using(prof):
+            conn.quick(query)
+
+    # or from the command line
+    des-query --profile -o objects.csv < sql_file
+"""
+from __future__ import print_function
+import sys
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource=None
+
+# phases in the order they are reported
+_PHASES=('connect','execute','fetch','convert','write')
+
+_local=threading.local()
+
+def get_profile():
+    """
+    Get the profile active in this thread, or the NullProfile
+    """
+    return getattr(_local, 'profile', NULL_PROFILE)
+
+@contextmanager
+def profiled(prof=None):
+    """
+    Make the profile active in this thread for the duration of the block,
+    and yield it.  If prof is not sent a new QueryProfile is made
+
+        with profiled() as stats:
+            conn.quickWrite(query)
+    """
+    if prof is None:
+        prof=QueryProfile()
+
+    with using(prof):
+        prof.start()
+        try:
+            yield prof
+        finally:
+            prof.stop()
+
+@contextmanager
+def using(prof):
+    """
+    Make the profile active in this thread for the duration of the block,
+    without starting or stopping it.  Use this in worker threads to add
+    their work to the profile of the thread that started them, which can
+    be the NullProfile
+
+        prof=get_profile()
+        def work():
+            with using(prof):
+                conn.quick(query)
+    """
+    old=getattr(_local, 'profile', None)
+    _local.profile=prof
+    try:
+        yield prof
+    finally:
+        if old is None:
+            del _local.profile
+        else:
+            _local.profile=old
+
+class QueryProfile(object):
+    """
+    Time spent in each phase, rows fetched and bytes written, see the
+    module docs.  Use profiled() to make it active.  The counts can be
+    added from several threads
+    """
+    enabled=True
+
+    def __init__(self):
+        self.times=OrderedDict( (phase,0.0) for phase in _PHASES )
+        self.nrows=0
+        self.nbytes=0
+        self.peak_memory=None
+
+        self._tm0=None
+        self._tm1=None
+        self._lock=threading.Lock()
+
+    def start(self):
+        """
+        Start the clock for the total time
+        """
+        self._tm0=time.time()
+        self._tm1=None
+
+    def stop(self):
+        """
+        Stop the clock and record the peak memory of the process
+        """
+        self._tm1=time.time()
+        self.peak_memory=get_peak_memory()
+
+    def timer(self, phase):
+        """
+        A context manager adding the time in the block to the phase
+
+            with prof.timer('write'):
+                fobj.write(text)
+        """
+        return _PhaseTimer(self, phase)
+
+    def add_time(self, phase, seconds):
+        """
+        Add seconds to the phase
+        """
+        with self._lock:
+            self.times[phase]=self.times.get(phase,0.0) + seconds
+
+    def add_rows(self, nrows):
+        """
+        Count rows fetched
+        """
+        with self._lock:
+            self.nrows += nrows
+
+    def add_bytes(self, nbytes):
+        """
+        Count bytes of output, before any compression
+        """
+        with self._lock:
+            self.nbytes += nbytes
+
+    @property
+    def elapsed(self):
+        """
+        Total seconds since the profile was started
+        """
+        if self._tm0 is None:
+            return 0.0
+        if self._tm1 is None:
+            return time.time()-self._tm0
+        return self._tm1-self._tm0
+
+    @property
+    def rows_per_sec(self):
+        """
+        Rows fetched per second of total time
+        """
+        elapsed=self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.nrows/elapsed
+
+    def asdict(self):
+        """
+        Get the statistics as a dict, e.g. for writing as json.  The
+        peak_memory is for the process since it started
+        """
+        elapsed=self.elapsed
+        with self._lock:
+            times=OrderedDict(self.times)
+            nrows=self.nrows
+            nbytes=self.nbytes
+        other=max(elapsed-sum(times.values()), 0.0)
+
+        times['other']=other
+
+        return OrderedDict([
+            ('seconds',elapsed),
+            ('phases',times),
+            ('rows',nrows),
+            ('bytes',nbytes),
+            ('rows_per_sec',self.rows_per_sec),
+            ('peak_memory',self.peak_memory),
+        ])
+
+    def summary(self):
+        """
+        A table of the time in each phase and the totals
+        """
+        stats=self.asdict()
+        elapsed=stats['seconds']
+
+        lines=['query profile']
+        indent=' '*4
+        for phase,tm in stats['phases'].items():
+            if elapsed > 0:
+                frac=100.0*tm/elapsed
+            else:
+                frac=0.0
+            lines.append('%s%-8s %10.3f s %6.1f%%' % (indent,phase,tm,frac))
+
+        lines.append('%s%-8s %10.3f s' % (indent,'total',elapsed))
+        lines.append('%s%-8s %10d   %.1f rows/s' % (indent,'rows',
+                                                   stats['rows'],
+                                                   stats['rows_per_sec']))
+        lines.append('%s%-8s %10s' % (indent,'written',
+                                      format_bytes(stats['bytes'])))
+        if stats['peak_memory'] is not None:
+            lines.append('%s%-8s %10s   process peak' % (
+                indent,'peak mem',format_bytes(stats['peak_memory'])
+            ))
+        return '\n'.join(lines)
+
+    def write(self, fobj=None):
+        """
+        Write the summary, by default to stderr
+        """
+        if fobj is None:
+            fobj=sys.stderr
+        print(self.summary(), file=fobj)
+
+    def __repr__(self):
+        return self.summary()
+
+class NullProfile(object):
+    """
+    Used when no profile is active; all methods do nothing
+    """
+    enabled=False
+
+    def timer(self, phase):
+        return _NULL_TIMER
+
+    def add_time(self, phase, seconds):
+        pass
+
+    def add_rows(self, nrows):
+        pass
+
+    def add_bytes(self, nbytes):
+        pass
+
+class _PhaseTimer(object):
+    def __init__(self, prof, phase):
+        self.prof=prof
+        self.phase=phase
+
+    def __enter__(self):
+        self.tm0=time.time()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.prof.add_time(self.phase, time.time()-self.tm0)
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        pass
+
+_NULL_TIMER=_NullTimer()
+NULL_PROFILE=NullProfile()
+
+def get_peak_memory():
+    """
+    The peak resident memory of the process in bytes, or None if it
+    cannot be found
+    """
+    if resource is None:
+        return None
+
+    maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform=='darwin':
+        return maxrss
+    else:
+        # kilobytes on linux
+        return maxrss*1024
+
+def format_bytes(nbytes):
+    """
+    Format a number of bytes as e.g. '12.3 MB'
+    """
+    for unit in ('B','kB','MB','GB'):
+        if abs(nbytes) < 1024.0 or unit=='GB':
+            break
+        nbytes /= 1024.0
+
+    if unit=='B':
+        return '%d B' % nbytes
+    return '%.1f %s' % (nbytes, unit)
@@ -0,0 +1,122 @@
+"""
+Compact containers for query results.
+
+A list of dicts repeats every column name in every row.  The containers here
+hold the same data with much less overhead:
+
+    records: a list of Record objects.  A Record is a tuple with attribute
+             access to the columns, r.band, that also supports r['band'] as
+             for the dicts.  Records are read-only; use asdict() for a row
+             that can be modified
+    columns: a dict with a list of values for each column
+
+examples
+--------
+
+    res=conn.quick(query, container='records')
+    for r in res:
+        print(r.run, r['band'])
+
+    res=conn.quick(query, container='columns')
+    runs=res['run']
+"""
+from __future__ import print_function
+from collections import namedtuple
+
+try:
+    _string_types=(str, unicode)
+except NameError:
+    _string_types=(str,)
+
+_record_classes={}
+
+def get_record_class(names):
+    """
+    Get a Record class with the input column names.  Classes are
+    cached, so results with the same columns share a class
+
+    Names that are not valid python identifiers are still available
+    with r['name'], but have generic attribute names
+    """
+    names=tuple(names)
+    cls=_record_classes.get(names,None)
+    if cls is None:
+        cls=_make_record_class(names)
+        _record_classes[names]=cls
+    return cls
+
+def rows2records(rows, names):
+    """
+    Convert a list of row tuples to a list of Record objects
+    """
+    cls=get_record_class(names)
+    new=tuple.__new__
+    return [new(cls,row) for row in rows]
+
+def rows2columns(rows, names):
+    """
+    Convert a list of row tuples to a dict with a list of values
+    for each column
+    """
+    if len(rows) > 0:
+        columns=[list(col) for col in zip(*rows)]
+    else:
+        columns=[[] for n in names]
+    return dict(zip(names,columns))
+
+def _make_record_class(names):
+    base=namedtuple('Record', names, rename=True)
+    index=dict( (name,i) for i,name in enumerate(names) )
+
+    class Record(base):
+        """
+        A row of a query result.  The columns can be accessed as attributes,
+        by position, or by name as for a dict, r['band'].  Iteration is
+        over the values, as for a tuple; use keys() for the names, but
+        'band' in r tests the names as for a dict.  Records are read-only
+        """
+        __slots__=()
+
+        _names=names
+        _index=index
+
+        def __getitem__(self, key):
+            if isinstance(key, _string_types):
+                try:
+                    key=self._index[key]
+                except KeyError:
+                    raise KeyError(key)
+            return tuple.__getitem__(self, key)
+
+        def __contains__(self, key):
+            return key in self._index
+
+        def keys(self):
+            return list(self._names)
+
+        def values(self):
+            return list(self)
+
+        def items(self):
+            return list(zip(self._names, self))
+
+        def get(self, key, default=None):
+            i=self._index.get(key,None)
+            if i is None:
+                return default
+            return tuple.__getitem__(self, i)
+
+        def asdict(self):
+            """
+            the row as a dict
+            """
+            return dict(zip(self._names, self))
+
+        def __reduce__(self):
+            # pickle by the column names, since the class is made at run time
+            return (_rebuild_record, (self._names, tuple(self)))
+
+    return Record
+
+def _rebuild_record(names, values):
+    return tuple.__new__(get_record_class(names), values)
@@ -0,0 +1,423 @@
+"""
+Exports that can be resumed after a failure.
+
+The query is run sorted by a key column, and every so often the output is
+closed and the last key written and the number of rows are recorded in a
+checkpoint file next to the output, <file>.checkpoint.  If the export dies,
+running it again with the same arguments drops anything written after the
+last checkpoint, re-issues the query for keys greater than the last one, and
+appends to the output, so only the missing tail is fetched.  The last key is
+sent as the bind variable :desdb_last_key, so any params must be a dict.
+
+The key column should not be NULL.  Keys need not be unique; checkpoints are
+only made between rows with different keys.
+
+fits, npydir, csv, space, tab and ndjson output are supported.
+
+examples
+--------
+
+    import desdb
+
+    conn=desdb.Connection()
+
+    # run again with the same arguments to resume
+    desdb.resume.resume_write(conn, query, 'coadd_objects_id',
+                              'objects.fits', fmt='fits')
+
+    # or from the command line
+    des-query -f fits --resume-key coadd_objects_id -o objects.fits < sql_file
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+
+from . import desdb
+from . import split
+from . import cache
+
+# default seconds between checkpoints
+_INTERVAL=60.0
+
+_VERSION=1
+
+# name of the bind variable for the last key written
+_LAST_KEY_BIND='desdb_last_key'
+
+_resume_formats=split._split_formats
+
+try:
+    _string_types=(str, unicode)
+    _int_types=(int, long)
+except NameError:
+    _string_types=(str,)
+    _int_types=(int,)
+
+def resume_write(conn,
+                 query,
+                 resume_key,
+                 file,
+                 fmt='fits',
+                 params=None,
+                 header='names',
+                 replace_none=None,
+                 prefetch=desdb._PREFETCH,
+                 interval=_INTERVAL,
+                 show=False):
+    """
+    Write the results of the query to the file, with checkpoints so an
+    interrupted export can be resumed by calling again with the same
+    arguments
+
+    parameters
+    ----------
+    conn: Connection
+        The database connection
+    query: string
+        A query to execute
+    resume_key: string
+        Column the results are sorted by, used to restart the query.  It
+        must be in the select list and should not be NULL
+    file: string
+        The output file, or directory for npydir
+    fmt: string, optional
+        'fits', 'npydir', 'csv', 'space', 'tab' or 'ndjson'.  Default 'fits'
+    params: dict, optional
+        Values for bind variables in the query.  These are sent by name,
+        since the last key is added to them when resuming
+    header: string, optional
+        If not False, write a header to text files
+    replace_none: optional
+        Replace None with this value
+    prefetch: int or 'auto', optional
+        Number of rows to fetch in each round trip
+    interval: float, optional
+        Seconds between checkpoints, default 60
+    show: bool, optional
+        If True, print the query to stderr
+
+    returns
+    -------
+    The total number of rows in the output
+    """
+    if fmt not in _resume_formats:
+        raise ValueError("format must be one of %s for resumable output, "
+                         "got '%s'" % (', '.join(_resume_formats),fmt))
+
+    if params is not None and not isinstance(params, dict):
+        raise ValueError("params must be a dict for resumable output, "
+                         "got %s" % type(params))
+
+    ckpt_fname=get_checkpoint_fname(file)
+    ident=_get_ident(query, params, resume_key, fmt)
+
+    ckpt=read_checkpoint(ckpt_fname)
+    if ckpt is not None:
+        for key,val in ident.items():
+            if ckpt.get(key,None) != val:
+                raise ValueError("the checkpoint %s is for a different "
+                                 "export; remove it to start "
+                                 "again" % ckpt_fname)
+
+        if ckpt['complete']:
+            print("export to %s is already complete" % file, file=sys.stderr)
+            return ckpt['nrows']
+
+        if ckpt['nrows']==0:
+            ckpt=None
+        else:
+            print("resuming export to %s after %d rows" % (file,ckpt['nrows']),
+                  file=sys.stderr)
+
+    if ckpt is None:
+        last_key=None
+    else:
+        last_key=ckpt['last_key']
+
+    rquery,rparams=get_resume_query(query, resume_key,
+                                    params=params, last_key=last_key)
+    curs=conn._execute(rquery,
+                       params=rparams,
+                       prefetch=prefetch,
+                       numpy_types=(fmt in desdb._numpy_formats),
+                       show=show)
+
+    if curs.description is not None:
+        curs=desdb.ThreadedCursor(curs)
+
+    try:
+        if curs.description is None:
+            return 0
+
+        writer=ResumableWriter(file,
+                               ckpt_fname,
+                               ident,
+                               curs.description,
+                               resume_key,
+                               fmt=fmt,
+                               header=header,
+                               replace_none=replace_none,
+                               checkpoint=ckpt,
+                               interval=interval)
+        return writer.write(curs)
+    finally:
+        curs.close()
+
+def get_resume_query(query, resume_key, params=None, last_key=None):
+    """
+    Wrap the query so it is sorted by the key, and if last_key is sent
+    only returns rows with larger keys.  The key is bound as
+    :desdb_last_key rather than pasted into the query, so the text is
+    the same for every resume
+
+    returns
+    -------
+    The query and the params, a copy with desdb_last_key added when
+    last_key is sent
+    """
+    q='select * from (\n%s\n) desdb_resume' % query
+    if last_key is not None:
+        if params is None:
+            params={}
+        elif not isinstance(params, dict):
+            raise ValueError("params must be a dict to bind the last key, "
+                             "got %s" % type(params))
+        if _LAST_KEY_BIND in params:
+            raise ValueError("%s is reserved for the last key" % _LAST_KEY_BIND)
+
+        params=dict(params)
+        params[_LAST_KEY_BIND]=last_key
+        q += '\nwhere %s > :%s' % (resume_key, _LAST_KEY_BIND)
+    q += '\norder by %s' % resume_key
+    return q, params
+
+def get_checkpoint_fname(file):
+    """
+    The checkpoint file for the output file or directory
+    """
+    return file.rstrip(os.sep) + '.checkpoint'
+
+def read_checkpoint(fname):
+    """
+    Read the checkpoint, or return None if it does not exist
+    """
+    if not os.path.exists(fname):
+        return None
+
+    with open(fname) as fobj:
+        return json.load(fobj)
+
+class ResumableWriter(object):
+    """
+    Write rows sorted by a key, closing the output and recording a
+    checkpoint at intervals.  Used by resume_write
+    """
+    def __init__(self,
+                 file,
+                 ckpt_fname,
+                 ident,
+                 desc,
+                 resume_key,
+                 fmt='fits',
+                 header='names',
+                 replace_none=None,
+                 checkpoint=None,
+                 interval=_INTERVAL):
+
+        self.file=file
+        self.ckpt_fname=ckpt_fname
+        self.ident=ident
+        self.fmt=fmt
+        self.interval=interval
+
+        names=desdb.get_names(desc)
+        col=resume_key.lower()
+        if col not in names:
+            raise ValueError("resume key '%s' not found in the "
+                             "results" % resume_key)
+        self._ikey=names.index(col)
+
+        # the split output files handle appending to each format
+        self._opener=split.get_opener(desc,
+                                      fmt=fmt,
+                                      header=header,
+                                      replace_none=replace_none)
+
+        if checkpoint is None:
+            self.nrows=0
+            self.last_key=None
+            self._fobj=self._opener(file, append=False)
+        else:
+            self.nrows=checkpoint['nrows']
+            self.last_key=checkpoint['last_key']
+            self._fobj=self._reopen(checkpoint)
+
+    def write(self, curs):
+        """
+        Write the rows from the cursor, checkpointing at intervals
+
+        returns
+        -------
+        The total number of rows in the output
+        """
+        # the key of the last row written, which may not be checkpointed
+        written_key=self.last_key
+        last_time=time.time()
+
+        try:
+            for rows in desdb.cursor_chunks(curs):
+                keys=[row[self._ikey] for row in rows]
+                if None in keys:
+                    raise ValueError("found NULL values of the resume key")
+
+                ibound=None
+                if time.time()-last_time > self.interval:
+                    ibound=_find_boundary(keys, written_key)
+
+                if ibound is not None:
+                    if ibound > 0:
+                        self._fobj.write(rows[:ibound])
+                        self.nrows += ibound
+                        written_key=keys[ibound-1]
+
+                    self.checkpoint(written_key)
+                    last_time=time.time()
+
+                    rows=rows[ibound:]
+                    keys=keys[ibound:]
+
+                self._fobj.write(rows)
+                self.nrows += len(rows)
+                written_key=keys[-1]
+
+            self._fobj.close()
+            self._fobj=None
+            self._write_checkpoint(written_key, complete=True)
+        finally:
+            if self._fobj is not None:
+                self._fobj.close()
+                self._fobj=None
+
+        return self.nrows
+
+    def checkpoint(self, last_key):
+        """
+        Close the output, record the rows written, and reopen it
+        for appending
+        """
+        self._fobj.close()
+        self._fobj=None
+
+        self._write_checkpoint(last_key)
+
+        self._fobj=self._opener(self.file, append=True)
+
+    def _write_checkpoint(self, last_key, complete=False):
+        self.last_key=_to_json_value(last_key)
+
+        ckpt=dict(self.ident)
+        ckpt.update({
+            'version':_VERSION,
+            'last_key':self.last_key,
+            'nrows':self.nrows,
+            'bytes':_get_size(self.file),
+            'complete':complete,
+        })
+
+        # write and rename, so the checkpoint is never partial
+        tmpname=self.ckpt_fname+'.tmp'
+        with open(tmpname,'w') as fobj:
+            json.dump(ckpt, fobj, indent=1)
+        os.rename(tmpname, self.ckpt_fname)
+
+    def _reopen(self, checkpoint):
+        """
+        Drop anything written after the checkpoint and open for appending
+        """
+        nrows=checkpoint['nrows']
+
+        if not os.path.exists(self.file):
+            raise IOError("cannot resume, %s is missing" % self.file)
+
+        if self.fmt=='fits':
+            import fitsio
+            with fitsio.FITS(self.file,'rw') as fits:
+                hdu=fits[1]
+                if hdu.get_nrows() < nrows:
+                    raise IOError("cannot resume, %s has fewer rows than "
+                                  "the checkpoint" % self.file)
+                hdu.resize(nrows)
+            return self._opener(self.file, append=True)
+
+        elif self.fmt=='npydir':
+            fobj=self._opener(self.file, append=True)
+            if fobj.writer.nrows < nrows:
+                fobj.close()
+                raise IOError("cannot resume, %s has fewer rows than "
+                              "the checkpoint" % self.file)
+            fobj.writer.truncate(nrows)
+            return fobj
+
+        else:
+            size=checkpoint['bytes']
+            if _get_size(self.file) < size:
+                raise IOError("cannot resume, %s is smaller than at "
+                              "the checkpoint" % self.file)
+            with open(self.file,'r+b') as fobj:
+                fobj.truncate(size)
+            return self._opener(self.file, append=True)
+
+def _find_boundary(keys, last_key):
+    """
+    The last position i in the chunk for which the rows before it can be
+    checkpointed, meaning keys[i-1] differs from keys[i].  None if there
+    is no such position
+    """
+    for i in range(len(keys)-1, 0, -1):
+        if keys[i-1] != keys[i]:
+            return i
+
+    if last_key is not None and keys[0] != last_key:
+        return 0
+
+    return None
+
+def _get_ident(query, params, resume_key, fmt):
+    """
+    what identifies the export in the checkpoint
+    """
+    if isinstance(params, dict):
+        params=sorted(params.items())
+    elif params is not None:
+        params=list(params)
+
+    return {'query':cache.normalize_query(query),
+            'params':repr(params),
+            'resume_key':resume_key.lower(),
+            'fmt':fmt}
+
+def _to_json_value(val):
+    if val is None:
+        return None
+
+    # numpy scalars
+    if hasattr(val, 'item'):
+        val=val.item()
+
+    if isinstance(val, bytes) and not isinstance(val, str):
+        val=val.decode('utf-8')
+
+    if not isinstance(val, _string_types + _int_types + (float,)):
+        raise ValueError("the resume key must be a number or a string, "
+                         "got %s" % type(val))
+    return val
+
+def _get_size(fname):
+    """
+    size in bytes of a file, or 0 for a directory
+    """
+    if os.path.isdir(fname):
+        return 0
+    return os.path.getsize(fname)
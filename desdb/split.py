@@ -0,0 +1,376 @@
+"""
+Writing the results of one query to many files, split by column values.
+
+Rather than running the same query once for each tile or band, run it once
+and route each row to a file named from its values of the split columns.
+The file names come from a template with the column names in braces, e.g.
+
+    objects-{tilename}-{band}.fits
+
+Only a limited number of files are kept open.  When the limit is reached the
+least recently used file is closed, and it is reopened for appending if more
+rows arrive for it.
+
+The text formats csv, space, tab and ndjson are supported, as are fits and
+npydir.
+
+examples
+--------
+
+    import desdb
+
+    conn=desdb.Connection()
+    conn.quickWrite(query, fmt='fits', file='objects-{tilename}.fits',
+                    split_by='tilename')
+
+    # or from the command line
+    des-query --split-by tilename,band -f csv -o 'objects-{tilename}-{band}.csv' < sql_file
+"""
+from __future__ import print_function
+import os
+import string
+from collections import OrderedDict
+
+from . import desdb
+from . import profiling
+
+# default maximum number of files open at once
+_MAX_OPEN=64
+
+try:
+    _string_types=(str, unicode)
+except NameError:
+    _string_types=(str,)
+
+_text_formats=('csv','space','tab','ndjson')
+_split_formats=_text_formats + desdb._numpy_formats
+
+def write_split(curs,
+                template,
+                split_by,
+                fmt='csv',
+                header='names',
+                replace_none=None,
+                max_open=_MAX_OPEN):
+    """
+    Write the rows from the cursor to files named by their values of the
+    split columns, in a single pass over the results
+
+    parameters
+    ----------
+    curs: cursor
+        An executed cursor, or any object with a description and
+        a fetchmany method
+    template: string
+        Template for the file names, with each split column in braces
+        in lower case, e.g. 'objects-{tilename}.fits'.  Existing files
+        are overwritten
+    split_by: string or sequence
+        The column names to split by, either a sequence or a comma
+        separated string.  The columns must be in the select list
+    fmt: string, optional
+        'csv', 'space', 'tab', 'ndjson', 'fits' or 'npydir'.  Default 'csv'
+    header: string, optional
+        If not False, write a header to the text files
+    replace_none: optional
+        Replace None with this value
+    max_open: int, optional
+        Maximum number of files open at once.  Default 64
+
+    returns
+    -------
+    A dict with the number of rows written to each file
+    """
+    writer=SplitWriter(template,
+                       split_by,
+                       fmt=fmt,
+                       header=header,
+                       replace_none=replace_none,
+                       max_open=max_open)
+    return writer.write(curs)
+
+def get_split_columns(split_by):
+    """
+    Get a list of lower case column names from a sequence or a comma
+    separated string
+    """
+    if isinstance(split_by, _string_types):
+        split_by=split_by.split(',')
+
+    names=[name.strip().lower() for name in split_by]
+    if len(names)==0 or '' in names:
+        raise ValueError("bad split columns: %s" % (split_by,))
+    return names
+
+def get_template_fields(template):
+    """
+    The names in braces in the file name template
+    """
+    fields=[]
+    for text,field,spec,conv in string.Formatter().parse(template):
+        if field is not None:
+            fields.append(field)
+    return fields
+
+def format_split_value(val):
+    """
+    Convert a value of a split column to a string for the file name
+    """
+    if val is None:
+        return 'null'
+
+    sval=str(val).strip()
+
+    # keep the file in the directory named by the template
+    return sval.replace(os.sep,'_')
+
+class SplitWriter(object):
+    """
+    Write rows to files chosen by the values of the split columns, with
+    a limit on the number of open files.  See write_split for the
+    meaning of the parameters
+    """
+    def __init__(self,
+                 template,
+                 split_by,
+                 fmt='csv',
+                 header='names',
+                 replace_none=None,
+                 max_open=_MAX_OPEN):
+
+        if fmt not in _split_formats:
+            raise ValueError("format must be one of %s for split output, "
+                             "got '%s'" % (', '.join(_split_formats),fmt))
+        if max_open < 1:
+            raise ValueError("max_open must be >= 1, got %s" % max_open)
+
+        self.template=template
+        self.split_by=get_split_columns(split_by)
+        self.fmt=fmt
+        self.header=header
+        self.replace_none=replace_none
+        self.max_open=max_open
+
+        fields=get_template_fields(template)
+        missing=[name for name in self.split_by if name not in fields]
+        if len(missing) > 0:
+            raise ValueError("the file name template must contain each "
+                             "split column, missing %s" % ', '.join(missing))
+        extra=[name for name in fields if name not in self.split_by]
+        if len(extra) > 0:
+            raise ValueError("unknown names in the file name "
+                             "template: %s" % ', '.join(extra))
+
+    def write(self, curs):
+        """
+        Write the rows from the cursor
+
+        returns
+        -------
+        A dict with the number of rows written to each file
+        """
+        desc=curs.description
+        if desc is None:
+            return {}
+
+        names=desdb.get_names(desc)
+        missing=[name for name in self.split_by if name not in names]
+        if len(missing) > 0:
+            raise ValueError("split columns not found in the "
+                             "results: %s" % ', '.join(missing))
+        index=[names.index(name) for name in self.split_by]
+
+        opener=get_opener(desc,
+                          fmt=self.fmt,
+                          header=self.header,
+                          replace_none=self.replace_none)
+
+        # file names for each key, and the open files in order of use
+        fnames={}
+        files=OrderedDict()
+        nrows={}
+        try:
+            for rows in desdb.cursor_chunks(curs):
+                for key,krows in _group_rows(rows, index):
+                    fname=fnames.get(key,None)
+                    if fname is None:
+                        fname=self._get_fname(key)
+                        fnames[key]=fname
+
+                    fobj=files.pop(fname,None)
+                    if fobj is None:
+                        if len(files) >= self.max_open:
+                            oldname,oldobj=files.popitem(last=False)
+                            oldobj.close()
+
+                        # files seen before are appended to
+                        fobj=opener(fname, append=(fname in nrows))
+                        nrows.setdefault(fname,0)
+
+                    files[fname]=fobj
+
+                    fobj.write(krows)
+                    nrows[fname] += len(krows)
+        finally:
+            for fobj in files.values():
+                fobj.close()
+
+        return nrows
+
+    def _get_fname(self, key):
+        vals=[format_split_value(val) for val in key]
+        return self.template.format(**dict(zip(self.split_by, vals)))
+
+
+def get_opener(desc, fmt='csv', header='names', replace_none=None):
+    """
+    Get a function opener(fname, append=False) returning an output file
+    for rows with the cursor description.  The file has write(rows) and
+    close() methods.  With append=True, rows are added to an existing file
+    """
+    if fmt not in _split_formats:
+        raise ValueError("format must be one of %s, "
+                         "got '%s'" % (', '.join(_split_formats),fmt))
+
+    if fmt in _text_formats:
+        writer=desdb.CursorWriter(fmt=fmt,
+                                  header=header,
+                                  replace_none=replace_none)
+        def opener(fname, append=False):
+            return _TextFile(fname, writer, desc, append=append)
+    else:
+        dtype=desdb.get_numpy_descr(desc)
+        nullable=desdb.get_nullable(desc)
+        if fmt=='fits':
+            cls=_FitsFile
+        else:
+            cls=_ColumnarFile
+
+        def opener(fname, append=False):
+            return cls(fname, dtype, nullable, replace_none, append=append)
+
+    return opener
+
+class _TextFile(object):
+    """
+    one text output file, written with the methods of a CursorWriter
+    """
+    def __init__(self, fname, writer, desc, append=False):
+        from . import gzipio
+
+        self.fobj=gzipio.open_output(fname, append=append)
+        self.fmt=writer.fmt
+        self.writer=writer
+
+        if self.fmt=='ndjson':
+            self.formatter=writer.get_ndjson_formatter(desc)
+        else:
+            self.csv_writer,self.delim=writer.get_csv_writer(self.fobj)
+            if not append and writer.header_type=='names':
+                self.csv_writer.writerow( desdb.get_names(desc) )
+
+    def write(self, rows):
+        if self.fmt=='ndjson':
+            self.writer.write_ndjson_rows(self.fobj, self.formatter, rows)
+        else:
+            self.writer.write_csv_rows(self.fobj,
+                                       self.csv_writer,
+                                       self.delim,
+                                       rows)
+
+    def close(self):
+        self.fobj.close()
+
+class _FitsFile(object):
+    """
+    one fits output file, with the rows in the first extension
+    """
+    def __init__(self, fname, dtype, nullable, replace_none, append=False):
+        import fitsio
+
+        self.fname=fname
+        self.dtype=dtype
+        self.nullable=nullable
+        self.replace_none=replace_none
+
+        if append:
+            self.fits=fitsio.FITS(fname,'rw')
+        else:
+            self.fits=fitsio.FITS(fname,'rw',clobber=True)
+
+    def write(self, rows):
+        prof=profiling.get_profile()
+
+        with prof.timer('convert'):
+            data=desdb.rows2array(rows, self.dtype,
+                                  nullable=self.nullable,
+                                  replace_none=self.replace_none)
+        if len(self.fits) > 1:
+            write=self.fits[-1].append
+        else:
+            write=self.fits.write
+
+        desdb.write_chunk(write, data,
+                          fmt='fits',
+                          file=self.fname,
+                          nrows=data.size,
+                          nbytes=data.nbytes)
+
+    def close(self):
+        self.fits.close()
+
+class _ColumnarFile(object):
+    """
+    one columnar output directory
+    """
+    def __init__(self, dirname, dtype, nullable, replace_none, append=False):
+        from . import npyio
+
+        self.dirname=dirname
+        self.nullable=nullable
+        self.replace_none=replace_none
+
+        self.writer=npyio.ColumnarWriter(dirname, dtype, append=append)
+
+    def write(self, rows):
+        prof=profiling.get_profile()
+
+        with prof.timer('convert'):
+            data=desdb.rows2array(rows, self.writer.dtype,
+                                  nullable=self.nullable,
+                                  replace_none=self.replace_none)
+
+        desdb.write_chunk(self.writer.write, data,
+                          fmt='npydir',
+                          file=self.dirname,
+                          nrows=data.size,
+                          nbytes=data.nbytes)
+
+    def close(self):
+        self.writer.close()
+
+def _group_rows(rows, index):
+    """
+    Group the rows by their values in the index columns, keeping the
+    order of first appearance.  Yields (key, rows) pairs
+    """
+    groups=OrderedDict()
+    if len(index)==1:
+        i=index[0]
+        for row in rows:
+            key=(row[i],)
+            group=groups.get(key,None)
+            if group is None:
+                groups[key]=[row]
+            else:
+                group.append(row)
+    else:
+        for row in rows:
+            key=tuple([row[i] for i in index])
+            group=groups.get(key,None)
+            if group is None:
+                groups[key]=[row]
+            else:
+                group.append(row)
+
+    return groups.items()
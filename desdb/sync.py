@@ -1,12 +1,15 @@
 import sys
 from sys import stderr
 import os
+import time
 import tempfile
 
 import urllib2
 from urlparse import urlparse
 import shutil
 
+from . import hooks
+
 class URLLister(object):
     """
     Get a list of all urls under the specified remote directory.
@@ -139,6 +142,9 @@ class Synchronizer(object):
     debug: bool, optional
         if True, show every step of the procedure
 
+    The on_file_synced hooks are called for each file copied, see
+    desdb.hooks
+
     example
     -------
 
@@ -190,7 +196,9 @@ class Synchronizer(object):
             if self.debug:
                 print >>stderr,cmd
 
+            tm0=time.time()
             self._run_curl(cmd, url)
+            seconds=time.time()-tm0
 
             # We need to check because if the local file already existed and
             # was no older than the remote, no file was downloaded
@@ -203,6 +211,14 @@ class Synchronizer(object):
 
                 self._move_from_tmp(local_path, tmp_path)
 
+                funcs=hooks.get_hooks('on_file_synced')
+                if funcs:
+                    hooks.call(funcs,
+                               url=url,
+                               file=local_path,
+                               nbytes=os.path.getsize(local_path),
+                               seconds=seconds)
+
         except KeyboardInterrupt:
             sys.exit(1)
         finally: